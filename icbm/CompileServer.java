@@ -0,0 +1,229 @@
+import java.io.BufferedInputStream;
+import java.io.BufferedOutputStream;
+import java.io.DataInputStream;
+import java.io.DataOutputStream;
+import java.io.EOFException;
+import java.io.File;
+import java.io.IOException;
+import java.io.PrintWriter;
+import java.io.StringWriter;
+import java.net.InetAddress;
+import java.net.ServerSocket;
+import java.net.Socket;
+import java.net.SocketTimeoutException;
+import java.util.ArrayList;
+import java.util.HashMap;
+import java.util.List;
+import java.util.Map;
+import java.util.concurrent.LinkedBlockingQueue;
+import java.util.concurrent.atomic.AtomicInteger;
+import java.util.concurrent.atomic.AtomicLong;
+
+import javax.tools.JavaCompiler;
+import javax.tools.JavaFileObject;
+import javax.tools.StandardJavaFileManager;
+import javax.tools.ToolProvider;
+
+/**
+ * A long-lived javac for ICBM (see compile_server.py).
+ *
+ * Running javac in the same JVM over and over keeps it warmed up, and
+ * the file managers keep the jars they opened, so a compile doesn't
+ * pay for JVM startup, JIT warmup and reading the jar indexes again.
+ *
+ * The server listens on a port of the loopback interface, which it
+ * prints on the first line of its output. Each connection starts with
+ * the token from the ICBM_COMPILE_SERVER_TOKEN environment variable,
+ * followed by any number of requests, which are handled one after the
+ * other; several connections are handled at once. Everything is sent
+ * with DataOutputStream:
+ *
+ *   token:    UTF
+ *   request:  int n, followed by n UTF javac arguments. Sources are the
+ *             arguments that end in .java; all paths must be absolute.
+ *             n == -1 asks the server to exit.
+ *   response: int exit code, long milliseconds, int n, n bytes of
+ *             UTF-8 compiler output
+ *
+ * The server exits once it has had no connections for the number of
+ * seconds given as its only argument.
+ */
+public class CompileServer {
+
+    private static final JavaCompiler compiler =
+        ToolProvider.getSystemJavaCompiler();
+
+    /** Idle file managers. */
+    private static final LinkedBlockingQueue<FileManager> fileManagers =
+        new LinkedBlockingQueue<FileManager>();
+
+    private static final AtomicInteger connections = new AtomicInteger();
+    private static final AtomicLong lastUsed =
+        new AtomicLong(System.currentTimeMillis());
+
+    /**
+     * A file manager, and the jars it has read. A file manager holds on
+     * to the jars it opened, so it is only reused as long as none of
+     * them changed.
+     */
+    private static class FileManager {
+        final StandardJavaFileManager manager =
+            compiler.getStandardFileManager(null, null, null);
+        final Map<String, String> jars = new HashMap<String, String>();
+
+        boolean isCurrent(List<String> classpath) {
+            for (String jar : classpath) {
+                String known = jars.get(jar);
+                if (known != null && !known.equals(stamp(jar))) {
+                    return false;
+                }
+            }
+            return true;
+        }
+
+        void remember(List<String> classpath) {
+            for (String jar : classpath) {
+                jars.put(jar, stamp(jar));
+            }
+        }
+
+        static String stamp(String path) {
+            File f = new File(path);
+            return f.length() + ":" + f.lastModified();
+        }
+    }
+
+    public static void main(String[] args) throws Exception {
+        final long idleMillis = Long.parseLong(args[0]) * 1000;
+        final String token = System.getenv("ICBM_COMPILE_SERVER_TOKEN");
+        if (compiler == null || token == null) {
+            System.err.println("A JDK and ICBM_COMPILE_SERVER_TOKEN are needed");
+            System.exit(1);
+        }
+
+        final ServerSocket server =
+            new ServerSocket(0, 50, InetAddress.getByName("127.0.0.1"));
+        server.setSoTimeout(10000);
+        System.out.println(server.getLocalPort());
+        System.out.flush();
+
+        while (true) {
+            Socket socket;
+            try {
+                socket = server.accept();
+            } catch (SocketTimeoutException e) {
+                if (connections.get() == 0 &&
+                    System.currentTimeMillis() - lastUsed.get() > idleMillis) {
+                    System.exit(0);
+                }
+                continue;
+            }
+            final Socket client = socket;
+            connections.incrementAndGet();
+            Thread t = new Thread() {
+                public void run() {
+                    try {
+                        serve(client, token);
+                    } catch (EOFException e) {
+                        // The client is done.
+                    } catch (IOException e) {
+                        e.printStackTrace();
+                    } finally {
+                        try {
+                            client.close();
+                        } catch (IOException e) {
+                        }
+                        lastUsed.set(System.currentTimeMillis());
+                        connections.decrementAndGet();
+                    }
+                }
+            };
+            t.setDaemon(true);
+            t.start();
+        }
+    }
+
+    private static void serve(Socket socket, String token) throws IOException {
+        DataInputStream in = new DataInputStream(
+            new BufferedInputStream(socket.getInputStream()));
+        DataOutputStream out = new DataOutputStream(
+            new BufferedOutputStream(socket.getOutputStream()));
+        if (!token.equals(in.readUTF())) {
+            return;
+        }
+        while (true) {
+            int n = in.readInt();
+            if (n == -1) {
+                System.exit(0);
+            }
+            List<String> args = new ArrayList<String>(n);
+            for (int i = 0; i < n; i++) {
+                args.add(in.readUTF());
+            }
+
+            long start = System.currentTimeMillis();
+            StringWriter output = new StringWriter();
+            int exitCode;
+            try {
+                exitCode = compile(args, output);
+            } catch (RuntimeException e) {
+                // Bad arguments end up here.
+                e.printStackTrace(new PrintWriter(output));
+                exitCode = 2;
+            }
+            byte[] bytes = output.toString().getBytes("UTF-8");
+            out.writeInt(exitCode);
+            out.writeLong(System.currentTimeMillis() - start);
+            out.writeInt(bytes.length);
+            out.write(bytes);
+            out.flush();
+        }
+    }
+
+    private static int compile(List<String> args, StringWriter output)
+            throws IOException {
+        List<String> options = new ArrayList<String>();
+        List<String> sources = new ArrayList<String>();
+        List<String> classpath = new ArrayList<String>();
+        for (int i = 0; i < args.size(); i++) {
+            String arg = args.get(i);
+            if (arg.endsWith(".java")) {
+                sources.add(arg);
+                continue;
+            }
+            options.add(arg);
+            if ((arg.equals("-classpath") || arg.equals("-cp")) &&
+                i + 1 < args.size()) {
+                for (String entry :
+                         args.get(i + 1).split(File.pathSeparator)) {
+                    if (entry.endsWith(".jar")) {
+                        classpath.add(entry);
+                    }
+                }
+            }
+        }
+
+        FileManager fm = fileManagers.poll();
+        if (fm != null && !fm.isCurrent(classpath)) {
+            fm.manager.close();
+            fm = null;
+        }
+        if (fm == null) {
+            fm = new FileManager();
+        }
+        boolean success = false;
+        try {
+            Iterable<? extends JavaFileObject> units =
+                fm.manager.getJavaFileObjectsFromStrings(sources);
+            success = compiler.getTask(
+                output, fm.manager, null, options, null, units).call();
+        } finally {
+            // The file manager, and the jars it has open, are kept for
+            // the next compile.
+            fm.manager.flush();
+            fm.remember(classpath);
+            fileManagers.offer(fm);
+        }
+        return success ? 0 : 1;
+    }
+}
@@ -0,0 +1,270 @@
+import java.io.BufferedInputStream;
+import java.io.BufferedOutputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.DataInputStream;
+import java.io.DataOutputStream;
+import java.io.EOFException;
+import java.io.File;
+import java.io.FileDescriptor;
+import java.io.FileInputStream;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.net.URL;
+import java.net.URLClassLoader;
+import java.security.Permission;
+import java.util.HashMap;
+import java.util.Map;
+
+/**
+ * Runs a Java generator (antlr, plovr, ...) as a persistent worker of
+ * ICBM generate rules (see generate_worker.py), e.g.
+ *
+ *   generate(name = "schema",
+ *            compiler = "genschema.sh",
+ *            worker = "GenerateWorker thirdparty/gen.jar com.acme.Gen",
+ *            ...)
+ *
+ * Every request calls the main method of the generator in this JVM, so
+ * only the first one pays for starting a JVM and warming it up.
+ *
+ * The arguments are the generator's classpath (relative to the top of
+ * the workspace), then either its main class, followed by arguments
+ * that go before those of every request, or the name of one of the
+ * entry points for the compiler scripts that ICBM comes with:
+ *
+ *   antlr   takes the arguments of genantlr.sh, and runs antlr.Tool
+ *   plovr   takes the arguments of genjs.sh, and runs plovr's build
+ *
+ * e.g. worker = "GenerateWorker Core/jars/antlr-2.7.6.jar antlr".
+ *
+ * Requests are read from stdin and responses written to stdout. Every
+ * string is an int length followed by that many bytes of UTF-8:
+ *
+ *   request:  int n, then n strings: the directory the generator would
+ *             have been run in, and its arguments
+ *   response: int exit code, then a string with the generator's output
+ *
+ * A JVM can't change its working directory, so the arguments that name
+ * files in the directory (ones that exist, or that have a directory
+ * part and whose directory exists) are made absolute. A generator whose
+ * outputs don't follow from its arguments needs an entry point of its
+ * own.
+ */
+public class GenerateWorker {
+
+    /** Thrown instead of letting the generator call System.exit. */
+    private static class ExitException extends SecurityException {
+        final int status;
+
+        ExitException(int status) {
+            this.status = status;
+        }
+    }
+
+    /** A call of a generator. */
+    private static class Invocation {
+        String[] classpath;
+        String mainClass;
+        /** The static main method, or an instance method that returns
+         *  the exit code. */
+        String method = "main";
+        String[] args;
+        /** Where the generator's standard output goes, or null to
+         *  return it with the response. */
+        File stdout;
+    }
+
+    /** The methods that generators are run with, by classpath, class
+     *  and method name. */
+    private static final Map<String, Method> methods =
+        new HashMap<String, Method>();
+
+    public static void main(String[] args) throws Exception {
+        // Makes antlr throw rather than exit when it fails.
+        System.setProperty("ANTLR_DO_NOT_EXIT", "true");
+        String[] classpath = args[0].split(File.pathSeparator);
+        String entryPoint = args[1];
+        String[] fixedArgs = new String[args.length - 2];
+        System.arraycopy(args, 2, fixedArgs, 0, fixedArgs.length);
+
+        try {
+            System.setSecurityManager(new SecurityManager() {
+                public void checkExit(int status) {
+                    throw new ExitException(status);
+                }
+
+                public void checkPermission(Permission perm) {
+                }
+            });
+        } catch (UnsupportedOperationException e) {
+            // Newer JVMs don't allow it; a generator that calls
+            // System.exit ends the worker, and ICBM starts another one.
+        }
+
+        DataInputStream in = new DataInputStream(
+            new BufferedInputStream(new FileInputStream(FileDescriptor.in)));
+        DataOutputStream out = new DataOutputStream(
+            new BufferedOutputStream(new FileOutputStream(FileDescriptor.out)));
+        while (true) {
+            int n;
+            try {
+                n = in.readInt();
+            } catch (EOFException e) {
+                return;
+            }
+            File dir = new File(readString(in));
+            String[] request = new String[n - 1];
+            for (int i = 0; i < request.length; i++) {
+                request[i] = readString(in);
+            }
+
+            ByteArrayOutputStream output = new ByteArrayOutputStream();
+            PrintStream printer = new PrintStream(output, true);
+            int exitCode;
+            try {
+                exitCode = run(invocation(
+                    classpath, entryPoint, fixedArgs, dir, request), printer);
+            } catch (Exception e) {
+                e.printStackTrace(printer);
+                exitCode = 1;
+            }
+            byte[] bytes = output.toByteArray();
+            out.writeInt(exitCode);
+            out.writeInt(bytes.length);
+            out.write(bytes);
+            out.flush();
+        }
+    }
+
+    /** Turns a request into the call of the generator. */
+    private static Invocation invocation(
+            String[] classpath, String entryPoint, String[] fixedArgs,
+            File dir, String[] request) {
+        Invocation inv = new Invocation();
+        inv.classpath = classpath;
+        if (entryPoint.equals("antlr")) {
+            // genantlr.sh GRAMMAR ... antlr.Tool.main always calls
+            // System.exit, so the tool is run the way main runs it.
+            File grammar = new File(dir, request[0]);
+            inv.mainClass = "antlr.Tool";
+            inv.method = "doEverything";
+            inv.args = new String[] {
+                "-o", grammar.getParent(), grammar.getPath()};
+        } else if (entryPoint.equals("plovr")) {
+            // genjs.sh CLASSPATH CONFIG ... OUTPUT, which runs plovr with
+            // the extra classpath and writes its output to OUTPUT.
+            String[] extras = request[0].length() > 0 ?
+                request[0].split(":") : new String[0];
+            inv.classpath = new String[classpath.length + extras.length];
+            System.arraycopy(classpath, 0, inv.classpath, 0, classpath.length);
+            for (int i = 0; i < extras.length; i++) {
+                inv.classpath[classpath.length + i] =
+                    new File(dir, extras[i]).getPath();
+            }
+            inv.mainClass = "org.plovr.cli.Main";
+            inv.args = new String[] {
+                "build", new File(dir, request[1]).getPath()};
+            inv.stdout = new File(dir, request[request.length - 1]);
+        } else {
+            inv.mainClass = entryPoint;
+            inv.args = new String[fixedArgs.length + request.length];
+            System.arraycopy(fixedArgs, 0, inv.args, 0, fixedArgs.length);
+            for (int i = 0; i < request.length; i++) {
+                inv.args[fixedArgs.length + i] = resolve(dir, request[i]);
+            }
+        }
+        return inv;
+    }
+
+    /**
+     * Returns the method of a generator to run. Every classpath gets a
+     * class loader of its own, which is kept for the later requests.
+     */
+    private static Method method(Invocation inv) throws Exception {
+        String[] classpath = inv.classpath;
+        StringBuilder key = new StringBuilder(inv.mainClass);
+        key.append(".").append(inv.method);
+        for (String entry : classpath) {
+            key.append(File.pathSeparator).append(entry);
+        }
+        Method method = methods.get(key.toString());
+        if (method == null) {
+            URL[] urls = new URL[classpath.length];
+            for (int i = 0; i < classpath.length; i++) {
+                urls[i] = new File(classpath[i]).toURI().toURL();
+            }
+            // Not this class's loader, so that the generator doesn't see
+            // this class or the classes of other generators.
+            ClassLoader loader = new URLClassLoader(
+                urls, GenerateWorker.class.getClassLoader().getParent());
+            method = Class.forName(inv.mainClass, true, loader).getMethod(
+                inv.method, String[].class);
+            methods.put(key.toString(), method);
+        }
+        return method;
+    }
+
+    private static int run(Invocation inv, PrintStream output)
+            throws Exception {
+        Method method = method(inv);
+        OutputStream file = null;
+        PrintStream stdout = System.out;
+        PrintStream stderr = System.err;
+        Thread thread = Thread.currentThread();
+        ClassLoader contextLoader = thread.getContextClassLoader();
+        try {
+            if (inv.stdout != null) {
+                file = new BufferedOutputStream(
+                    new FileOutputStream(inv.stdout));
+                System.setOut(new PrintStream(file, false));
+            } else {
+                System.setOut(output);
+            }
+            System.setErr(output);
+            Class<?> cls = method.getDeclaringClass();
+            thread.setContextClassLoader(cls.getClassLoader());
+            if (inv.method.equals("main")) {
+                method.invoke(null, (Object) inv.args);
+                return 0;
+            }
+            Object result = method.invoke(cls.newInstance(), (Object) inv.args);
+            return ((Integer) result).intValue();
+        } catch (InvocationTargetException e) {
+            if (e.getCause() instanceof ExitException) {
+                return ((ExitException) e.getCause()).status;
+            }
+            e.getCause().printStackTrace(output);
+            return 1;
+        } finally {
+            System.out.flush();
+            System.setOut(stdout);
+            System.setErr(stderr);
+            thread.setContextClassLoader(contextLoader);
+            if (file != null) {
+                file.close();
+            }
+        }
+    }
+
+    private static String readString(DataInputStream in) throws IOException {
+        byte[] bytes = new byte[in.readInt()];
+        in.readFully(bytes);
+        return new String(bytes, "UTF-8");
+    }
+
+    private static String resolve(File dir, String arg) {
+        if (arg.startsWith("-") || new File(arg).isAbsolute()) {
+            return arg;
+        }
+        File file = new File(dir, arg);
+        if (file.exists() ||
+            (arg.indexOf('/') >= 0 && file.getParentFile().isDirectory())) {
+            return file.getPath();
+        }
+        return arg;
+    }
+}
@@ -0,0 +1,271 @@
+#!/usr/bin/python
+
+import cPickle
+import fcntl
+import hashlib
+import os
+import shutil
+import threading
+import time
+
+import fileutil
+
+# Bump this whenever the way actions are keyed or stored changes.
+VERSION = 1
+
+_digests = {}
+
+def FileDigest(filename):
+    """Returns the hex SHA-1 of a file's contents.
+
+    Digests are remembered for as long as the file's size, mtime and
+    inode stay the same, so asking again is cheap.
+    """
+    s = os.stat(filename)
+    key = (filename, s.st_size, s.st_mtime, s.st_ino)
+    digest = _digests.get(key)
+    if digest is None:
+        h = hashlib.sha1()
+        with open(filename, "rb") as f:
+            while True:
+                block = f.read(1 << 16)
+                if not block:
+                    break
+                h.update(block)
+        digest = _digests[key] = h.hexdigest()
+    return digest
+
+
+def ActionKey(*parts):
+    """Returns the key of an action, given everything that determines
+    its outputs (names, digests, flags and so on)."""
+    return hashlib.sha1(repr((VERSION,) + parts)).hexdigest()
+
+
+class ActionCache(object):
+
+    """Content-addressed store of the outputs of build actions.
+
+    An action is identified by a key computed from all of its inputs
+    (see ActionKey). For every action that ran, a manifest is kept
+    under actions/, listing the files it produced by their contents'
+    digests, and the contents themselves are kept once under blobs/.
+    Restoring an action copies its outputs back out of the store.
+
+    The cache directory can be shared between workspaces, and it can
+    live outside of build/ so that it survives a clean build. Actions
+    that are not in it are looked up in the remote cache, if there is
+    one, and actions that ran are uploaded to it.
+    """
+
+    def __init__(self, cache_dir, max_size, remote=None):
+        """Constructor.
+
+        Args:
+          cache_dir: Directory to keep the cache in
+          max_size: Size in bytes that Evict trims the cache down to
+          remote: A remote_cache.RemoteCache, or None
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.remote = remote
+        self.lock = threading.Lock()
+        # Bytes of blobs this build added, for the ledger (see Evict)
+        self.added = 0
+        self.hits = 0
+        self.remote_hits = 0
+        self.misses = 0
+
+    def _ManifestPath(self, key):
+        return os.path.join(self.cache_dir, "actions", key[:2], key)
+
+    def _BlobPath(self, digest):
+        return os.path.join(self.cache_dir, "blobs", digest[:2], digest)
+
+    def _WriteBlob(self, filename, write):
+        fileutil.WriteAtomic(filename, write)
+        size = os.path.getsize(filename)
+        with self.lock:
+            self.added += size
+
+    def Restore(self, key, outdir, clear=None):
+        """Copies the outputs of an action into outdir, if it is cached.
+
+        Args:
+          key: The action key
+          outdir: The directory the outputs were stored relative to
+          clear: If given, a function that is called on a hit, before
+                 the outputs are copied, to remove whatever outputs of
+                 an earlier run are in outdir
+
+        Returns: True on a hit, False if the action has to be run.
+        """
+        manifest_path = self._ManifestPath(key)
+        remote = False
+        try:
+            if self.remote and not os.path.exists(manifest_path):
+                manifest = self.remote.Download(
+                    key, self._BlobPath, self._WriteBlob)
+                if manifest is not None:
+                    fileutil.WriteAtomic(manifest_path,
+                                 lambda f: cPickle.dump(manifest, f, -1))
+                    remote = True
+            with open(manifest_path, "rb") as f:
+                manifest = cPickle.load(f)
+            if clear:
+                clear()
+            for relpath, digest, mode in manifest:
+                dest = os.path.join(outdir, relpath)
+                if not os.path.isdir(os.path.dirname(dest)):
+                    os.makedirs(os.path.dirname(dest))
+                if os.path.lexists(dest):
+                    os.unlink(dest)
+                shutil.copyfile(self._BlobPath(digest), dest)
+                os.chmod(dest, mode)
+            # Mark the action as recently used, for Evict.
+            os.utime(manifest_path, None)
+        except (IOError, OSError, EOFError, cPickle.UnpicklingError):
+            with self.lock:
+                self.misses += 1
+            return False
+        with self.lock:
+            if remote:
+                self.remote_hits += 1
+            else:
+                self.hits += 1
+        return True
+
+    def Store(self, key, outdir, files=None):
+        """Stores the outputs of an action that just ran.
+
+        Args:
+          key: The action key
+          outdir: The directory holding the outputs
+          files: Output file names relative to outdir. By default, all
+                 the regular files under outdir (but not symlinks).
+        """
+        if files is None:
+            files = []
+            for dirname, dirs, names in os.walk(outdir):
+                for name in names:
+                    path = os.path.join(dirname, name)
+                    if os.path.isfile(path) and not os.path.islink(path):
+                        files.append(os.path.relpath(path, outdir))
+        manifest = []
+        for relpath in files:
+            path = os.path.join(outdir, relpath)
+            digest = FileDigest(path)
+            blob = self._BlobPath(digest)
+            if not os.path.exists(blob):
+                with open(path, "rb") as src:
+                    self._WriteBlob(
+                        blob, lambda f: shutil.copyfileobj(src, f))
+            manifest.append(
+                (relpath, digest, os.stat(path).st_mode & 0777))
+        fileutil.WriteAtomic(self._ManifestPath(key),
+                     lambda f: cPickle.dump(manifest, f, -1))
+        if self.remote:
+            self.remote.Upload(key, manifest, self._BlobPath)
+
+    def Flush(self):
+        """Waits for the uploads to the remote cache to finish."""
+        if self.remote:
+            self.remote.Flush()
+
+    def Evict(self):
+        """Trims the cache down to max_size bytes, dropping the actions
+        that were used least recently first.
+
+        The total size of the blobs is kept in a ledger file, which
+        every build adds the blobs it wrote to. Only once that crosses
+        max_size is the store walked, which also sets the ledger to
+        the real size again. Builds sharing the cache take turns with
+        the ledger by locking it.
+        """
+        if not os.path.isdir(self.cache_dir):
+            return
+        fd = os.open(os.path.join(self.cache_dir, "size"),
+                     os.O_RDWR | os.O_CREAT, 0644)
+        with os.fdopen(fd, "r+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            with self.lock:
+                added, self.added = self.added, 0
+            try:
+                size = int(f.read()) + added
+            except ValueError:
+                # A new ledger, or a cache from before there was one.
+                size = None
+            if size is None or size > self.max_size:
+                size = self._Trim()
+            f.seek(0)
+            f.truncate()
+            f.write("%d\n" % size)
+
+    def _Trim(self):
+        """Does the work of Evict, and returns the size of the blobs
+        that are left."""
+        # digest -> (size, mtime)
+        blobs = {}
+        for dirname, _, names in os.walk(os.path.join(self.cache_dir, "blobs")):
+            for name in names:
+                s = os.stat(os.path.join(dirname, name))
+                blobs[name] = (s.st_size, s.st_mtime)
+        size = sum(s for s, _ in blobs.itervalues())
+        if size <= self.max_size:
+            return size
+
+        actions = []
+        for dirname, _, names in os.walk(
+                os.path.join(self.cache_dir, "actions")):
+            for name in names:
+                path = os.path.join(dirname, name)
+                actions.append((os.path.getmtime(path), path))
+        actions.sort()
+
+        # Blobs can be shared between actions, so count how many of the
+        # remaining actions use each one.
+        manifests = {}
+        refs = {}
+        for _, path in actions:
+            try:
+                with open(path, "rb") as f:
+                    manifests[path] = set(d for _, d, _ in cPickle.load(f))
+            except Exception:
+                manifests[path] = set()
+            for digest in manifests[path]:
+                refs[digest] = refs.get(digest, 0) + 1
+
+        # Blobs left behind by an interrupted Store. Recent ones may
+        # belong to a Store that is still going on in another build.
+        stale = time.time() - 3600
+        for digest in blobs.keys():
+            if digest not in refs and blobs[digest][1] < stale:
+                try:
+                    os.unlink(self._BlobPath(digest))
+                except OSError:
+                    pass
+                size -= blobs.pop(digest)[0]
+
+        for _, path in actions:
+            if size <= self.max_size:
+                break
+            os.unlink(path)
+            for digest in manifests[path]:
+                refs[digest] -= 1
+                if not refs[digest] and digest in blobs:
+                    try:
+                        os.unlink(self._BlobPath(digest))
+                    except OSError:
+                        pass
+                    size -= blobs.pop(digest)[0]
+        return size
+
+    def Report(self):
+        """Returns a line describing how well the cache did."""
+        hits = self.hits + self.remote_hits
+        total = hits + self.misses
+        report = "Action cache: %d hits, %d misses (%.0f%% hit rate)" % (
+            hits, self.misses, 100.0 * hits / total if total else 0)
+        if self.remote:
+            report += ", %d from the remote cache" % self.remote_hits
+        return report
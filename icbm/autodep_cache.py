@@ -0,0 +1,239 @@
+#!/usr/bin/python
+
+import cPickle
+import hashlib
+import os
+import threading
+
+import fileutil
+
+# Bump this whenever the pickled representation of the genautodep File
+# classes (or of the cache itself) changes, so that old caches get
+# discarded instead of misread.
+VERSION = 3
+
+_MAGIC = "icbm-autodep"
+
+def FileDigest(filename, contents=None):
+    """Returns the hex SHA-1 of a file's contents.
+
+    Args:
+      filename: The file to hash
+      contents: The contents of the file, if the caller already read them
+    """
+    if contents is not None:
+        return hashlib.sha1(contents).hexdigest()
+    h = hashlib.sha1()
+    with open(filename, "rb") as f:
+        while True:
+            block = f.read(1 << 16)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def WriteVersioned(filename, *objs):
+    """Pickles objs, preceded by the version header, into filename."""
+    def _Write(f):
+        f.write("%s %d\n" % (_MAGIC, VERSION))
+        for obj in objs:
+            cPickle.dump(obj, f, -1)
+    fileutil.WriteAtomic(filename, _Write)
+
+
+def ReadVersioned(filename, count):
+    """Reads count objects written by WriteVersioned, or returns None if
+    the file is missing, unreadable or from another version."""
+    try:
+        with open(filename, "rb") as f:
+            if f.readline().split() != [_MAGIC, str(VERSION)]:
+                return None
+            return [cPickle.load(f) for _ in xrange(count)]
+    except Exception:
+        return None
+
+
+class _ShardRef(object):
+
+    """Loads the parsed state of a stub File from its shard on demand."""
+
+    def __init__(self, cache, shard, fname):
+        self.cache = cache
+        self.shard = shard
+        self.fname = fname
+
+    def Load(self, obj):
+        with self.cache.lock:
+            if obj.__dict__.get("_shard") is not self:
+                # Another thread loaded it first.
+                return
+            cls, state = self.cache._LoadShard(self.shard)[self.fname]
+            stat = obj.__dict__.get("stat")
+            obj.__setstate__(state)
+            obj.stat = stat
+            # Only now is the state complete, and the stub done.
+            del obj.__dict__["_shard"]
+
+
+class AutodepCache(object):
+
+    """Cache of parsed genautodep File objects.
+
+    Entries are keyed by file name and validated by size and content
+    digest, so touching a file or checking it out again does not force
+    it to be reparsed. The mtime is only used as a shortcut: if it is
+    unchanged along with the size, the file is not rehashed.
+
+    The cache is stored in a directory. A small index holds the
+    validation data and a stub of every file (see File.Stub), and the
+    full parsed state lives in one shard per module directory. Shards
+    are only unpickled when something asks for state that the stub
+    does not have, so the startup cost follows what is being built.
+    """
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        # filename -> (size, mtime, digest, shard, cls, stub)
+        self.entries = {}
+        # shard -> file name of the shard, relative to dirname
+        self.shard_files = {}
+        # shard -> {filename: (cls, state)}
+        self.shards = {}
+        # filename -> File, for everything looked up or updated this run
+        self.objects = {}
+        self.dirty_shards = set()
+        self.dirty = False
+        # Guards loading shards, and stubs from them
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+        loaded = ReadVersioned(os.path.join(dirname, "index"), 2)
+        if loaded:
+            self.entries, self.shard_files = loaded
+
+    def _LoadShard(self, shard):
+        with self.lock:
+            if shard not in self.shards:
+                loaded = None
+                if shard in self.shard_files:
+                    loaded = ReadVersioned(
+                        os.path.join(self.dirname, self.shard_files[shard]),
+                        1)
+                assert loaded, "autodep cache shard %s is missing" % shard
+                self.shards[shard] = loaded[0]
+            return self.shards[shard]
+
+    def Lookup(self, fname, stat):
+        """Returns the cached File for fname, or None if it must be parsed.
+
+        The returned File is usually a stub that loads the rest of its
+        state from its shard when needed.
+
+        Args:
+          fname: The file name
+          stat: The current os.stat() of the file
+        """
+        entry = self.entries.get(fname)
+        if entry is not None and entry[0] == stat.st_size:
+            size, mtime, digest, shard, cls, stub = entry
+            if mtime == stat.st_mtime or FileDigest(fname) == digest:
+                if mtime != stat.st_mtime:
+                    self.entries[fname] = (size, stat.st_mtime, digest,
+                                           shard, cls, stub)
+                    self.dirty = True
+                self.hits += 1
+                jf = self.objects[fname] = cls.FromStub(
+                    stub, _ShardRef(self, shard, fname))
+                return jf
+        self.misses += 1
+        return None
+
+    def Update(self, fname, stat, digest, jf):
+        """Stores a freshly parsed File in the cache."""
+        shard = "%s=%s" % (jf.module, jf.path)
+        self.entries[fname] = (stat.st_size, stat.st_mtime, digest,
+                               shard, jf.__class__, jf.Stub())
+        self.objects[fname] = jf
+        self.dirty_shards.add(shard)
+        self.dirty = True
+
+    def Save(self):
+        """Writes the cache back out, if anything changed."""
+        write = self.Snapshot()
+        if write:
+            write()
+
+    def Snapshot(self):
+        """Takes what Save writes, to be written out later.
+
+        The state of every file in a changed shard is taken right away,
+        loading stubs as needed, so this has to run on the thread that
+        uses the Files. The writing can then happen on another thread.
+
+        Entries for files that were neither looked up nor updated
+        during this run (i.e. deleted files) are dropped. Every file is
+        written to a temporary name and renamed into place, and the
+        index is written last, so an interrupted build leaves either
+        the old or the new cache behind.
+
+        Returns: A function that writes the cache, or None if nothing
+        changed.
+        """
+        for fname in self.entries.keys():
+            if fname not in self.objects:
+                del self.entries[fname]
+                self.dirty = True
+        if not self.dirty:
+            return None
+
+        by_shard = {}
+        for fname, entry in self.entries.iteritems():
+            if entry[3] in self.dirty_shards:
+                by_shard.setdefault(entry[3], []).append(fname)
+
+        shard_files = dict(self.shard_files)
+        # (shard file, states) to write
+        writes = []
+        old_files = []
+        for shard, fnames in by_shard.iteritems():
+            shard_file = "%s.%s" % (
+                hashlib.sha1(shard).hexdigest()[:16],
+                hashlib.sha1(repr(sorted(
+                    self.entries[f][2] for f in fnames))).hexdigest()[:8])
+            if shard_files.get(shard) == shard_file:
+                continue
+            states = {}
+            for fname in fnames:
+                jf = self.objects[fname]
+                states[fname] = (jf.__class__, jf.__getstate__())
+            writes.append((shard_file, states))
+            if shard in shard_files:
+                old_files.append(shard_files[shard])
+            shard_files[shard] = shard_file
+
+        live = set(entry[3] for entry in self.entries.itervalues())
+        for shard in shard_files.keys():
+            if shard not in live:
+                old_files.append(shard_files.pop(shard))
+
+        entries = dict(self.entries)
+        self.dirty_shards = set()
+        self.dirty = False
+
+        def _Write():
+            for shard_file, states in writes:
+                WriteVersioned(os.path.join(self.dirname, shard_file), states)
+            WriteVersioned(os.path.join(self.dirname, "index"),
+                           entries, shard_files)
+            # Stubs that are still loaded go by the new shard files
+            # from now on, so the old ones can go.
+            with self.lock:
+                self.shard_files = shard_files
+            for old in old_files:
+                try:
+                    os.unlink(os.path.join(self.dirname, old))
+                except OSError:
+                    pass
+        return _Write
@@ -0,0 +1,221 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import autodep_cache
+import config
+import genautodep
+
+FOO = """package com.example.foo;
+
+import com.example.bar.Bar;
+
+public class Foo {
+    Bar bar;
+}
+"""
+
+BAR = """package com.example.bar;
+
+public class Bar {
+}
+"""
+
+class AutodepCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.dir, "cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def Write(self, path, contents, mtime=None):
+        fname = os.path.join(self.dir, path)
+        if not os.path.isdir(os.path.dirname(fname)):
+            os.makedirs(os.path.dirname(fname))
+        with open(fname, "w") as f:
+            f.write(contents)
+        if mtime is not None:
+            os.utime(fname, (mtime, mtime))
+        return fname
+
+    def Store(self, fname, path, name):
+        """Parses fname into a new cache, and saves it."""
+        cache = autodep_cache.AutodepCache(self.cache_dir)
+        with open(fname) as f:
+            jf = genautodep.JavaFile("src", path, name, f.read())
+        cache.Update(fname, os.stat(fname),
+                     autodep_cache.FileDigest(fname), jf)
+        cache.Save()
+        return jf
+
+    def testRoundTrip(self):
+        fname = self.Write("src/com/example/foo/Foo.java", FOO)
+        jf = self.Store(fname, "com/example/foo", "Foo")
+
+        cache = autodep_cache.AutodepCache(self.cache_dir)
+        stub = cache.Lookup(fname, os.stat(fname))
+        self.assertEqual((1, 0), (cache.hits, cache.misses))
+        # The index has enough for the stub; the shard isn't read until
+        # something else is asked for.
+        self.assertEqual(("src", "com/example/foo", "Foo", "com.example.foo"),
+                         (stub.module, stub.path, stub.name, stub.package))
+        self.assertEqual({}, cache.shards)
+        self.assertEqual(jf.parsed_classes, stub.parsed_classes)
+        self.assertEqual(["src=com/example/foo"], cache.shards.keys())
+        self.assertNotIn("_shard", stub.__dict__)
+
+    def testMtimeShortcut(self):
+        fname = self.Write("src/com/example/foo/Foo.java", FOO, 1000)
+        self.Store(fname, "com/example/foo", "Foo")
+
+        # With the size and mtime unchanged, the file isn't hashed.
+        digest = autodep_cache.FileDigest
+        def _Fail(*args):
+            self.fail("rehashed %s" % (args,))
+        autodep_cache.FileDigest = _Fail
+        try:
+            cache = autodep_cache.AutodepCache(self.cache_dir)
+            self.assertTrue(cache.Lookup(fname, os.stat(fname)))
+            self.assertFalse(cache.dirty)
+        finally:
+            autodep_cache.FileDigest = digest
+
+    def testTouchedFileIsHashed(self):
+        fname = self.Write("src/com/example/foo/Foo.java", FOO, 1000)
+        self.Store(fname, "com/example/foo", "Foo")
+
+        # Same contents, new mtime: still a hit, and the new mtime is
+        # remembered so that the next lookup can take the shortcut.
+        os.utime(fname, (2000, 2000))
+        cache = autodep_cache.AutodepCache(self.cache_dir)
+        self.assertTrue(cache.Lookup(fname, os.stat(fname)))
+        self.assertEqual(2000, cache.entries[fname][1])
+        self.assertTrue(cache.dirty)
+
+    def testChangedContents(self):
+        fname = self.Write("src/com/example/foo/Foo.java", FOO, 1000)
+        self.Store(fname, "com/example/foo", "Foo")
+
+        # Same size, different contents.
+        self.Write("src/com/example/foo/Foo.java", FOO.replace("bar;", "baz;"),
+                   2000)
+        cache = autodep_cache.AutodepCache(self.cache_dir)
+        self.assertEqual(None, cache.Lookup(fname, os.stat(fname)))
+        # Different size, same mtime.
+        self.Write("src/com/example/foo/Foo.java", FOO + "\n", 1000)
+        self.assertEqual(None, cache.Lookup(fname, os.stat(fname)))
+        self.assertEqual((0, 2), (cache.hits, cache.misses))
+
+    def testVersionMismatch(self):
+        fname = self.Write("src/com/example/foo/Foo.java", FOO)
+        self.Store(fname, "com/example/foo", "Foo")
+
+        version = autodep_cache.VERSION
+        autodep_cache.VERSION += 1
+        try:
+            cache = autodep_cache.AutodepCache(self.cache_dir)
+            self.assertEqual({}, cache.entries)
+            self.assertEqual(None, cache.Lookup(fname, os.stat(fname)))
+        finally:
+            autodep_cache.VERSION = version
+
+    def testCorruptIndex(self):
+        fname = self.Write("src/com/example/foo/Foo.java", FOO)
+        self.Store(fname, "com/example/foo", "Foo")
+        index = os.path.join(self.cache_dir, "index")
+        with open(index, "r+b") as f:
+            f.seek(30)
+            f.truncate()
+        cache = autodep_cache.AutodepCache(self.cache_dir)
+        self.assertEqual(None, cache.Lookup(fname, os.stat(fname)))
+
+    def testShards(self):
+        foo = self.Write("src/com/example/foo/Foo.java", FOO)
+        bar = self.Write("src/com/example/bar/Bar.java", BAR)
+        cache = autodep_cache.AutodepCache(self.cache_dir)
+        for fname, path, name, contents in (
+            (foo, "com/example/foo", "Foo", FOO),
+            (bar, "com/example/bar", "Bar", BAR)):
+            cache.Update(fname, os.stat(fname),
+                         autodep_cache.FileDigest(fname),
+                         genautodep.JavaFile("src", path, name, contents))
+        cache.Save()
+        # The index, and a shard per directory.
+        files = set(os.listdir(self.cache_dir))
+        self.assertEqual(3, len(files))
+        self.assertIn("index", files)
+
+        # Nothing changed: nothing is written.
+        cache = autodep_cache.AutodepCache(self.cache_dir)
+        cache.Lookup(foo, os.stat(foo))
+        cache.Lookup(bar, os.stat(bar))
+        self.assertEqual(None, cache.Snapshot())
+
+        # Bar is gone: its entry and its shard are dropped, and Foo's
+        # shard is left alone.
+        cache = autodep_cache.AutodepCache(self.cache_dir)
+        foo_shard = cache.shard_files["src=com/example/foo"]
+        cache.Lookup(foo, os.stat(foo))
+        cache.Save()
+        self.assertEqual(set(["index", foo_shard]),
+                         set(os.listdir(self.cache_dir)))
+        cache = autodep_cache.AutodepCache(self.cache_dir)
+        self.assertEqual([foo], cache.entries.keys())
+        self.assertEqual(None, cache.Lookup(bar, os.stat(bar)))
+
+
+class CachedDependenciesTest(unittest.TestCase):
+
+    """Runs autodep twice, the second time entirely from the cache."""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        self.jobs = config.AUTODEP_JOBS
+        config.AUTODEP_JOBS = 1
+        for path, contents in (("src/com/example/foo/Foo.java", FOO),
+                               ("src/com/example/bar/Bar.java", BAR)):
+            os.makedirs(os.path.dirname(path))
+            with open(path, "w") as f:
+                f.write(contents)
+
+    def tearDown(self):
+        config.AUTODEP_JOBS = self.jobs
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def Compute(self):
+        modules = genautodep.ComputeDependencies(["src"])
+        # The cache is written on a thread of its own.
+        for t in threading.enumerate():
+            if t is not threading.current_thread():
+                t.join()
+        return modules["src"].filenames
+
+    def testLinkingStubs(self):
+        files = self.Compute()
+        foo = files["src/com/example/foo/Foo.java"]
+        self.assertEqual(["Bar"], [c.name for c in foo.classes])
+
+        files = self.Compute()
+        foo = files["src/com/example/foo/Foo.java"]
+        bar = files["src/com/example/bar/Bar.java"]
+        cache = foo.__dict__["_shard"].cache
+        self.assertEqual((2, 0), (cache.hits, cache.misses))
+        self.assertIn("_linker", foo.__dict__)
+        # Linking Foo loads its own shard, to get at what it refers to,
+        # and finds Bar by the stub's package and name alone.
+        self.assertEqual([bar], foo.classes)
+        self.assertEqual(["src=com/example/foo"], cache.shards.keys())
+        self.assertIn("_shard", bar.__dict__)
+
+
+if __name__ == "__main__":
+    unittest.main()
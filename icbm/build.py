@@ -1,15 +1,18 @@
 #!/usr/bin/python2.7
 
+import functools
 import optparse
 import os
 import re
 import sys
 import time
 
+import build_fingerprint
 import config
 import engine
 import data
 import genautodep
+import stat_cache
 
 
 APPDIR_RE = re.compile(r"(/app)($|/)")
@@ -38,6 +41,118 @@ def RegisterJavaLibrary(module, f):
     data.DataHolder.Register(module.name, f.path, f.name + "_deploy", jar)
 
 
+def RegisterProtoLibrary(module, f):
+    RegisterJavaLibrary(module, f)
+    # Autodep doesn't find the dependency on protobufs.
+    data.DataHolder.Get(module.name, f.DepName()).deps.append(
+        config.PROTOBUF_JAVA)
+
+
+def ProtoOutputs(f):
+    return [os.path.join(f.path, "%s.java" % f.name)]
+
+
+def RegisterProtoGenerate(mname, f):
+    gen = data.Generate(
+        mname, f.path, f.name + "_proto",
+        "%s/genproto.sh" % engine.ICBM_PATH, None,
+        list(data.FixPath(mname, f.path, ["%s.proto" % f.protoname])) + f.extras,
+        ProtoOutputs(f), batch=True)
+    data.DataHolder.Register(mname, f.path, f.name + "_proto", gen)
+
+
+def RegisterPackageLibrary(mname, path, file_arr):
+    lib = data.JavaLibrary(
+        mname, path, "lib",
+        [],
+        [],
+        list(f.DepName() for f in file_arr),
+        [])
+    data.DataHolder.Register(mname, path, "lib", lib)
+
+
+def RegisterAppDeps(mname, path, file_arr):
+    deps = set()
+    for f in file_arr:
+        for c in f.classes:
+            if not APPDIR_RE.search(c.path):
+                deps.add(c.DepName())
+    lib = data.JavaLibrary(
+        mname, path, "app_deps",
+        [],
+        [],
+        list(deps),
+        [])
+    data.DataHolder.Register(mname, path, "app_deps", lib)
+
+
+def RegisterJarLibrary(mname, jar):
+    lib = data.JavaLibrary(
+        mname, "", jar.name, [],
+        list(data.FixPath(mname, jar.path, ["%s.jar" % jar.name])),
+        [], [])
+    data.DataHolder.Register(mname, jar.path, jar.name, lib)
+
+
+def RegisterJarsLibrary(mname, jars):
+    lib = data.JavaLibrary(
+        mname, "", "jars",
+        [],
+        [],
+        list(f.DepName() for f in jars),
+        [])
+    data.DataHolder.Register(mname, "", "jars", lib)
+
+
+def RegisterJspDeps(mname, jsps):
+    lib = data.JavaLibrary(
+        mname, "", "jsp_deps",
+        [],
+        [],
+        list(c.DepName() for jsp in jsps for c in jsp.classes),
+        [])
+    data.DataHolder.Register(mname, "", "jsp_deps", lib)
+
+
+def JavaLibraryNames(f):
+    """Returns the names of the targets RegisterJavaLibrary creates."""
+    return ["lib%s" % f.name, f.name, f.name + "_deploy"]
+
+
+def AffectedTargets(modules, paths):
+    """Returns the targets that need to be rebuilt when paths change.
+
+    These are the lib, binary and _deploy targets of every java file
+    and proto that depends on the changed files, as well as the
+    jsp_deps libraries.
+
+    Args:
+      modules: Modules as returned by genautodep.ComputeDependencies
+      paths: List of changed file names
+    """
+    index = genautodep.ReverseDependencies(modules)
+    affected, unknown = genautodep.Affected(index, paths)
+    for path in unknown:
+        print >>sys.stderr, "Not tracked by autodep, ignoring:", path
+
+    targets = []
+    for depname in sorted(affected):
+        module, target = depname.split("=", 1)
+        path, name = target.split(":", 1)
+        if name == "jsp_deps":
+            names = [name]
+        elif name.startswith("lib"):
+            names = [name, name[3:], name[3:] + "_deploy"]
+        else:
+            # A jar; whatever uses it is affected as well.
+            continue
+        for name in names:
+            target = "%s=%s:%s" % (module, path, name)
+            if data.DataHolder.Exists(module, target):
+                targets.append(target)
+    return targets
+
+
 def main():
     start_time = time.time()
 
@@ -48,8 +163,37 @@ def main():
     except:
         pass
 
+    # If nothing changed since the last successful build with the same
+    # arguments, there is nothing to do.
+    fingerprint = build_fingerprint.BuildFingerprint(
+        os.path.join(engine.BUILD_DIR, "fingerprint"), sys.argv[1:])
+    if not config.AFFECTED and fingerprint.Matches():
+        print "Nothing changed since the last build"
+        print "Total ICBM build time: %.1f seconds" % (
+            time.time() - start_time)
+        return
+    fingerprint.Invalidate()
+    fingerprint.AddFile("icbm.cfg")
+    for fn in os.listdir(engine.ICBM_PATH):
+        if not fn.endswith(".pyc"):
+            fingerprint.AddFile(os.path.join(engine.ICBM_PATH, fn))
+    # Editing an .icbmignore doesn't touch its directory, so it is
+    # recorded on its own, and missing ones too, so that adding one
+    # counts as a change. It is stat'ed before autodep reads it.
+    for d in config.MODULE_PATHS:
+        fingerprint.AddFile(os.path.join(d, ".icbmignore"))
+
     modules = genautodep.ComputeDependencies(config.MODULE_PATHS)
+    for d in config.MODULE_PATHS:
+        fingerprint.AddFile(d)
+    for module in modules.itervalues():
+        for dirname, s in module.dirs.iteritems():
+            fingerprint.Add(dirname, stat_cache.FromStat(s))
+        for fname, f in module.filenames.iteritems():
+            fingerprint.Add(fname, stat_cache.FromStat(f.stat))
 
+    # The targets implied by autodep are only created when something
+    # asks for them, so that a build only pays for the ones it uses.
     for module in modules.itervalues():
         mname = module.name
         app_dirs = {}
@@ -79,72 +223,56 @@ def main():
                     java_files.append(f)
 
             for f in java_files:
-                RegisterJavaLibrary(module, f)
+                data.DataHolder.RegisterLazy(
+                    mname, f.path, JavaLibraryNames(f),
+                    functools.partial(RegisterJavaLibrary, module, f))
 
             for f in proto_files:
                 # Skip protos if there's already a lib for that name
                 # that is out there.
-                if data.DataHolder.Get(mname, f.DepName()):
+                if data.DataHolder.Exists(mname, f.DepName()):
                     continue
 
-                RegisterJavaLibrary(module, f)
-                # Autodep doesn't find the dependency on protobufs.
-                data.DataHolder.Get(mname, f.DepName()).deps.append(
-                    config.PROTOBUF_JAVA)
+                data.DataHolder.RegisterLazy(
+                    mname, f.path, JavaLibraryNames(f),
+                    functools.partial(RegisterProtoLibrary, module, f))
 
-                gen = data.Generate(
-                    mname, f.path, f.name + "_proto",
-                    "%s/genproto.sh" % engine.ICBM_PATH, None,
-                    list(data.FixPath(mname, f.path, ["%s.proto" % f.protoname])) + f.extras,
-                    [os.path.join(f.path, "%s.java" % f.name)])
-                data.DataHolder.Register(mname, f.path, f.name + "_proto", gen)
+                data.DataHolder.RegisterLazy(
+                    mname, f.path, [f.name + "_proto"], functools.partial(
+                        RegisterProtoGenerate, mname, f))
+                data.DataHolder.RegisterOutputs(
+                    mname, f.path, f.name + "_proto", ProtoOutputs(f))
 
             # Create a lib in each package as well
             for path, file_arr in filemap.iteritems():
-                lib = data.JavaLibrary(
-                    mname, path, "lib",
-                    [],
-                    [],
-                    list(f.DepName() for f in file_arr),
-                    [])
-                data.DataHolder.Register(mname, path, "lib", lib)
+                data.DataHolder.RegisterLazy(
+                    mname, path, ["lib"], functools.partial(
+                        RegisterPackageLibrary, mname, path, file_arr))
 
         for path, file_arr in app_dirs.iteritems():
-            deps = set()
-            for f in file_arr:
-                for c in f.classes:
-                    if not APPDIR_RE.search(c.path):
-                        deps.add(c.DepName())
-            lib = data.JavaLibrary(
-                mname, path, "app_deps",
-                [],
-                [],
-                list(deps),
-                [])
-            data.DataHolder.Register(mname, path, "app_deps", lib)
+            data.DataHolder.RegisterLazy(
+                mname, path, ["app_deps"], functools.partial(
+                    RegisterAppDeps, mname, path, file_arr))
 
         for jar in module.jars:
-            lib = data.JavaLibrary(
-                mname, "", jar.name, [],
-                list(data.FixPath(mname, jar.path, ["%s.jar" % jar.name])),
-                [], [])
-            data.DataHolder.Register(mname, jar.path, jar.name, lib)
-        lib = data.JavaLibrary(
-            mname, "", "jars",
-            [],
-            [],
-            list(f.DepName() for f in module.jars),
-            [])
-        data.DataHolder.Register(mname, "", "jars", lib)
+            data.DataHolder.RegisterLazy(
+                mname, jar.path, [jar.name], functools.partial(
+                    RegisterJarLibrary, mname, jar))
+        data.DataHolder.RegisterLazy(
+            mname, "", ["jars"], functools.partial(
+                RegisterJarsLibrary, mname, module.jars))
 
         if module.jsps:
-            lib = data.JavaLibrary(
-                mname, "", "jsp_deps",
-                [],
-                [],
-                list(c.DepName() for jsp in module.jsps for c in jsp.classes),
-                [])
-            data.DataHolder.Register(mname, "", "jsp_deps", lib)
+            data.DataHolder.RegisterLazy(
+                mname, "", ["jsp_deps"], functools.partial(
+                    RegisterJspDeps, mname, module.jsps))
+
+    if config.AFFECTED:
+        args = AffectedTargets(modules, args)
+        if config.AFFECTED == "print":
+            for target in args:
+                print target
+            return
 
     for target in args:
         # load the corresponding spec files
@@ -155,7 +283,11 @@ def main():
             print "Unknown target:", target
             sys.exit(1)
         d.LoadSpecs()
-    success = data.DataHolder.Go(args)
+    # Spec files glob their directories, so those count as well.
+    for fn in data.spec_files:
+        fingerprint.AddFile(fn)
+        fingerprint.AddFile(os.path.dirname(fn))
+    success = data.DataHolder.Go(args, fingerprint)
 
     elapsed_time = time.time() - start_time
     print
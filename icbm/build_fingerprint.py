@@ -0,0 +1,78 @@
+#!/usr/bin/python
+
+import cPickle
+import os
+
+import fileutil
+import stat_cache
+
+# Bump this whenever what goes into a fingerprint changes.
+VERSION = 1
+
+# Environment variables that select the tools a build runs.
+_ENVIRONMENT = ("PATH", "JAVA_HOME", "ANT_HOME")
+
+class BuildFingerprint(object):
+
+    """Everything a successful build read, to skip running it again.
+
+    The fingerprint is made of the arguments and environment of the
+    build and the stats of the files and directories it looked at:
+    icbm.cfg, ICBM itself, the files and directories autodep walked,
+    the spec files that were loaded (or looked for), and the inputs
+    and outputs of the targets. A directory's mtime changes when files
+    are added to or removed from it, so checking the directories stands
+    in for walking them again.
+
+    If an invocation with the same arguments finds all of it unchanged,
+    it has nothing to do and can return without building the graph.
+    """
+
+    def __init__(self, filename, args):
+        """Constructor.
+
+        Args:
+          filename: File to keep the fingerprint of the last build in
+          args: The command line arguments of this build
+        """
+        self.filename = filename
+        self.key = (VERSION, os.getcwd(), list(args),
+                    [os.environ.get(v) for v in _ENVIRONMENT])
+        # path -> stat tuple (see stat_cache.StatCache.Stat)
+        self.stats = {}
+
+    def Matches(self):
+        """Returns whether the last successful build was the same as
+        this one, and nothing it read has changed since."""
+        try:
+            with open(self.filename, "rb") as f:
+                key, stats = cPickle.load(f)
+        except Exception:
+            return False
+        if key != self.key:
+            return False
+        for path, s in stats:
+            if stat_cache.Stat(path) != s:
+                return False
+        return True
+
+    def Invalidate(self):
+        """Forgets the last build, before starting a new one."""
+        try:
+            os.unlink(self.filename)
+        except OSError:
+            pass
+
+    def Add(self, path, s):
+        """Records that the build read path, which had the stat s."""
+        self.stats[path] = s
+
+    def AddFile(self, path):
+        """Records that the build read path, as it is now."""
+        self.stats[path] = stat_cache.Stat(path)
+
+    def Save(self):
+        fileutil.WriteAtomic(
+            self.filename,
+            lambda f: cPickle.dump((self.key, sorted(self.stats.iteritems())),
+                                   f, -1))
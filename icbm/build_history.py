@@ -0,0 +1,62 @@
+#!/usr/bin/python
+
+import cPickle
+
+import fileutil
+
+# Estimate for a target of a kind that has never been built.
+_DEFAULT_DURATION = 1.0
+
+# How much of a recorded duration is kept when the target runs faster.
+# Targets that turn out to be up to date finish almost immediately, so
+# the estimate only comes down slowly rather than following them.
+_DECAY = 0.9
+
+class BuildHistory(object):
+
+    """How long targets took to run in previous builds.
+
+    The durations are used to guess which targets are on the critical
+    path of a build, so that those can be started first.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        # target name -> (kind, seconds)
+        self.durations = {}
+        try:
+            with open(filename, "rb") as f:
+                self.durations = cPickle.load(f)
+        except Exception:
+            pass
+
+        # kind -> average seconds, for targets without a history
+        totals = {}
+        for kind, seconds in self.durations.itervalues():
+            total = totals.setdefault(kind, [0.0, 0])
+            total[0] += seconds
+            total[1] += 1
+        self.averages = dict((kind, total / count)
+                             for kind, (total, count) in totals.iteritems())
+
+    def Estimate(self, name, kind):
+        """Returns the expected run time of a target, in seconds.
+
+        Args:
+          name: The target name
+          kind: The kind of target (e.g. "JavaCompile"), used to guess
+                for targets that have not run before
+        """
+        if name in self.durations:
+            return self.durations[name][1]
+        return self.averages.get(kind, _DEFAULT_DURATION)
+
+    def Record(self, name, kind, seconds):
+        """Records that a target took the given time to run."""
+        if name in self.durations:
+            seconds = max(seconds, self.durations[name][1] * _DECAY)
+        self.durations[name] = (kind, seconds)
+
+    def Save(self):
+        fileutil.WriteAtomic(
+            self.filename, lambda f: cPickle.dump(self.durations, f, -1))
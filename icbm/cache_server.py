@@ -0,0 +1,138 @@
+#!/usr/bin/python
+
+"""A reference server for the remote action cache.
+
+It keeps everything in a directory and is meant for testing and for
+small setups, e.g.
+
+  python icbm/cache_server.py --port 8080 --dir /tmp/icbm-cache
+
+and then in icbm.cfg:
+
+  [build]
+  remote_cache = http://localhost:8080/
+
+See remote_cache.RemoteCache for the protocol.
+"""
+
+import BaseHTTPServer
+import hashlib
+import optparse
+import os
+import re
+import shutil
+import SocketServer
+import tempfile
+
+_PATH_RE = re.compile(r"^/(ac|cas)/([0-9a-f]{40})$")
+
+class CacheHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # Keep connections alive, as the client pools them.
+    protocol_version = "HTTP/1.1"
+
+    def _Filename(self):
+        m = _PATH_RE.match(self.path)
+        if not m:
+            self._Reply(400)
+            return None
+        kind, key = m.groups()
+        return os.path.join(self.server.cache_dir, kind, key[:2], key)
+
+    def _Reply(self, code, length=0):
+        self.send_response(code)
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+
+    def do_HEAD(self):
+        filename = self._Filename()
+        if filename:
+            if os.path.exists(filename):
+                self._Reply(200, os.path.getsize(filename))
+            else:
+                self._Reply(404)
+
+    def do_GET(self):
+        filename = self._Filename()
+        if not filename:
+            return
+        try:
+            f = open(filename, "rb")
+        except IOError:
+            self._Reply(404)
+            return
+        with f:
+            self._Reply(200, os.fstat(f.fileno()).st_size)
+            shutil.copyfileobj(f, self.wfile)
+
+    def do_PUT(self):
+        filename = self._Filename()
+        if not filename:
+            return
+        dirname = os.path.dirname(filename)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # Another request made it first.
+                pass
+        length = int(self.headers.get("Content-Length", 0))
+        h = hashlib.sha1()
+        temp_fd, temp_filename = tempfile.mkstemp(dir=dirname)
+        try:
+            with os.fdopen(temp_fd, "wb") as f:
+                while length > 0:
+                    block = self.rfile.read(min(length, 1 << 16))
+                    if not block:
+                        break
+                    length -= len(block)
+                    h.update(block)
+                    f.write(block)
+            # Blobs are addressed by their contents, so refuse ones
+            # that don't match.
+            if length or ("/cas/" in self.path and
+                          h.hexdigest() != os.path.basename(filename)):
+                os.unlink(temp_filename)
+                self._Reply(400)
+                return
+            os.rename(temp_filename, filename)
+        except:
+            if os.path.exists(temp_filename):
+                os.unlink(temp_filename)
+            raise
+        self._Reply(201)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(
+                self, format, *args)
+
+
+class CacheServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, cache_dir, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, CacheHandler)
+        self.cache_dir = cache_dir
+        self.verbose = verbose
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--bind", default="localhost",
+                      help="address to listen on")
+    parser.add_option("--port", type="int", default=8080)
+    parser.add_option("--dir", default="icbm-cache",
+                      help="directory to keep the cache in")
+    parser.add_option("-v", "--verbose", action="store_true")
+    (options, args) = parser.parse_args()
+
+    server = CacheServer((options.bind, options.port), options.dir,
+                         options.verbose)
+    print "Serving %s on %s:%d" % (options.dir, options.bind, options.port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+#!/usr/bin/python
+
+import hashlib
+import os
+import Queue
+import socket
+import struct
+import subprocess
+import sys
+import threading
+
+_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       "CompileServer.java")
+
+class CompileServerError(Exception):
+    pass
+
+
+def _WriteUTF(s):
+    """Encodes a string like java.io.DataOutputStream.writeUTF."""
+    if isinstance(s, str):
+        s = s.decode("utf-8")
+    # Java's "modified UTF-8" encodes UTF-16 code units, and NUL as two
+    # bytes.
+    units = s.encode("utf-16-be")
+    data = []
+    for i in xrange(0, len(units), 2):
+        c = (ord(units[i]) << 8) | ord(units[i + 1])
+        if 0 < c < 0x80:
+            data.append(chr(c))
+        elif c < 0x800:
+            data.append(chr(0xc0 | c >> 6) + chr(0x80 | c & 0x3f))
+        else:
+            data.append(chr(0xe0 | c >> 12) + chr(0x80 | c >> 6 & 0x3f) +
+                        chr(0x80 | c & 0x3f))
+    data = "".join(data)
+    if len(data) > 0xffff:
+        raise CompileServerError("Argument too long: %s..." % s[:80])
+    return struct.pack(">H", len(data)) + data
+
+
+def _ReadFully(sock, n):
+    data = []
+    while n:
+        block = sock.recv(n)
+        if not block:
+            raise EOFError("Compile server closed the connection")
+        data.append(block)
+        n -= len(block)
+    return "".join(data)
+
+
+class CompileServer(object):
+
+    """Client of a long-lived javac (see CompileServer.java).
+
+    Starting a JVM for every compile throws away its JIT warmup and the
+    jar indexes it read. Instead, the first compile starts a server
+    that runs javac through javax.tools, and the ones after it, in this
+    build or in later ones, send it their arguments. Several compiles
+    run in it at once, one per connection; connections are pooled
+    between the engine workers.
+
+    The server is detached from the build, listens on the loopback
+    interface and exits on its own once it has been idle for a while.
+    Its port, and the token clients have to send it, are kept in a file
+    that only the user can read. If the server dies, it is started
+    again, and if CompileServer.java changed, the old one is told to
+    exit and a new one is started.
+    """
+
+    def __init__(self, state_dir, memory, idle_seconds):
+        """Constructor.
+
+        Args:
+          state_dir: Directory for the server's classes, port file and log
+          memory: Megabytes of heap the server may use
+          idle_seconds: Seconds without compiles after which the server
+                        exits
+        """
+        self.state_dir = state_dir
+        self.memory = memory
+        self.idle_seconds = idle_seconds
+        self.port_file = os.path.join(state_dir, "server")
+        self.lock = threading.Lock()
+        # (port, token) of the server, or None if it isn't known yet
+        self.server = None
+        # Bumped every time the server is given up on, so that pooled
+        # connections to it are thrown away.
+        self.generation = 0
+        # Idle (socket, generation)
+        self.pool = Queue.LifoQueue()
+        self.version = None
+        # Set, under the lock, once the server can't be started or keeps
+        # failing; javac is spawned for the rest of the build then.
+        self.disabled = False
+
+    def Compile(self, args):
+        """Runs javac on the server.
+
+        Args:
+          args: The javac arguments, with absolute paths
+
+        Returns: (exit code, compiler output, seconds the compile took
+        on the server), or None if the server is disabled, because it
+        couldn't be started or kept failing, in which case the caller
+        spawns javac itself.
+        """
+        if self.disabled:
+            return None
+        try:
+            return self._Compile(args)
+        except CompileServerError as e:
+            self._Disable(e)
+            return None
+
+    def _Disable(self, error):
+        with self.lock:
+            if self.disabled:
+                # Another worker already did.
+                return
+            self.disabled = True
+        print >>sys.stderr, "%s, spawning javac instead" % error
+
+    def _Compile(self, args):
+        request = [struct.pack(">i", len(args))]
+        request.extend(_WriteUTF(arg) for arg in args)
+        request = "".join(request)
+        for attempt in xrange(2):
+            sock, generation = self._Connection()
+            try:
+                sock.sendall(request)
+                returncode, millis, length = struct.unpack(
+                    ">iqi", _ReadFully(sock, 16))
+                output = _ReadFully(sock, length).decode("utf-8")
+            except (socket.error, EOFError) as e:
+                sock.close()
+                if attempt:
+                    raise CompileServerError("Compile server failed: %s" % e)
+                # The server crashed, or it isn't the one in the port
+                # file any more.
+                print >>sys.stderr, "Restarting the compile server (%s)" % e
+                self._Forget(generation)
+                continue
+            self.pool.put((sock, generation))
+            return returncode, output, millis / 1000.0
+
+    def _Connection(self):
+        while True:
+            try:
+                sock, generation = self.pool.get_nowait()
+            except Queue.Empty:
+                break
+            if generation == self.generation:
+                return sock, generation
+            sock.close()
+        for attempt in xrange(2):
+            with self.lock:
+                if self.disabled:
+                    # Another worker gave up on the server meanwhile.
+                    raise CompileServerError("Compile server disabled")
+                if self.server is None:
+                    self.server = self._Find() or self._Start()
+                (port, token), generation = self.server, self.generation
+            try:
+                sock = socket.create_connection(("127.0.0.1", port))
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.sendall(_WriteUTF(token))
+                return sock, generation
+            except socket.error as e:
+                if attempt:
+                    raise CompileServerError(
+                        "Could not connect to the compile server: %s" % e)
+                # It exited since it was started, e.g. after being idle.
+                self._Forget(generation)
+
+    def _Forget(self, generation):
+        with self.lock:
+            if generation != self.generation:
+                # Another worker already did.
+                return
+            self.generation += 1
+            self.server = None
+            try:
+                os.unlink(self.port_file)
+            except OSError:
+                pass
+
+    def _Find(self):
+        """Returns (port, token) of a server started earlier, or None."""
+        try:
+            with open(self.port_file) as f:
+                port, token, version = f.read().split()
+            port = int(port)
+        except (IOError, ValueError):
+            return None
+        if version == self._Version():
+            return port, token
+        # Built from an older CompileServer.java.
+        try:
+            sock = socket.create_connection(("127.0.0.1", port), 1)
+            sock.sendall(_WriteUTF(token) + struct.pack(">i", -1))
+            sock.close()
+        except socket.error:
+            pass
+        return None
+
+    def _Version(self):
+        if self.version is None:
+            with open(_SOURCE, "rb") as f:
+                self.version = hashlib.sha1(f.read()).hexdigest()
+        return self.version
+
+    def _Start(self):
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir)
+        classfile = os.path.join(self.state_dir, "CompileServer.class")
+        if (not os.path.exists(classfile) or
+            os.path.getmtime(classfile) < os.path.getmtime(_SOURCE)):
+            cmd = ["javac", "-d", self.state_dir, _SOURCE]
+            print cmd
+            if subprocess.call(cmd, close_fds=True) != 0:
+                raise CompileServerError("Could not compile %s" % _SOURCE)
+
+        token = os.urandom(16).encode("hex")
+        env = dict(os.environ)
+        env["ICBM_COMPILE_SERVER_TOKEN"] = token
+        cmd = ["java", "-Xmx%dm" % self.memory,
+               "-cp", self.state_dir, "CompileServer", str(self.idle_seconds)]
+        print cmd
+        with open(os.path.join(self.state_dir, "log"), "a") as log:
+            try:
+                # In a session of its own, so that it outlives the build
+                # and doesn't get the build's Ctrl-C.
+                p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                     stderr=log, env=env, close_fds=True,
+                                     preexec_fn=os.setsid)
+            except OSError as e:
+                raise CompileServerError("Could not start %s: %s" % (cmd, e))
+        line = p.stdout.readline()
+        p.stdout.close()
+        try:
+            port = int(line)
+        except ValueError:
+            raise CompileServerError(
+                "Compile server didn't start, see %s" %
+                os.path.join(self.state_dir, "log"))
+
+        temp_filename = self.port_file + ".tmp"
+        fd = os.open(temp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0600)
+        with os.fdopen(fd, "w") as f:
+            f.write("%d %s %s\n" % (port, token, self._Version()))
+        os.rename(temp_filename, self.port_file)
+        return port, token
@@ -2,13 +2,68 @@
 
 import ConfigParser
 import optparse
+import os
 import sys
 
 VERBOSE = False
 MODULE_PATHS = ["lib", "src"]
 FLAGS_BY_DEFAULT = False
+# How java targets are compiled: "ant" runs compile.xml, and "javac"
+# runs javac directly, on just the sources that need it.
+JAVA_COMPILER = "ant"
+JAVA_ENCODING = "cp1252"
+JAVA_TARGET = "1.6"
+# ANTLR generates lexers that aren't Xlint:cast clean.
+JAVAC_FLAGS = ("-Xlint -Xlint:-path -Xlint:-serial -Xlint:-unchecked "
+               "-Xlint:-deprecation -Xlint:-cast -Werror")
+# Whether the javac compiler runs javac on a long-lived compile server
+# (see compile_server.py) instead of starting a JVM for every target.
+COMPILE_SERVER = False
+# Megabytes of heap of the compile server, which is shared by the
+# compiles running on it.
+COMPILE_SERVER_MEMORY = 2048
+# Seconds without compiles after which the compile server exits.
+COMPILE_SERVER_IDLE = 3600
 PROTOBUF_JAVA = "lib=:protobuf-java-2.5.0"
+# Most .proto files that are compiled by one run of protoc. Files that
+# are ready to be compiled at the same time are batched together.
+PROTO_BATCH_SIZE = 64
 VALID_TLDS = "com org net javax"
+# Number of processes used to parse source files in genautodep. 0 means
+# one per CPU.
+AUTODEP_JOBS = 0
+# Number of files handed to an autodep worker process at a time.
+AUTODEP_BATCH = 64
+# Module path -> list of patterns that autodep should not look at.
+IGNORE = {}
+# Number of targets built at once. 0 means one per CPU.
+JOBS = 0
+# Megabytes that the JVMs spawned by targets may use between them. 0
+# means three quarters of the physical memory, and a negative value
+# means no limit.
+MEMORY_BUDGET = 0
+# Megabytes that each spawned JVM is expected to use.
+JVM_MEMORY = 1024
+# Whether to stop the build at the first failure, instead of building
+# everything that doesn't depend on it.
+FAIL_FAST = False
+# Where targets keep their outputs keyed by their inputs, so that they
+# can be restored instead of rebuilt. It can point outside of build/ so
+# that it survives a clean build, or be shared between workspaces.
+ACTION_CACHE_DIR = "build/actioncache"
+# Megabytes the action cache is trimmed down to after a build. 0
+# disables the cache.
+ACTION_CACHE_SIZE = 10240
+# URL of a remote action cache (see remote_cache.py) that is shared
+# between machines, or None. It is used through the local one, so it
+# has no effect if that is disabled.
+REMOTE_CACHE = None
+# Seconds that restoring a target from the remote cache may take before
+# the target is built locally instead.
+REMOTE_CACHE_TIMEOUT = 2.0
+# If set, the arguments are changed files rather than targets, and only
+# the targets affected by them are printed ("print") or built ("build").
+AFFECTED = None
 
 # Avoid having to declare all the variables as global in init.
 config = sys.modules[__name__]
@@ -16,8 +71,24 @@ config = sys.modules[__name__]
 def init():
     parser = optparse.OptionParser()
     parser.add_option("-v", "--verbose", action="store_true", dest="verbose")
+    parser.add_option("-j", "--jobs", type="int", dest="jobs")
+    parser.add_option("--memory-budget", type="int", dest="memory_budget")
+    parser.add_option("--fail-fast", action="store_true", dest="fail_fast",
+                      help="stop the build at the first failure")
+    parser.add_option("--keep-going", action="store_false", dest="fail_fast",
+                      help="build everything not affected by a failure")
+    parser.add_option("--remote-cache", dest="remote_cache",
+                      help="URL of the remote action cache")
+    parser.add_option("--autodep-jobs", type="int", dest="autodep_jobs")
+    parser.add_option("--affected", action="store_const", const="print",
+                      dest="affected",
+                      help="print the targets affected by the given files")
+    parser.add_option("--build-affected", action="store_const",
+                      const="build", dest="affected",
+                      help="build the targets affected by the given files")
     (options, args) = parser.parse_args()
     config.VERBOSE = options.verbose
+    config.AFFECTED = options.affected
 
     conf = ConfigParser.SafeConfigParser(allow_no_value=True)
     # Module paths (the options of the modules section) must be case sensitive.
@@ -30,8 +101,64 @@ def init():
             "java", "flags_by_default")
     if conf.has_option("java", "valid_tlds"):
         config.VALID_TLDS = conf.get("java", "valid_tlds")
+    if conf.has_option("java", "compiler"):
+        config.JAVA_COMPILER = conf.get("java", "compiler")
+    if conf.has_option("java", "encoding"):
+        config.JAVA_ENCODING = conf.get("java", "encoding")
+    if conf.has_option("java", "target"):
+        config.JAVA_TARGET = conf.get("java", "target")
+    if conf.has_option("java", "javac_flags"):
+        config.JAVAC_FLAGS = conf.get("java", "javac_flags")
+    if conf.has_option("java", "compile_server"):
+        config.COMPILE_SERVER = conf.getboolean("java", "compile_server")
+    if conf.has_option("java", "compile_server_memory"):
+        config.COMPILE_SERVER_MEMORY = conf.getint(
+            "java", "compile_server_memory")
+    if conf.has_option("java", "compile_server_idle"):
+        config.COMPILE_SERVER_IDLE = conf.getint("java", "compile_server_idle")
+    if config.JAVA_COMPILER not in ("ant", "javac"):
+        parser.error("unknown java compiler: %s" % config.JAVA_COMPILER)
     if conf.has_option("proto", "protobuf_java"):
         config.PROTOBUF_JAVA = conf.get("proto", "protobuf_java")
+    if conf.has_option("proto", "batch_size"):
+        config.PROTO_BATCH_SIZE = max(1, conf.getint("proto", "batch_size"))
+    if conf.has_option("build", "jobs"):
+        config.JOBS = conf.getint("build", "jobs")
+    if conf.has_option("build", "memory_budget"):
+        config.MEMORY_BUDGET = conf.getint("build", "memory_budget")
+    if conf.has_option("build", "jvm_memory"):
+        config.JVM_MEMORY = conf.getint("build", "jvm_memory")
+    if conf.has_option("build", "fail_fast"):
+        config.FAIL_FAST = conf.getboolean("build", "fail_fast")
+    if conf.has_option("build", "action_cache_dir"):
+        config.ACTION_CACHE_DIR = os.path.expanduser(
+            conf.get("build", "action_cache_dir"))
+    if conf.has_option("build", "action_cache_size"):
+        config.ACTION_CACHE_SIZE = conf.getint("build", "action_cache_size")
+    if conf.has_option("build", "remote_cache"):
+        config.REMOTE_CACHE = conf.get("build", "remote_cache")
+    if conf.has_option("build", "remote_cache_timeout"):
+        config.REMOTE_CACHE_TIMEOUT = conf.getfloat(
+            "build", "remote_cache_timeout")
+    if conf.has_option("autodep", "jobs"):
+        config.AUTODEP_JOBS = conf.getint("autodep", "jobs")
+    if conf.has_option("autodep", "batch"):
+        config.AUTODEP_BATCH = conf.getint("autodep", "batch")
+    if conf.has_section("ignore"):
+        config.IGNORE = dict((path, (patterns or "").split())
+                             for path, patterns in conf.items("ignore"))
+
+    # Command line options take precedence over icbm.cfg.
+    if options.jobs is not None:
+        config.JOBS = options.jobs
+    if options.memory_budget is not None:
+        config.MEMORY_BUDGET = options.memory_budget
+    if options.fail_fast is not None:
+        config.FAIL_FAST = options.fail_fast
+    if options.remote_cache is not None:
+        config.REMOTE_CACHE = options.remote_cache or None
+    if options.autodep_jobs is not None:
+        config.AUTODEP_JOBS = options.autodep_jobs
 
     return args
 
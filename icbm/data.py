@@ -5,8 +5,11 @@ import functools
 import os
 import sys
 
+import action_cache
+import compile_server
 import config
 import engine
+import remote_cache
 
 def cache(f):
     """A decorator to cache results for a given function call.
@@ -99,6 +102,13 @@ class DataHolder(object):
     # into the engine.
     _registered = {}
 
+    # path:name -> function that registers that target, and usually a
+    # few others, the first time it is asked for.
+    _lazy = {}
+
+    # Generated file -> full name of the Generate target that outputs it.
+    _generated = {}
+
     # Set of dependency FullName's whose files have already been loaded.
     _processed = set()
 
@@ -190,27 +200,99 @@ class DataHolder(object):
         """Registers a given target in the global registry."""
         fname = "%s=%s:%s" % (module, path, name)
         assert fname not in cls._registered, fname
+        assert fname not in cls._lazy, fname
         assert isinstance(obj, DataHolder)
         cls._registered[fname] = obj
+        if isinstance(obj, Generate):
+            cls.RegisterOutputs(module, path, name, obj.outs)
+
+    @classmethod
+    def RegisterOutputs(cls, module, path, name, outs):
+        """Records the files that a Generate target outputs.
+
+        Register does this by itself; it only needs to be called
+        directly for Generate targets that are registered lazily.
+        """
+        fname = "%s=%s:%s" % (module, path, name)
+        for out in outs:
+            assert cls._generated.get(out, fname) == fname, (
+                "%s is generated by both %s and %s" %
+                (out, cls._generated[out], fname))
+            cls._generated[out] = fname
+
+    @classmethod
+    def RegisterLazy(cls, module, path, names, register):
+        """Registers targets that are only created when needed.
+
+        Args:
+          module: The module of the targets
+          path: The path of the targets
+          names: The names of the targets within the path
+          register: A function that Registers all of the named targets.
+                    It is called at most once, the first time any of
+                    them is retrieved.
+        """
+        fnames = ["%s=%s:%s" % (module, path, name) for name in names]
+        called = []
+        def _Once():
+            if not called:
+                called.append(True)
+                # Register refuses names that are still lazy, so that a
+                # target defined twice fails however it is looked up.
+                for fname in fnames:
+                    if cls._lazy.get(fname) is _Once:
+                        del cls._lazy[fname]
+                register()
+        for fname in fnames:
+            assert fname not in cls._registered, fname
+            assert fname not in cls._lazy, fname
+            cls._lazy[fname] = _Once
 
     @classmethod
     def Get(cls, module, fname):
         """Retrieves a target from the global registry."""
         fname = abs_target(fname, default_module=module)
+        if fname in cls._lazy:
+            cls._lazy.pop(fname)()
         return cls._registered.get(fname)
 
     @classmethod
-    def Go(cls, targets):
+    def Exists(cls, module, fname):
+        """Returns whether a target is registered, without creating it."""
+        fname = abs_target(fname, default_module=module)
+        return fname in cls._registered or fname in cls._lazy
+
+    @classmethod
+    def Go(cls, targets, fingerprint=None):
         """Builds everything starting with the given targets as the top-level.
 
         Args:
           targets: List of string specifiers of targets resolved in top-level
                    scope
+          fingerprint: A build_fingerprint.BuildFingerprint that the
+                       files looked at by the targets are added to, if
+                       they all build successfully and incrementally
 
         Returns: True if all the targets built successfully, False otherwise
         """
         done = set()
-        e = engine.Engine()
+        actions = None
+        if config.ACTION_CACHE_SIZE > 0:
+            remote = None
+            if config.REMOTE_CACHE:
+                remote = remote_cache.RemoteCache(
+                    config.REMOTE_CACHE, config.REMOTE_CACHE_TIMEOUT)
+            actions = action_cache.ActionCache(
+                config.ACTION_CACHE_DIR, config.ACTION_CACHE_SIZE << 20,
+                remote)
+        server = None
+        if config.JAVA_COMPILER == "javac" and config.COMPILE_SERVER:
+            server = compile_server.CompileServer(
+                os.path.join(engine.BUILD_DIR, "compile_server"),
+                config.COMPILE_SERVER_MEMORY, config.COMPILE_SERVER_IDLE)
+        e = engine.Engine(config.MEMORY_BUDGET, config.JVM_MEMORY,
+                          config.FAIL_FAST, actions, server,
+                          config.PROTO_BATCH_SIZE)
         target_names = []
         for target in targets:
             holder = cls.Get(TOPLEVEL, target)
@@ -220,15 +302,24 @@ class DataHolder(object):
             ret = holder.TopApply(e)
             if ret:
                 target_names.append(ret)
-        # Make sure to apply all of the Generate targets. Otherwise
-        # their out's will never get considered.
-        for obj in cls._registered.itervalues():
-            if isinstance(obj, Generate):
-                obj.Apply(e)
-        e.ComputeDependencies()
+        # Generate targets are applied once something that is being
+        # built turns out to need their outputs.
+        def _Resolve(path):
+            name = cls._generated.get(path)
+            if name:
+                cls.Get(TOPLEVEL, name).Apply(e)
+        e.ComputeDependencies(_Resolve)
+        if not e.VerifyGraph([e.GetTarget(t) for t in target_names]):
+            return False
         for target in target_names:
             e.BuildTarget(e.GetTarget(target))
-        return e.Go()
+        if not e.Go(config.JOBS):
+            return False
+        if fingerprint and all(t.incremental for t in e.build_order):
+            for path, s in e.stat_cache.Snapshot():
+                fingerprint.Add(path, s)
+            fingerprint.Save()
+        return True
 
 class JavaBinary(DataHolder):
 
@@ -245,31 +336,15 @@ class JavaBinary(DataHolder):
     def Apply(self, e):
         # Build up a list of source files, jars, and data files that
         # we need to get.
-        sources = set()
-        jars = self.jars = set()
-        datas = set()
-
-        deps = list(self.deps)
-        processed = set()
-        while len(deps) > 0:
-            depname = deps.pop()
+        libs = []
+        for depname in self.deps:
             dep = DataHolder.Get(self.module, depname)
             assert dep, "%s not found" % depname
-            if dep.FullName() in processed:
-                continue
             assert isinstance(dep, JavaLibrary), '%s is not a library' % depname
-
-            dep.Apply(e)
-
-            if dep.files:
-                sources.update(dep.files)
-            if dep.jars:
-                jars.update(dep.jars)
-            if dep.data:
-                datas.update(dep.data)
-            if dep.deps:
-                deps.extend(dep.Canonicalize(dep.deps))
-            processed.add(dep.FullName())
+            libs.append(dep)
+        bits = _UnionBits(libs)
+        sources, jars, datas = _ExpandClosure(bits)
+        self.jars = jars
 
         if self.flags:
             dep = DataHolder.Get(
@@ -277,7 +352,8 @@ class JavaBinary(DataHolder):
             dep.Apply(e)
 
         c = engine.JavaCompile(self.path, self.name, sources, jars,
-                               datas, self.main, self.flags)
+                               datas, self.main, self.flags, _JavacOptions(),
+                               functools.partial(_SourceDependencies, bits))
         e.AddTarget(c)
         return c.Name()
 
@@ -331,45 +407,176 @@ class JavaLibrary(DataHolder):
 
     @cache
     def TopApply(self, e):
-        sources = set(self.files)
-        jars = self.jars = set(self.jars)
-        datas = set(self.data)
-
-        deps = list(self.deps)
-        processed = set()
-        while len(deps) > 0:
-            depname = deps.pop()
-            dep = DataHolder.Get(self.module, depname)
-            assert dep, "%s not found" % depname
-            if dep.FullName() in processed:
-                continue
-            assert isinstance(dep, JavaLibrary)
-
-            dep.Apply(e)
-
-            if dep.files:
-                sources.update(dep.files)
-            if dep.jars:
-                jars.update(dep.jars)
-            if dep.data:
-                datas.update(dep.data)
-            if dep.deps:
-                deps.extend(dep.Canonicalize(dep.deps))
-            processed.add(dep.FullName())
+        sources, jars, datas = self.Closure()
 
         c = engine.JavaCompile(self.path, os.path.join(self.path, self.name),
                                sources, jars,
-                               datas, "", False)
+                               datas, "", False, _JavacOptions(),
+                               functools.partial(_SourceDependencies,
+                                                 self.ClosureBits()))
         e.AddTarget(c)
         return c.Name()
 
     def Apply(self, e):
         pass
 
+    def Closure(self):
+        """Returns the files, jars and data of this library and everything
+        it depends on, as a tuple of frozensets.
+
+        See _ComputeClosures. Libraries (and binaries) whose closures
+        contain the same libraries share the same frozensets.
+        """
+        return _ExpandClosure(self.ClosureBits())
+
+    def ClosureBits(self):
+        """Returns the libraries in the closure of this one, as a bitmask
+        of their _library_ids."""
+        if not hasattr(self, "_closure_bits"):
+            _ComputeClosures(self)
+        return self._closure_bits
+
     def LoadSpecs(self):
         if self.deps:
             self._LoadSpecs(self.deps)
 
+# Every library that has been part of a closure, indexed by its
+# _library_id.
+_libraries = []
+
+# Closure bitmask -> (files, jars, data) frozensets.
+_expanded = {}
+
+def _LibraryDeps(lib):
+    """Returns the JavaLibrary objects that lib depends on directly."""
+    if not hasattr(lib, "_dep_libs"):
+        libs = []
+        for depname in lib.Canonicalize(lib.deps or []):
+            dep = DataHolder.Get(lib.module, depname)
+            assert dep, "%s not found" % depname
+            assert isinstance(dep, JavaLibrary), '%s is not a library' % depname
+            libs.append(dep)
+        lib._dep_libs = libs
+    return lib._dep_libs
+
+def _LibraryId(lib):
+    if not hasattr(lib, "_library_id"):
+        lib._library_id = len(_libraries)
+        _libraries.append(lib)
+    return lib._library_id
+
+def _ComputeClosures(root):
+    """Sets _closure_bits on root and on every library reachable from it.
+
+    A closure is kept as a bitmask over _libraries rather than as sets
+    of files, so that computing it for every library is cheap, and the
+    closures of the libraries below are reused by everything above
+    them. Libraries can depend on each other in cycles, so this finds
+    the strongly connected components with (an iterative version of)
+    Tarjan's algorithm; every library in a component has the same
+    closure, which is computed once all the components it depends on
+    are done.
+    """
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    work = [(root, iter(_LibraryDeps(root)))]
+    index[root] = lowlink[root] = 0
+    stack.append(root)
+    on_stack.add(root)
+    while work:
+        lib, deps = work[-1]
+        for dep in deps:
+            if hasattr(dep, "_closure_bits"):
+                continue
+            if dep not in index:
+                index[dep] = lowlink[dep] = len(index)
+                stack.append(dep)
+                on_stack.add(dep)
+                work.append((dep, iter(_LibraryDeps(dep))))
+                break
+            if dep in on_stack:
+                lowlink[lib] = min(lowlink[lib], index[dep])
+        else:
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[lib])
+            if lowlink[lib] != index[lib]:
+                continue
+            component = []
+            while True:
+                member = stack.pop()
+                on_stack.discard(member)
+                component.append(member)
+                if member is lib:
+                    break
+            bits = 0
+            for member in component:
+                bits |= 1 << _LibraryId(member)
+            for member in component:
+                for dep in _LibraryDeps(member):
+                    if hasattr(dep, "_closure_bits"):
+                        bits |= dep._closure_bits
+            for member in component:
+                member._closure_bits = bits
+
+def _Libraries(bits):
+    """Yields the libraries in bits."""
+    # Walk the set bits from the least significant one up.
+    digits = bin(bits)[:1:-1]
+    i = digits.find("1")
+    while i >= 0:
+        yield _libraries[i]
+        i = digits.find("1", i + 1)
+
+def _ExpandClosure(bits):
+    """Returns the (files, jars, data) frozensets of the libraries in bits."""
+    if bits not in _expanded:
+        sources, jars, datas = set(), set(), set()
+        for lib in _Libraries(bits):
+            sources.update(lib.files or ())
+            jars.update(lib.jars or ())
+            datas.update(lib.data or ())
+        _expanded[bits] = (frozenset(sources), frozenset(jars),
+                           frozenset(datas))
+    return _expanded[bits]
+
+def _UnionBits(libs):
+    """Returns the closure bitmask of libs and everything they depend on."""
+    bits = 0
+    for lib in libs:
+        bits |= lib.ClosureBits()
+    return bits
+
+def _SourceDependencies(bits):
+    """Returns which sources of the libraries in bits use which others.
+
+    This is only as precise as the libraries: every source depends on
+    the sources of its own library and of the libraries that it depends
+    on directly. Autodep gives most sources a library of their own.
+
+    Returns: A dict from each fake source path to the set of the fake
+    paths that it depends on.
+    """
+    deps = {}
+    for lib in _Libraries(bits):
+        files = [fake for fake, _ in lib.files or ()]
+        if not files:
+            continue
+        below = set(files)
+        for dep in _LibraryDeps(lib):
+            below.update(fake for fake, _ in dep.files or ())
+        for fake in files:
+            deps.setdefault(fake, set()).update(below)
+    return deps
+
+def _JavacOptions():
+    return engine.JavacOptions(config.JAVA_COMPILER, config.JAVA_ENCODING,
+                               config.JAVA_TARGET,
+                               tuple(config.JAVAC_FLAGS.split()))
+
 class JavaWar(DataHolder):
 
     """Class that holds a java_war target."""
@@ -430,13 +637,16 @@ class Generate(DataHolder):
 
     """Class that holds a generate target."""
 
-    def __init__(self, module, path, name, compiler, args, ins, outs):
+    def __init__(self, module, path, name, compiler, args, ins, outs,
+                 worker=None, batch=False):
         DataHolder.__init__(self, module, path, name)
         self.compiler = compiler
         self.args = args
         self.ins = ins
         self.outs = outs
         self.deps = []
+        self.worker = worker
+        self.batch = batch
 
     @cache
     def Apply(self, e):
@@ -448,7 +658,8 @@ class Generate(DataHolder):
             deps.append(dep.Apply(e))
 
         target = engine.Generate(self.path, self.name, self.compiler, self.args,
-                                 self.ins, self.outs, deps)
+                                 self.ins, self.outs, deps, self.worker,
+                                 self.batch)
         e.AddTarget(target)
         return target.Name()
 
@@ -586,12 +797,15 @@ def play_app(module, dpath, name, modules, deps=None, path=None, data=None, play
     if data:
         obj.data.extend(FixPath(module, dpath, data))
 
-def generate(module, dpath, name, compiler=None, args=None, ins=None, outs=None, path=None, deps=None):
+def generate(module, dpath, name, compiler=None, args=None, ins=None, outs=None, path=None, deps=None, worker=None):
     if path:
         dpath = path
+    if isinstance(worker, basestring):
+        worker = worker.split()
     obj = Generate(module, dpath, name, compiler, args,
                    list(FixPath(module, dpath, ins)),
-                   map(lambda x: x[0], FixPath(module, dpath, outs)))
+                   map(lambda x: x[0], FixPath(module, dpath, outs)),
+                   worker)
     DataHolder.Register(module, dpath, name, obj)
     if deps:
         obj.deps.extend(deps)
@@ -601,6 +815,8 @@ def alias(module, path, name, deps):
     DataHolder.Register(module, path, name, obj)
 
 loaded = set()
+# Every spec file that was looked for, whether it exists or not
+spec_files = set()
 
 def LoadTargetSpec(module, target):
     """Loads the spec file that should contain the target in question.
@@ -623,6 +839,7 @@ def LoadTargetSpec(module, target):
     else:
         base = "."
         fn = os.path.join(module, base, dirname, "build.spec")
+    spec_files.add(fn)
     if fn in loaded:
         return
     elif not os.path.exists(fn):
@@ -1,20 +1,30 @@
 #!/usr/bin/python
 
+import collections
 import commands
+import contextlib
 import glob
 import itertools
+import marshal
+import multiprocessing
 import Queue
 import os
 import os.path
 import shutil
 import subprocess
 import sys
+import tempfile
 import threading
 import time
 import traceback
 import zipfile
+from xml.sax import saxutils
 
+import action_cache
+import build_history
 import class_cache
+import generate_worker
+import stat_cache
 import symlink
 
 BUILD_DIR = "build"
@@ -25,60 +35,379 @@ class BuildError(Exception):
     def __init__(self, target):
         Exception.__init__(self, "Error building %s" % target.Name())
 
-class Engine(object):
+class BuildCancelled(Exception):
 
     def __init__(self):
+        Exception.__init__(self, "Build cancelled")
+
+_tool_fingerprints = {}
+
+def ToolFingerprint(*names):
+    """Identifies the installed versions of the given tools.
+
+    Rather than running them to ask, this looks at which files they
+    resolve to on the PATH, and at the environment variables that
+    select a JDK or ant installation.
+    """
+    if names not in _tool_fingerprints:
+        fingerprint = [os.environ.get(v) for v in ("JAVA_HOME", "ANT_HOME")]
+        for name in names:
+            for d in os.environ.get("PATH", "").split(os.pathsep):
+                path = os.path.join(d, name)
+                if os.path.isfile(path) and os.access(path, os.X_OK):
+                    real = os.path.realpath(path)
+                    s = os.stat(real)
+                    fingerprint.append((name, real, s.st_size, s.st_mtime))
+                    break
+        _tool_fingerprints[names] = fingerprint
+    return _tool_fingerprints[names]
+
+def WriteIfChanged(filename, text):
+    """Writes text to filename, unless it already holds exactly that.
+
+    Leaving the file alone keeps its mtime, so that whatever goes by it
+    doesn't consider it changed.
+    """
+    if os.path.exists(filename):
+        with open(filename) as f:
+            if f.read() == text:
+                return
+    with open(filename, "w") as f:
+        f.write(text)
+
+def SyncSymlinks(prefix, roots, links, store):
+    """Makes trees of symlinks match links, changing only what differs.
+
+    The links that were made last time are kept in store, and are
+    taken to still be in place. Links that are no longer wanted are
+    removed, along with the directories they leave empty, and the new
+    or changed ones are made. Without a store, e.g. on the first build,
+    the roots are cleared and everything is made from scratch.
+
+    Args:
+      prefix: The directory the links are made relative to
+      roots: The directories relative to prefix that hold nothing but
+             the links; they exist afterwards, even if empty
+      links: dict of path relative to prefix -> what the link points to
+      store: The file that the links are kept in between builds
+    """
+    old = None
+    if all(os.path.isdir(os.path.join(prefix, root)) for root in roots):
+        try:
+            with open(store, "rb") as f:
+                old = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            pass
+    if not isinstance(old, dict):
+        old = {}
+        for root in roots:
+            root = os.path.join(prefix, root)
+            if os.path.lexists(root):
+                if os.path.isdir(root) and not os.path.islink(root):
+                    shutil.rmtree(root)
+                else:
+                    os.unlink(root)
+            os.makedirs(root)
+    else:
+        os.unlink(store)
+
+    for path in old:
+        if path not in links:
+            dest = os.path.join(prefix, path)
+            try:
+                os.unlink(dest)
+            except OSError:
+                continue
+            # Prune the directories that are empty now.
+            dirname = os.path.dirname(path)
+            while dirname not in roots:
+                try:
+                    os.rmdir(os.path.join(prefix, dirname))
+                except OSError:
+                    break
+                dirname = os.path.dirname(dirname)
+
+    made_dirs = set()
+    for path, real in links.iteritems():
+        if old.get(path) == real:
+            continue
+        dest = os.path.join(prefix, path)
+        dirname = os.path.dirname(dest)
+        if dirname not in made_dirs:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            made_dirs.add(dirname)
+        if os.path.lexists(dest):
+            os.unlink(dest)
+        symlink.symlink(real, dest)
+
+    with open(store, "wb") as f:
+        marshal.dump(links, f)
+
+class MemoryBudget(object):
+
+    """Limits the memory used by the processes that targets spawn.
+
+    Targets reserve memory around the expensive processes they run
+    (JVMs, mostly), and wait while the budget is used up. A process
+    that needs more than the whole budget runs once nothing else holds
+    any of it.
+    """
+
+    def __init__(self, budget):
+        """Constructor.
+
+        Args:
+          budget: Megabytes available. 0 means three quarters of the
+                  physical memory, and a negative value means no limit.
+        """
+        if budget == 0:
+            try:
+                budget = (os.sysconf("SC_PAGE_SIZE") *
+                          os.sysconf("SC_PHYS_PAGES") / (1 << 20)) * 3 / 4
+            except (ValueError, OSError):
+                budget = -1
+        self.budget = budget
+        self.available = budget
+        self.cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def Reserve(self, amount):
+        """Holds amount megabytes of the budget for the with block."""
+        if self.budget < 0:
+            yield
+            return
+        amount = min(amount, self.budget)
+        with self.cond:
+            while self.available < amount:
+                self.cond.wait()
+            self.available -= amount
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.available += amount
+                self.cond.notify_all()
+
+class Engine(object):
+
+    def __init__(self, memory_budget=-1, jvm_memory=0, fail_fast=False,
+                 action_cache=None, compile_server=None, batch_size=1):
+        """Constructor.
+
+        Args:
+          memory_budget: See MemoryBudget
+          jvm_memory: Megabytes each spawned JVM is expected to use
+          fail_fast: Whether to stop the whole build at the first
+                     failure, rather than only skipping what depends
+                     on it
+          action_cache: An action_cache.ActionCache that targets keep
+                        their outputs in, or None
+          compile_server: A compile_server.CompileServer that the javac
+                          backend runs javac on, or None to spawn it
+          batch_size: Most targets of the same BatchKey that are run
+                      together
+        """
         # target name -> target
         self.targets = {}
+        # Targets whose dependencies haven't been computed yet
+        self.new_targets = []
 
         # target -> set(filename)
         self.target_deps = {}
         # filename -> target
         self.target_provides = {}
 
-        self.ready_queue = Queue.Queue()
-
+        # Ready targets, the ones with the longest path of work
+        # depending on them first. See Prioritize.
+        self.ready_queue = Queue.PriorityQueue()
+        self.history = build_history.BuildHistory(
+            os.path.join(BUILD_DIR, "durations"))
+        # target -> estimated seconds from its start to the end of the build
+        self.priority = {}
+        # Breaks ties between targets of the same priority, first come
+        # first served.
+        self.sequence = itertools.count()
+        # target -> (start, end) time of its run
+        self.times = {}
+
+        # Guards done, waitors, pending and success once the workers
+        # are running.
         self.waitor_lock = threading.Lock()
         self.done = set()
-        self.waitors = []
+        # Targets that are waiting for some of their dependencies
+        self.waitors = set()
+        # target -> number of targets it is still waiting for
+        self.pending = {}
+        # target -> targets that depend on it
+        self.dependents = {}
+        # target -> targets it depends on
+        self.dependencies = {}
+        # Targets to build, each one after all of its dependencies
+        self.build_order = []
         self.build_visited = set()
         self.success = True
+        # Targets that failed to build
+        self.failed = []
+        # target -> the failed target that it can't be built without
+        self.skipped = {}
+
+        self.fail_fast = fail_fast
+        self.batch_size = batch_size
+        # BatchKey -> ready targets of it that no worker took yet
+        self.batchable = {}
+        # Targets in the ready queue that were already run as part of
+        # another target's batch
+        self.batched = set()
+        # Set once a failure stops the build. Guarded by process_lock.
+        self.cancelled = False
+        self.process_lock = threading.Lock()
+        # Processes started by targets that may still be running
+        self.processes = set()
+
+        self.stat_cache = stat_cache.StatCache([BUILD_DIR])
         self.class_cache = class_cache.ClassCache(
             os.path.join(BUILD_DIR, "classcache"))
+        self.memory = MemoryBudget(memory_budget)
+        self.jvm_memory = jvm_memory
+        self.action_cache = action_cache
+        self.compile_server = compile_server
+        self.workers = generate_worker.WorkerPool(
+            os.path.join(BUILD_DIR, "generate_worker"), jvm_memory)
+
+    def SpawningJVM(self):
+        """Returns a context to run a JVM in, within the memory budget.
+
+        Only the process itself should run within it, not any up to
+        date checks around it.
+        """
+        return self.memory.Reserve(self.jvm_memory)
+
+    def Popen(self, *args, **kwargs):
+        """Starts a subprocess.Popen that is terminated if the build is
+        cancelled."""
+        with self.process_lock:
+            if self.cancelled:
+                raise BuildCancelled()
+            self.processes = set(
+                p for p in self.processes if p.poll() is None)
+            p = subprocess.Popen(*args, **kwargs)
+            self.processes.add(p)
+        return p
+
+    def Cancel(self):
+        """Stops the build: nothing new is started, and the processes
+        that are running are terminated."""
+        with self.process_lock:
+            self.cancelled = True
+            for p in self.processes:
+                if p.poll() is None:
+                    try:
+                        p.terminate()
+                    except OSError:
+                        pass
+            self.processes = set()
 
     def Worker(self):
         while True:
             try:
-                item = self.ready_queue.get()
+                _, _, item = self.ready_queue.get()
             except:
                 return
+            if self.cancelled:
+                self.ready_queue.task_done()
+                continue
             with self.waitor_lock:
-                print "building", item.Name(), time.time()
+                if item in self.batched:
+                    # It ran along with another target of its batch.
+                    self.batched.remove(item)
+                    self.ready_queue.task_done()
+                    continue
+                batch = self.TakeBatch(item)
+                start = time.time()
+                print "building", ", ".join(t.Name() for t in batch), start
             try:
-                item.Setup(self)
-                if not item.Run(self):
-                    raise BuildError(item)
-                self.done.add(item)
+                for target in batch:
+                    target.Setup(self)
+                # A target that can be batched always runs through
+                # RunBatch, even on its own, so that it is run the same
+                # way whatever else is ready.
+                if item.BatchKey() is None:
+                    if not item.Run(self):
+                        raise BuildError(item)
+                    results = {item: True}
+                else:
+                    results = item.RunBatch(self, batch)
             except Exception:
-                traceback.print_exc()
-                self.success = False
+                if not self.cancelled:
+                    traceback.print_exc()
+                results = {}
 
             with self.waitor_lock:
-                self.EvalWaitors()
+                end = time.time()
+                for target in batch:
+                    if results.get(target):
+                        self.times[target] = (start, end)
+                        self.history.Record(
+                            target.Name(), target.__class__.__name__,
+                            (end - start) / len(batch))
+                        self.done.add(target)
+                        self.EvalWaitors(target)
+                    elif not self.cancelled:
+                        self.success = False
+                        self.failed.append(target)
+                        if self.fail_fast:
+                            self.Cancel()
+                        else:
+                            self.SkipDependents(target)
 
             self.ready_queue.task_done()
 
-    def EvalWaitors(self):
-        todel = []
-        for waitor in self.waitors:
-            deps = set()
-            for f in self.target_deps[waitor]:
-                deps.add(self.target_provides[f])
-            if not (deps - self.done):
-                todel.append(waitor)
-        for waitor in todel:
-            self.waitors.remove(waitor)
-            self.ready_queue.put(waitor)
+    def TakeBatch(self, target):
+        """Returns target and the ready targets to run along with it.
+
+        Must be called with waitor_lock held.
+        """
+        key = target.BatchKey()
+        if key is None:
+            return [target]
+        ready = self.batchable[key]
+        ready.remove(target)
+        others = ready[:self.batch_size - 1]
+        del ready[:len(others)]
+        self.batched.update(others)
+        return [target] + others
+
+    def SkipDependents(self, target):
+        """Gives up on everything that depends on a failed target.
+
+        Must be called with waitor_lock held.
+        """
+        todo = [target]
+        while todo:
+            for waitor in self.dependents.get(todo.pop(), ()):
+                if waitor in self.waitors:
+                    self.waitors.remove(waitor)
+                    self.skipped[waitor] = target
+                    todo.append(waitor)
+
+    def EvalWaitors(self, target):
+        """Queues the waitors that were only waiting for target.
+
+        Must be called with waitor_lock held.
+        """
+        for waitor in self.dependents.get(target, ()):
+            self.pending[waitor] -= 1
+            if not self.pending[waitor]:
+                self.waitors.remove(waitor)
+                self.Ready(waitor)
+
+    def Ready(self, target):
+        key = target.BatchKey()
+        if key is not None:
+            self.batchable.setdefault(key, []).append(target)
+        self.ready_queue.put(
+            (-self.priority[target], next(self.sequence), target))
 
     def Depend(self, target, f):
         #print "----- Requiring", target, f
@@ -92,10 +421,27 @@ class Engine(object):
     def AddTarget(self, target):
         assert target.Name() not in self.targets, "duplicate target: %s" % target.Name()
         self.targets[target.Name()] = target
+        self.new_targets.append(target)
 
-    def ComputeDependencies(self):
-        for target in self.targets.itervalues():
-            target.AddDependencies(self)
+    def ComputeDependencies(self, resolve=None):
+        """Has all the targets declare what they depend on and provide.
+
+        Args:
+          resolve: Optional function that is called with every file that
+                   is depended on but not provided by any target. It
+                   may add the targets that provide the file, whose
+                   dependencies are then computed in turn.
+        """
+        while self.new_targets:
+            targets = self.new_targets
+            self.new_targets = []
+            for target in targets:
+                target.AddDependencies(self)
+            if resolve:
+                for target in targets:
+                    for f in self.target_deps.get(target, ()):
+                        if f not in self.target_provides:
+                            resolve(f)
 
     def GetTarget(self, target):
         return self.targets.get(target)
@@ -106,20 +452,91 @@ class Engine(object):
         assert path in self.target_provides, "path not provided: %s" % path
         return os.path.abspath(self.target_provides[path].GetOutput(path))
 
+    def _Dependencies(self, target):
+        """Returns the set of targets that target depends on."""
+        deps = set()
+        for f in self.target_deps.get(target, []):
+            assert f in self.target_provides, "No target provides %s" % f
+            deps.add(self.target_provides[f])
+        return deps
+
     def BuildTarget(self, target):
+        """Schedules target, and everything it depends on, to be built.
+
+        The graph must not have cycles; see VerifyGraph.
+        """
         if target in self.build_visited:
             return
-        deps = self.target_deps.get(target, [])
-        for f in deps:
-            assert f in self.target_provides, "No target provides %s" % f
-            self.BuildTarget(self.target_provides[f])
-        if not deps:
-            self.ready_queue.put(target)
-        else:
-            self.waitors.append(target)
-        self.build_visited.add(target)
+        # Depth-first, without recursing, since the graph can be deep.
+        self.dependencies[target] = self._Dependencies(target)
+        work = [(target, iter(self.dependencies[target]))]
+        while work:
+            current, deps = work[-1]
+            for dep in deps:
+                if dep not in self.build_visited:
+                    assert dep not in self.dependencies, (
+                        "Dependency cycle through %s" % dep.Name())
+                    self.dependencies[dep] = self._Dependencies(dep)
+                    work.append((dep, iter(self.dependencies[dep])))
+                    break
+            else:
+                work.pop()
+                deps = self.dependencies[current]
+                for dep in deps:
+                    self.dependents.setdefault(dep, []).append(current)
+                self.pending[current] = len(deps)
+                if deps:
+                    self.waitors.add(current)
+                self.build_order.append(current)
+                self.build_visited.add(current)
+
+    def Prioritize(self):
+        """Estimates how long the build takes from each target's start.
+
+        That is the target's own expected run time plus that of the
+        longest chain of targets depending on it. Starting the targets
+        with the longest such chains first keeps the critical path
+        from being held up.
+        """
+        for target in reversed(self.build_order):
+            self.priority[target] = self.history.Estimate(
+                target.Name(), target.__class__.__name__) + max(
+                [self.priority[d] for d in self.dependents.get(target, ())]
+                or [0])
+
+    def CriticalPath(self):
+        """Returns the chain of built targets that ended the build last.
+
+        Starting from the target that finished last, this follows the
+        dependency that finished last, which is the one that held the
+        target up.
+        """
+        path = []
+        candidates = self.times.keys()
+        while candidates:
+            target = max(candidates, key=lambda t: self.times[t][1])
+            path.append(target)
+            candidates = [d for d in self.dependencies.get(target, ())
+                          if d in self.times]
+        path.reverse()
+        return path
+
+    def Go(self, workers=0):
+        """Builds the targets passed to BuildTarget.
+
+        Args:
+          workers: Number of targets to build at once. 0 means one per
+                   CPU.
+
+        Returns: True if all the targets built successfully.
+        """
+        if workers <= 0:
+            workers = multiprocessing.cpu_count()
+        self.Prioritize()
+        for target in self.build_order:
+            if not self.pending[target]:
+                self.Ready(target)
 
-    def Go(self, workers=4):
         # Start up workers
         for i in xrange(workers):
             t = threading.Thread(target=self.Worker)
@@ -127,24 +544,173 @@ class Engine(object):
             t.start()
 
         self.ready_queue.join()
-
-        if self.waitors:
+        self.workers.Shutdown()
+
+        if self.failed:
+            print "Failed:", ", ".join(t.Name() for t in self.failed)
+        if self.skipped:
+            print "Skipped because of failed dependencies:"
+            for target in sorted(self.skipped, key=lambda t: t.Name()):
+                print "  %s (needs %s)" % (
+                    target.Name(), self.skipped[target].Name())
+        if self.cancelled:
+            print "Build stopped after the first failure (--fail-fast)."
+        elif self.waitors:
             print "Following targets not built:", map(
                 lambda x: x.name, self.waitors)
 
+        path = self.CriticalPath()
+        if path:
+            print "Critical path: %.1f seconds" % (
+                self.times[path[-1]][1] - self.times[path[0]][0])
+            for target in path:
+                start, end = self.times[target]
+                print "  %6.1fs %s" % (end - start, target.Name())
+
+        try:
+            self.history.Save()
+        except (IOError, OSError):
+            pass
+
+        if self.action_cache:
+            self.action_cache.Flush()
+            print self.action_cache.Report()
+            try:
+                self.action_cache.Evict()
+            except (IOError, OSError):
+                traceback.print_exc()
+
         return self.success
 
 
-    def VerifyGraph(self, target, current=None, seen=None):
-        # Make sure that there aren't any cyclical dependencies. Does
-        # a DFS, keeping track of the current path so far to make sure
-        # that there are no cycles, as well as a list of nodes that
-        # have been verified as "good" and don't need to be recursed
-        # down.
-        return True
+    def VerifyGraph(self, targets):
+        """Checks that the given targets can be built.
+
+        Everything they depend on must be provided by some target, and
+        there must be no dependency cycles. This finds the strongly
+        connected components of the graph with (an iterative version
+        of) Tarjan's algorithm, so it takes linear time.
+
+        Args:
+          targets: The targets that are going to be built
+
+        Returns: True if the graph is fine. Otherwise, the problems are
+        printed and False is returned.
+        """
+        target_deps = self.target_deps
+        target_provides = self.target_provides
+        # target -> targets it depends on
+        edges = {}
+        missing = []
+        def _Edges(target):
+            deps = edges.get(target)
+            if deps is None:
+                deps = edges[target] = []
+                for f in target_deps.get(target, ()):
+                    dep = target_provides.get(f)
+                    if dep is None:
+                        missing.append((target, f))
+                    else:
+                        deps.append(dep)
+            return deps
+
+        index = {}
+        lowlink = {}
+        stack = []
+        on_stack = set()
+        cycles = []
+        for root in targets:
+            if root in index:
+                continue
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(_Edges(root)))]
+            while work:
+                target, deps = work[-1]
+                for dep in deps:
+                    if dep not in index:
+                        index[dep] = lowlink[dep] = len(index)
+                        stack.append(dep)
+                        on_stack.add(dep)
+                        work.append((dep, iter(_Edges(dep))))
+                        break
+                    if dep in on_stack and index[dep] < lowlink[target]:
+                        lowlink[target] = index[dep]
+                else:
+                    work.pop()
+                    low = lowlink[target]
+                    if work:
+                        parent = work[-1][0]
+                        if low < lowlink[parent]:
+                            lowlink[parent] = low
+                    if low != index[target]:
+                        continue
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    if member is target:
+                        if target in edges[target]:
+                            cycles.append(self._FindCycle(
+                                target, set([target])))
+                        continue
+                    component = set([member])
+                    while member is not target:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.add(member)
+                    cycles.append(self._FindCycle(target, component))
+
+        for target, f in missing:
+            print >>sys.stderr, "%s depends on %s, which no target provides" % (
+                target.Name(), f)
+        for cycle in cycles:
+            print >>sys.stderr, "Dependency cycle:"
+            for target, f in cycle:
+                print >>sys.stderr, "  %s needs %s, from" % (target.Name(), f)
+            print >>sys.stderr, "  %s" % cycle[0][0].Name()
+        return not missing and not cycles
+
+    def _FindCycle(self, start, component):
+        """Finds a shortest cycle from start back to itself.
+
+        Args:
+          start: A target in the component
+          component: A strongly connected set of targets
+
+        Returns: A list of (target, file) tuples, each target needing
+        the file from the next one, and the last one from start.
+        """
+        # target -> (previous target, file)
+        previous = {}
+        queue = collections.deque([start])
+        while queue:
+            target = queue.popleft()
+            for f in sorted(self.target_deps.get(target, ())):
+                dep = self.target_provides.get(f)
+                if dep not in component or dep in previous:
+                    continue
+                previous[dep] = (target, f)
+                if dep is start:
+                    queue.clear()
+                    break
+                queue.append(dep)
+        cycle = []
+        target = start
+        while True:
+            target, f = previous[target]
+            cycle.append((target, f))
+            if target is start:
+                break
+        cycle.reverse()
+        return cycle
 
 class Target(object):
 
+    # Whether Run does nothing when none of the files that the target
+    # looked at last time changed. Builds with targets that always do
+    # some work can't be skipped as a whole.
+    incremental = True
+
     def __init__(self, path, name):
         self.path = path
         self.name = name
@@ -164,43 +730,61 @@ class Target(object):
     def GetOutput(self, path):
         raise NotImplementedError
 
+    def BatchKey(self):
+        """Returns what the targets that can run together with this one
+        have in common, or None if it runs on its own. See RunBatch."""
+        return None
+
     @staticmethod
-    def NewerChanges(paths, timestamp):
+    def RunBatch(engine, targets):
+        """Runs targets of the same BatchKey together, after their Setup.
+
+        Returns: dict of target -> whether it built successfully
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def InputsChanged(engine, store, inputs, outputs, depstr=""):
         """Computes whether the task needs to do any changes
 
-        Iterates through all the paths and recursively finds the
-        newest file. If it was modified after the timestamp, then
-        there are changes that need to be addressed by the target.
+        Compares the size, mtime and inode of every input and output
+        file, along with depstr, against what RecordInputs stored after
+        the last successful run. Any difference, including a file that
+        was added, removed or replaced by an older one, means that the
+        target has to run.
 
         Args:
-          paths: An array of paths. Directories are walked recursively.
+          engine: The engine, whose stat cache is used
+          store: The file the manifest is kept in
+          inputs: The files the target reads. Directories are not
+                  walked; the files need to be listed.
+          outputs: The files the target writes
+          depstr: Anything else that the outputs depend on
 
         Returns True if the target needs to perform work.
         """
-        if not os.path.exists(timestamp):
+        try:
+            f = open(store, "rb")
+        except IOError:
             return True
+        with f:
+            try:
+                stored = marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                return True
+        return stored != Target._Manifest(engine, inputs, outputs, depstr)
 
-        newest = [0]
-        def _Update(path):
-            s = os.stat(path)
-            if s.st_mtime > newest[0]:
-                newest[0] = s.st_mtime
-
-        def _Visit(arg, dirname, names):
-            for name in names:
-                path = os.path.join(dirname, name)
-                if not os.path.isfile(path):
-                    continue
-                if os.path.samefile(path, timestamp):
-                    continue
-                _Update(path)
+    @staticmethod
+    def RecordInputs(engine, store, inputs, outputs, depstr=""):
+        """Stores the manifest checked by InputsChanged, after a run."""
+        f = open(store, "wb")
+        with f:
+            marshal.dump(Target._Manifest(engine, inputs, outputs, depstr), f)
 
-        for path in paths:
-            if os.path.isdir(path):
-                os.path.walk(path, _Visit, newest)
-            else:
-                _Update(path)
-        return newest[0] > os.stat(timestamp).st_mtime
+    @staticmethod
+    def _Manifest(engine, inputs, outputs, depstr):
+        return (depstr, engine.stat_cache.Signature(inputs),
+                engine.stat_cache.Signature(outputs))
 
     @staticmethod
     def DependenciesChanged(depstr, store):
@@ -212,15 +796,43 @@ class Target(object):
         return stored != depstr
 
 
+# How JavaCompile targets compile their sources.
+#
+#   backend: "ant" to run compile.xml, or "javac" to run javac directly
+#            on the sources that need to be compiled
+#   encoding: The encoding of the sources
+#   target: The class file version to generate
+#   flags: Other javac flags
+JavacOptions = collections.namedtuple(
+    "JavacOptions", ["backend", "encoding", "target", "flags"])
+
+_DEFAULT_JAVAC_OPTIONS = JavacOptions(
+    "ant", "cp1252", "1.6",
+    ("-Xlint", "-Xlint:-path", "-Xlint:-serial", "-Xlint:-unchecked",
+     "-Xlint:-deprecation", "-Xlint:-cast", "-Werror"))
+
 class JavaCompile(Target):
 
-    def __init__(self, path, name, sources, jars, data, main, flags):
+    def __init__(self, path, name, sources, jars, data, main, flags,
+                 javac=_DEFAULT_JAVAC_OPTIONS, source_deps=None):
+        """Constructor.
+
+        Args:
+          javac: JavacOptions
+          source_deps: A function that returns a dict from every fake
+                       source path to the fake paths it depends on. It
+                       is used by the javac backend to find what else
+                       to compile when some sources changed; without
+                       it, everything is compiled.
+        """
         Target.__init__(self, path, name)
         self.sources = dict(sources)
         self.jars = dict(jars)
         self.data = dict(data)
         self.main = main
         self.flags = flags
+        self.javac = javac
+        self.source_deps = source_deps
 
     def AddDependencies(self, engine):
         if self.flags:
@@ -239,34 +851,23 @@ class JavaCompile(Target):
         if not os.path.exists(prefix):
             os.makedirs(prefix)
 
-        # Link in the compile.xml which will tell ant to build things
-        compile_xml = os.path.join(prefix, "compile.xml")
-        if not os.path.exists(compile_xml):
-            symlink.symlink(
-                os.path.join(ICBM_PATH, "compile.xml"),
-                compile_xml)
-
-        # Set up the src/ directory, by symlinking in all the
-        # depending source files.
-        srcprefix = self.srcprefix = os.path.join(prefix, "src")
-        if os.path.exists(srcprefix):
-            shutil.rmtree(srcprefix)
-        os.makedirs(srcprefix)
-        for source, filename in self.sources.iteritems():
-            path = os.path.join(srcprefix, os.path.dirname(source))
-            if not os.path.exists(path):
-                os.makedirs(path)
-            dest = os.path.join(path, os.path.basename(source))
-            symlink.symlink(engine.GetFilename(filename), dest)
+        # Write the compile.xml which will tell ant to build things
+        if self.javac.backend == "ant":
+            self.WriteCompileXml()
 
-        # Set up the jars/ directory by symlinking in all the depending jars.
-        jarprefix = self.jarprefix = os.path.join(prefix, "jars")
-        if os.path.exists(jarprefix):
-            shutil.rmtree(jarprefix)
-        os.makedirs(jarprefix)
+        # Set up the src/ and jars/ directories, by symlinking in all
+        # the depending source files and jars. Only the links that
+        # changed since the last build are touched.
+        self.srcprefix = os.path.join(prefix, "src")
+        self.jarprefix = os.path.join(prefix, "jars")
+        links = {}
+        for source, filename in self.sources.iteritems():
+            links[os.path.join("src", source)] = engine.GetFilename(filename)
         for jar, filename in self.jars.iteritems():
-            symlink.symlink(engine.GetFilename(filename),
-                            os.path.join(jarprefix, os.path.basename(jar)))
+            links[os.path.join("jars", os.path.basename(jar))] = (
+                engine.GetFilename(filename))
+        SyncSymlinks(prefix, ("src", "jars"), links,
+                     os.path.join(prefix, ".links"))
 
         # Set up the output directory where all the class files will go
         outprefix = self.outprefix = os.path.join(prefix, "classes")
@@ -288,32 +889,47 @@ class JavaCompile(Target):
         engine.class_cache.PopulateFromCache(outprefix, self.sources)
 
         # Create an eclipse file
-        with open(os.path.join(prefix, ".classpath"), "w") as f:
-            f.write("""<?xml version="1.0" encoding="UTF-8"?>
+        WriteIfChanged(
+            os.path.join(prefix, ".classpath"),
+            """<?xml version="1.0" encoding="UTF-8"?>
 <classpath>
   <classpathentry kind="src" path="src"/>
   <classpathentry kind="output" path="classes"/>
   <classpathentry kind="con" path="org.eclipse.jdt.launching.JRE_CONTAINER"/>
-""")
-            for jar in self.jars:
-                f.write('<classpathentry kind="lib" path="jars/%s"/>\n' %
-                        os.path.basename(jar))
-            f.write("</classpath>\n")
+""" + "".join('<classpathentry kind="lib" path="jars/%s"/>\n' %
+              os.path.basename(jar) for jar in sorted(self.jars)) +
+            "</classpath>\n")
 
         # Create a findbugs file
-        with open(os.path.join(prefix, "findbugs.fbp"), "w") as f:
-            loc = os.path.abspath(prefix)
-            f.write('<Project projectName="">\n')
-            for jar in self.jars:
-                f.write("<AuxClasspathEntry>%s</AuxClasspathEntry>\n" %
-                        os.path.join(loc, "jars", os.path.basename(jar)))
-            f.write("<Jar>%s</Jar>\n" % os.path.join(loc, "classes"))
-            f.write("<SrcDir>%s</SrcDir>\n" % os.path.join(loc, "src"))
-            f.write("""<SuppressionFilter>
+        loc = os.path.abspath(prefix)
+        WriteIfChanged(
+            os.path.join(prefix, "findbugs.fbp"),
+            '<Project projectName="">\n' +
+            "".join("<AuxClasspathEntry>%s</AuxClasspathEntry>\n" %
+                    os.path.join(loc, "jars", os.path.basename(jar))
+                    for jar in sorted(self.jars)) +
+            "<Jar>%s</Jar>\n" % os.path.join(loc, "classes") +
+            "<SrcDir>%s</SrcDir>\n" % os.path.join(loc, "src") +
+            """<SuppressionFilter>
 <LastVersion value="-1" relOp="NEQ"/>
 </SuppressionFilter>
-""")
-            f.write("</Project>\n")
+""" +
+            "</Project>\n")
+
+    def WriteCompileXml(self):
+        with open(os.path.join(ICBM_PATH, "compile.xml")) as f:
+            text = f.read() % {
+                "encoding": self.javac.encoding,
+                "target": self.javac.target,
+                "compilerargs": "".join(
+                    '      <compilerarg value=%s/>\n' %
+                    saxutils.quoteattr(flag) for flag in self.javac.flags),
+                }
+        compile_xml = os.path.join(self.prefix, "compile.xml")
+        # Older builds symlinked the template itself into place.
+        if os.path.islink(compile_xml):
+            os.unlink(compile_xml)
+        WriteIfChanged(compile_xml, text)
 
     def GenerateRunner(self):
         # Create a script to run the whole thing with appropriate
@@ -342,36 +958,50 @@ class JavaCompile(Target):
 
     def Run(self, engine):
         # Ant is slow at figuring out that it has nothing to do, so
-        # check for a build tstamp, and compare against files. If none
-        # of them are newer, skip this step.
-
-        depstr = "%r%r%r%r%r" % (
-            self.sources, self.jars, self.data, self.main, self.flags)
+        # compare the inputs and the runner script against the last
+        # successful run. If none of them changed, skip this step.
+        #
+        # The first part is what all of the classes depend on, see
+        # StaleSources.
+        depstr = (repr((self.jars, self.javac)), repr(self.sources),
+                  repr((self.data, self.main, self.flags)))
         deplist = os.path.join(self.prefix, ".deplist")
 
-        tstamp_path = os.path.join(self.prefix, self.name)
-        if (not self.NewerChanges(
-                [self.srcprefix, self.jarprefix], tstamp_path) and
-            not self.DependenciesChanged(depstr, deplist)):
+        if not self.InputsChanged(engine, deplist, self.Inputs(engine),
+                                  [os.path.join(self.prefix, self.name)],
+                                  depstr):
             return True
 
-        cmd = ["ant", "-f", os.path.join(self.prefix, "compile.xml")]
-        print cmd
-        p = subprocess.Popen(cmd,
-                             bufsize=1,
-                             #stdout=subprocess.STDOUT,
-                             #stderr=subprocess.STDOUT,
-                             close_fds=True,
-                             shell=False)
-        p.wait()
+        # What the flag processor adds isn't covered by the action key,
+        # so targets that use it are never cached.
+        key = None
+        if engine.action_cache and not self.flags:
+            key = self.ActionKey(engine)
+            # A hit brings back all of the classes, so drop the ones
+            # that are there, which may include classes of sources
+            # that are gone.
+            if engine.action_cache.Restore(
+                    key, self.outprefix,
+                    lambda: self._RemoveClasses(lambda dirname, name: True)):
+                engine.class_cache.UpdateCache(self.outprefix)
+                self.Complete(engine, deplist, depstr)
+                return True
+
+        if self.javac.backend == "javac":
+            success = self.RunJavac(engine, deplist, depstr)
+        else:
+            success = self.RunAnt(engine)
 
         engine.class_cache.UpdateCache(self.outprefix)
 
-        if p.returncode != 0:
+        if not success:
             return False
 
         if not self.flags:
-            self.Complete(deplist, depstr)
+            if key:
+                engine.action_cache.Store(key, self.outprefix,
+                                          self.OutputClasses())
+            self.Complete(engine, deplist, depstr)
             return True
 
         # Execute the flagprocessor with all of its classpath, as well
@@ -380,34 +1010,243 @@ class JavaCompile(Target):
         #
         # java -cp flag_processor/*:target/* \
         #     com.alphaco.util.flags.FlagProcessor target/classes
-        flags = subprocess.Popen(
-            "java -cp flag_processor/classes:flag_processor/jars/* "
-            "com.alphaco.util.flags.FlagProcessor "
-            "%(target)s/classes "
-            "'%(target)s/jars/*'" % {"target" : self.name},
-            cwd=BUILD_DIR,
-            bufsize=1,
-            stdout=subprocess.PIPE,
-            close_fds=True,
-            shell=True)
-
-        output = flags.stdout.read()
-        if flags.wait() != 0:
-            return False
+        with engine.SpawningJVM():
+            flags = engine.Popen(
+                "java -cp flag_processor/classes:flag_processor/jars/* "
+                "com.alphaco.util.flags.FlagProcessor "
+                "%(target)s/classes "
+                "'%(target)s/jars/*'" % {"target" : self.name},
+                cwd=BUILD_DIR,
+                bufsize=1,
+                stdout=subprocess.PIPE,
+                close_fds=True,
+                shell=True)
+
+            output = flags.stdout.read()
+            if flags.wait() != 0:
+                return False
 
         f = open(os.path.join(self.outprefix, "flagdescriptors.cfg"), "w")
         with f:
             f.write(output)
 
-        self.Complete(deplist, depstr)
+        self.Complete(engine, deplist, depstr)
 
         return True
 
-    def Complete(self, deplist, depstr):
+    def RunAnt(self, engine):
+        cmd = ["ant", "-f", os.path.join(self.prefix, "compile.xml")]
+        print cmd
+        with engine.SpawningJVM():
+            p = engine.Popen(cmd,
+                             bufsize=1,
+                             #stdout=subprocess.STDOUT,
+                             #stderr=subprocess.STDOUT,
+                             close_fds=True,
+                             shell=False)
+            p.wait()
+        return p.returncode == 0
+
+    def RunJavac(self, engine, deplist, depstr):
+        stale = self.StaleSources(engine, deplist, depstr)
+        if stale is None:
+            # Start from scratch, so that no classes of removed
+            # sources are left behind.
+            stale = set(fake for fake in self.sources
+                        if fake.endswith(".java"))
+            self._RemoveClasses(lambda dirname, name: True)
+        else:
+            self._RemoveClasses(
+                lambda dirname, name: os.path.join(
+                    dirname, name.split("$")[0] + ".java") in stale)
+        if not stale:
+            return True
+
+        # The paths are absolute, as the compile server doesn't run in
+        # the prefix.
+        prefix = os.path.abspath(self.prefix)
+        classes = os.path.join(prefix, "classes")
+        src = os.path.join(prefix, "src")
+        classpath = [classes] + sorted(
+            os.path.join(prefix, "jars", os.path.basename(jar))
+            for jar in self.jars)
+        args = (["-d", classes,
+                 "-sourcepath", src,
+                 "-classpath", os.pathsep.join(classpath),
+                 "-encoding", self.javac.encoding,
+                 # Newer javacs refuse an old -target with their own
+                 # default -source (ant's javac task adds it as well).
+                 "-source", self.javac.target,
+                 "-target", self.javac.target,
+                 "-g",
+                 "-implicit:class"] +
+                list(self.javac.flags) +
+                sorted(os.path.join(src, fake) for fake in stale))
+
+        # The server disables itself when it fails, and returns None.
+        result = engine.compile_server and engine.compile_server.Compile(args)
+        if result:
+            returncode, output, seconds = result
+            sys.stdout.write(output.encode("utf-8"))
+            print "Compiled %d of %d sources of %s in %.1fs" % (
+                len(stale), len(self.sources), self.name, seconds)
+            return returncode == 0
+
+        # The sources go in an argument file, as there can be more of
+        # them than fit on a command line.
+        argfile = os.path.join(self.prefix, ".javac_args")
+        with open(argfile, "w") as f:
+            for arg in args:
+                f.write('"%s"\n' % arg.replace("\\", "\\\\"))
+
+        cmd = ["javac", "@.javac_args"]
+        print cmd, "(%d of %d sources)" % (len(stale), len(self.sources))
+        with engine.SpawningJVM():
+            p = engine.Popen(cmd,
+                             cwd=self.prefix,
+                             bufsize=1,
+                             close_fds=True,
+                             shell=False)
+            p.wait()
+        return p.returncode == 0
+
+    def StaleSources(self, engine, deplist, depstr):
+        """Finds the sources that the javac backend needs to compile.
+
+        A source is stale if it changed since the last successful
+        compile (going by the manifest that InputsChanged checks), or
+        if its class file is missing or older than it. Like the
+        <depend closure="yes"> of compile.xml, everything that depends
+        on a stale source, directly or not, is stale as well.
+
+        Returns: The set of fake paths of the stale sources, or None if
+        all of them need to be compiled, e.g. because the jars or the
+        compiler options changed.
+        """
+        old = {}
+        try:
+            with open(deplist, "rb") as f:
+                old_depstr, old_inputs, _ = marshal.load(f)
+            if old_depstr[0] != depstr[0]:
+                return None
+            old = dict(old_inputs)
+        except (IOError, EOFError, ValueError, TypeError):
+            # Go by the class files alone, like ant would.
+            pass
+
+        if old:
+            current = set(self.Inputs(engine))
+            for real in old:
+                if real.endswith(".java") and real not in current:
+                    # Whatever used a removed source is broken now, and
+                    # there is no telling what that was.
+                    return None
+            for real in self.jars.itervalues():
+                real = engine.GetFilename(real)
+                if old.get(real) != engine.stat_cache.Stat(real):
+                    return None
+
+        changed = set()
+        for fake, real in self.sources.iteritems():
+            if not fake.endswith(".java"):
+                continue
+            s = engine.stat_cache.Stat(engine.GetFilename(real))
+            if old and old.get(engine.GetFilename(real)) != s:
+                changed.add(fake)
+                continue
+            try:
+                mtime = os.stat(os.path.join(
+                    self.outprefix, fake[:-5] + ".class")).st_mtime
+            except OSError:
+                changed.add(fake)
+                continue
+            if s is None or int(mtime * 1e9) < s[1]:
+                changed.add(fake)
+        if not changed:
+            return changed
+        if not self.source_deps:
+            return None
+
+        dependents = {}
+        for fake, deps in self.source_deps().iteritems():
+            for dep in deps:
+                dependents.setdefault(dep, []).append(fake)
+        stale = set()
+        work = list(changed)
+        while work:
+            fake = work.pop()
+            if fake in stale:
+                continue
+            stale.add(fake)
+            work.extend(dependents.get(fake, ()))
+        return set(fake for fake in stale if fake in self.sources)
+
+    def _RemoveClasses(self, remove):
+        """Removes the class files for which remove(dirname, name)
+        returns True, given the directory relative to classes/ and the
+        class name, e.g. ("com/foo", "Foo$1")."""
+        for dirname, _, files in os.walk(self.outprefix):
+            reldir = os.path.relpath(dirname, self.outprefix)
+            if reldir == ".":
+                reldir = ""
+            for fn in files:
+                path = os.path.join(dirname, fn)
+                if (fn.endswith(".class") and not os.path.islink(path) and
+                    remove(reldir, fn[:-6])):
+                    os.unlink(path)
+
+    def OutputClasses(self):
+        """Returns the class files of the sources, relative to classes/.
+
+        Like the class cache, this goes by name: com/foo/Foo.class and
+        com/foo/Foo$1.class belong to com/foo/Foo.java. Classes of
+        sources that are gone, and the data files, are left out.
+        """
+        outputs = []
+        for dirname, _, files in os.walk(self.outprefix):
+            reldir = os.path.relpath(dirname, self.outprefix)
+            if reldir == ".":
+                reldir = ""
+            for fn in files:
+                if (fn.endswith(".class") and
+                    os.path.join(reldir, fn[:-6].split("$")[0] + ".java")
+                    in self.sources and
+                    not os.path.islink(os.path.join(dirname, fn))):
+                    outputs.append(os.path.join(reldir, fn))
+        return outputs
+
+    def ActionKey(self, engine):
+        """Returns the action cache key of the compile."""
+        def _Digests(files):
+            return sorted(
+                (fake, action_cache.FileDigest(engine.GetFilename(real)))
+                for fake, real in files.iteritems())
+        return action_cache.ActionKey(
+            "JavaCompile",
+            _Digests(self.sources),
+            sorted((os.path.basename(jar), digest)
+                   for jar, digest in _Digests(self.jars)),
+            _Digests(self.data),
+            self.main,
+            self.javac,
+            action_cache.FileDigest(os.path.join(ICBM_PATH, "compile.xml")),
+            ToolFingerprint("ant", "javac", "java"))
+
+    def Inputs(self, engine):
+        """Returns the files the compile reads."""
+        inputs = []
+        for files in (self.sources, self.jars, self.data):
+            for real in files.itervalues():
+                if not real.startswith("/"):
+                    real = engine.GetFilename(real)
+                inputs.append(real)
+        inputs.sort()
+        return inputs
+
+    def Complete(self, engine, deplist, depstr):
         self.GenerateRunner()
-        f = open(deplist, "w")
-        with f:
-            f.write(depstr)
+        self.RecordInputs(engine, deplist, self.Inputs(engine),
+                          [os.path.join(self.prefix, self.name)], depstr)
 
     def GetOutput(self, path):
         assert path == os.path.join(self.name, self.name)
@@ -436,9 +1275,36 @@ class JarBuild(Target):
         # Verify that we actually need to do something. Otherwise
         # leave it alone.
         tstamp_path = os.path.join(BUILD_DIR, self.name)
-        if not self.NewerChanges(self.jars.values() + [prefix], tstamp_path):
+        store = os.path.join(BUILD_DIR, ".%s.inputs" % self.name)
+        inputs = self.Inputs(engine)
+        if not self.InputsChanged(engine, store, inputs, [tstamp_path]):
             return True
 
+        # Clear VERSIONER_PYTHON_VERSION for mac, so that hg can use the default python version
+        rev = commands.getoutput("unset VERSIONER_PYTHON_VERSION; hg parent --template '{rev}:{node}\\n'")
+
+        # The revision goes into the manifest, so it is part of the
+        # key. The build time and user are not; a restored jar keeps
+        # those of the build that stored it.
+        key = None
+        if engine.action_cache:
+            classes = []
+            def _Digest(arg, dirname, files):
+                for fn in files:
+                    fn = os.path.join(dirname, fn)
+                    if os.path.isfile(fn):
+                        classes.append((os.path.relpath(fn, arg),
+                                        action_cache.FileDigest(fn)))
+            os.path.walk(prefix, _Digest, prefix)
+            key = action_cache.ActionKey(
+                "JarBuild", self.name, self.target, self.main, self.premain,
+                rev, sorted(classes),
+                sorted((jar, action_cache.FileDigest(engine.GetFilename(fn)))
+                       for jar, fn in self.jars.iteritems()))
+            if engine.action_cache.Restore(key, BUILD_DIR):
+                self.RecordInputs(engine, store, inputs, [tstamp_path])
+                return True
+
         # Put together the classes dir from the compiles, as well as
         # all of the jars into a single jar.
         out = os.path.join(BUILD_DIR, ".%s" % self.name)
@@ -478,8 +1344,6 @@ exec java ${JVM_ARGS} -jar $0 "$@"
                     contents = j.open(info).read()
                     f.writestr(info, contents)
 
-        # Clear VERSIONER_PYTHON_VERSION for mac, so that hg can use the default python version
-        rev = commands.getoutput("unset VERSIONER_PYTHON_VERSION; hg parent --template '{rev}:{node}\\n'")
         rev_hash = ''
         if rev and ":" in rev:
             rev, rev_hash = rev.split(":")
@@ -505,8 +1369,24 @@ Yext-Jar: %s
 
         os.rename(out, os.path.join(BUILD_DIR, self.name))
 
+        if key:
+            engine.action_cache.Store(key, BUILD_DIR, [self.name])
+
+        self.RecordInputs(engine, store, inputs, [tstamp_path])
+
         return True
 
+    def Inputs(self, engine):
+        """Returns the files the jar is built from.
+
+        Rather than every file under the classes directory, this lists
+        the runner script of the compile, which is rewritten whenever
+        the classes change.
+        """
+        return ([os.path.join(BUILD_DIR, self.target, self.target)] +
+                sorted(engine.GetFilename(fn)
+                       for fn in self.jars.itervalues()))
+
     def GetOutput(self, path):
         assert path == self.name
         return os.path.join(BUILD_DIR, self.name)
@@ -534,8 +1414,13 @@ class WarBuild(Target):
         # Verify that we actually need to do something. Otherwise
         # leave it alone.
         tstamp_path = os.path.join(BUILD_DIR, self.name)
-        if not self.NewerChanges(
-            self.jars.values() + self.data.values() + [prefix], tstamp_path):
+        store = os.path.join(BUILD_DIR, ".%s.inputs" % self.name)
+        # As for JarBuild, the runner script of the compile stands in
+        # for the classes directory.
+        inputs = ([os.path.join(BUILD_DIR, self.target, self.target)] +
+                  sorted(engine.GetFilename(fn) for fn in
+                         self.jars.values() + self.data.values()))
+        if not self.InputsChanged(engine, store, inputs, [tstamp_path]):
             return True
 
         # Put together the classes dir from the compiles, as well as
@@ -574,6 +1459,8 @@ Build-Revision: %s
 
         os.rename(out, os.path.join(BUILD_DIR, self.name))
 
+        self.RecordInputs(engine, store, inputs, [tstamp_path])
+
         return True
 
     def GetOutput(self, path):
@@ -583,6 +1470,8 @@ Build-Revision: %s
 
 class PlayCompile(Target):
 
+    incremental = False
+
     def __init__(self, path, name, modules, deps, data, play_home):
         Target.__init__(self, path, name)
         self.modules = modules
@@ -624,16 +1513,17 @@ class PlayCompile(Target):
             _CopyPlayApp(module)
 
         # Execute the play compiler
-        generate = subprocess.Popen(
-            [self.play_home + '/play',
-             'precompile',
-             os.path.join(self.prefix, self.modules[0])],
-            bufsize=1,
-            close_fds=True,
-            shell=False)
-
-        if generate.wait() != 0:
-            return False
+        with engine.SpawningJVM():
+            generate = engine.Popen(
+                [self.play_home + '/play',
+                 'precompile',
+                 os.path.join(self.prefix, self.modules[0])],
+                bufsize=1,
+                close_fds=True,
+                shell=False)
+
+            if generate.wait() != 0:
+                return False
 
         # Copy all the data file as well
         for data, filename in self.data.iteritems():
@@ -665,13 +1555,21 @@ class PlayCompile(Target):
 
 class Generate(Target):
 
-    def __init__(self, path, name, compiler, args, sources, outputs, deps):
+    def __init__(self, path, name, compiler, args, sources, outputs, deps,
+                 worker=None, batch=False):
         Target.__init__(self, path, name)
         self.sources = sources
         self.outputs = set(outputs)
         self.compiler = compiler
         self.args = args or []
         self.deps = deps
+        # Command of a persistent worker that runs the compiler's
+        # actions (see generate_worker.py), or None
+        self.worker = worker
+        # Whether the compiler is run on the first source of every
+        # target of a batch at once (see RunBatch), rather than on all
+        # the sources and outputs of one target.
+        self.batch = batch
 
     def AddDependencies(self, engine):
         for dep in self.deps:
@@ -702,11 +1600,8 @@ class Generate(Target):
                 os.makedirs(path)
 
     def Run(self, engine):
-        # The assumption is that the generation is fully dependent on
-        # the inputs. So if none of them have changed, then no need to
-        # do anything.
-        tstamp_path = os.path.join(self.prefix, "TIMESTAMP")
-        if not self.NewerChanges([self.prefix], tstamp_path):
+        assert not self.batch, "%s runs through RunBatch" % self.name
+        if not self.NeedsRun(engine):
             return True
 
         # Execute the compiler in the prefix cwd with the sources and
@@ -715,21 +1610,174 @@ class Generate(Target):
         args = ([self.compiler] + self.args + list(x[0] for x in self.sources) +
                 list(self.outputs))
         print args
-        generate = subprocess.Popen(
-            args,
-            cwd=self.prefix,
-            bufsize=1,
-            close_fds=True,
-            shell=False)
-
-        if generate.wait() != 0:
+        with engine.SpawningJVM():
+            returncode = None
+            if self.worker:
+                returncode = self.RunWorker(engine, args[1:])
+            if returncode is None:
+                generate = engine.Popen(
+                    args,
+                    cwd=self.prefix,
+                    bufsize=1,
+                    close_fds=True,
+                    shell=False)
+                returncode = generate.wait()
+            if returncode != 0:
+                return False
+
+        self.Finish(engine)
+        return True
+
+    def NeedsRun(self, engine):
+        """Returns whether the compiler needs to run, i.e. the outputs
+        are neither up to date nor restored from the action cache."""
+        # The assumption is that the generation is fully dependent on
+        # the inputs. So if none of them have changed, then no need to
+        # do anything.
+        store = os.path.join(self.prefix, ".inputs")
+        inputs = sorted(engine.GetFilename(real) for _, real in self.sources)
+        outputs = [os.path.join(self.prefix, "TIMESTAMP")] + sorted(
+            os.path.join(self.prefix, out) for out in self.outputs)
+        depstr = repr((self.compiler, self.args))
+        self.manifest = (store, inputs, outputs, depstr)
+        if not self.InputsChanged(engine, *self.manifest):
             return False
 
-        with open(tstamp_path, "w"):
+        # What the deps (e.g. a generator that is built itself) do
+        # isn't covered by the action key, so those aren't cached.
+        self.key = None
+        if engine.action_cache and not self.deps:
+            self.key = self.ActionKey(engine)
+            if engine.action_cache.Restore(self.key, self.prefix):
+                self.Finish(engine, restored=True)
+                return False
+        return True
+
+    def Finish(self, engine, restored=False):
+        """Records a run of the compiler, or a restore of its outputs."""
+        if self.key and not restored:
+            engine.action_cache.Store(self.key, self.prefix, self.outputs)
+
+        with open(os.path.join(self.prefix, "TIMESTAMP"), "w"):
             pass
 
+        self.RecordInputs(engine, *self.manifest)
+
+    def BatchKey(self):
+        if not self.batch:
+            return None
+        return (Generate, self.compiler, tuple(self.args),
+                tuple(sorted(self.deps)))
+
+    @staticmethod
+    def RunBatch(engine, targets):
+        """Runs the compiler once for all the targets that need it.
+
+        It runs in a directory with the sources of all of them, on the
+        first source of each, and has to write the outputs of every
+        target at the paths it would write them at for the target on
+        its own. Those are then moved into the targets' prefixes.
+        Targets with different sources at the same path go in separate
+        runs.
+        """
+        results = dict((target, True) for target in targets)
+        # (fake path -> real path, targets) of every run
+        groups = []
+        for target in targets:
+            if not target.NeedsRun(engine):
+                continue
+            for sources, members in groups:
+                if all(sources.get(fake, real) == real
+                       for fake, real in target.sources):
+                    sources.update(target.sources)
+                    members.append(target)
+                    break
+            else:
+                groups.append((dict(target.sources), [target]))
+
+        for sources, members in groups:
+            if Generate._RunGroup(engine, sources, members):
+                continue
+            if len(members) == 1:
+                results[members[0]] = False
+                continue
+            # Find out which of them is broken.
+            print "Batch failed, running its targets one at a time"
+            for target in members:
+                results[target] = Generate._RunGroup(
+                    engine, dict(target.sources), [target])
+        return results
+
+    @staticmethod
+    def _RunGroup(engine, sources, members):
+        first = members[0]
+        if len(members) == 1:
+            directory = first.prefix
+        else:
+            directory = tempfile.mkdtemp(prefix=".batch-", dir=BUILD_DIR)
+        try:
+            if directory != first.prefix:
+                for fake, real in sources.iteritems():
+                    dest = os.path.join(directory, fake)
+                    if not os.path.isdir(os.path.dirname(dest)):
+                        os.makedirs(os.path.dirname(dest))
+                    symlink.symlink(engine.GetFilename(real), dest)
+
+            args = ([first.compiler] + first.args +
+                    [target.sources[0][0] for target in members])
+            print args
+            with engine.SpawningJVM():
+                generate = engine.Popen(
+                    args,
+                    cwd=directory,
+                    bufsize=1,
+                    close_fds=True,
+                    shell=False)
+                if generate.wait() != 0:
+                    return False
+
+            if directory != first.prefix:
+                for target in members:
+                    for out in target.outputs:
+                        path = os.path.join(directory, out)
+                        if not os.path.exists(path):
+                            print >>sys.stderr, "%s was not generated" % out
+                            return False
+                        os.rename(path, os.path.join(target.prefix, out))
+        finally:
+            if directory != first.prefix:
+                shutil.rmtree(directory, ignore_errors=True)
+
+        for target in members:
+            target.Finish(engine)
         return True
 
+    def RunWorker(self, engine, args):
+        """Runs the compiler's action on a persistent worker.
+
+        Returns: The exit code of the action, or None if the worker
+        failed and the compiler should be run instead.
+        """
+        try:
+            returncode, output = engine.workers.Run(
+                engine.Popen, self.worker, os.path.abspath(self.prefix), args)
+        except generate_worker.WorkerError as e:
+            print >>sys.stderr, "%s, running %s instead" % (e, self.compiler)
+            return None
+        sys.stdout.write(output)
+        return returncode
+
+    def ActionKey(self, engine):
+        """Returns the action cache key of the generation."""
+        compiler = self.compiler
+        if os.path.isfile(compiler):
+            compiler = action_cache.FileDigest(compiler)
+        return action_cache.ActionKey(
+            "Generate", compiler, self.args,
+            sorted((fake, action_cache.FileDigest(engine.GetFilename(real)))
+                   for fake, real in self.sources),
+            sorted(self.outputs))
+
     def GetOutput(self, path):
         assert path in self.outputs, path
         return os.path.join(self.prefix, path)
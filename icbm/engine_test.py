@@ -0,0 +1,293 @@
+#!/usr/bin/python
+
+import marshal
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+import engine
+
+class FakeTarget(engine.Target):
+
+    """A target that provides its own name and needs the given files.
+
+    Running it only appends its name to log, and fails if fail is set.
+    """
+
+    def __init__(self, name, deps=(), fail=False, log=None):
+        engine.Target.__init__(self, "", name)
+        self.deps = deps
+        self.fail = fail
+        self.log = log
+
+    def AddDependencies(self, e):
+        for dep in self.deps:
+            e.Depend(self, dep)
+        e.Provide(self, self.name)
+
+    def Setup(self, e):
+        pass
+
+    def Run(self, e):
+        self.log.append(self.name)
+        return not self.fail
+
+
+class EngineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # The engine keeps its state in BUILD_DIR, relative to the
+        # current directory.
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        self.engine = engine.Engine()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def Add(self, *targets):
+        for target in targets:
+            self.engine.AddTarget(target)
+        self.engine.ComputeDependencies()
+
+
+class VerifyGraphTest(EngineTestCase):
+
+    def Verify(self, targets):
+        """Returns the result of VerifyGraph, and what it printed."""
+        stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            return (self.engine.VerifyGraph(targets),
+                    sys.stderr.getvalue().splitlines())
+        finally:
+            sys.stderr = stderr
+
+    def testGood(self):
+        a, b, c = (FakeTarget("a", ["b", "c"]), FakeTarget("b", ["c"]),
+                   FakeTarget("c"))
+        self.Add(a, b, c)
+        self.assertEqual((True, []), self.Verify([a]))
+
+    def testCycleAndMissing(self):
+        # top -> a -> b -> c -> a, and b also needs a file that nothing
+        # provides.
+        top, a, b, c = (FakeTarget("top", ["a"]), FakeTarget("a", ["b"]),
+                        FakeTarget("b", ["c", "nowhere"]),
+                        FakeTarget("c", ["a"]))
+        self.Add(top, a, b, c)
+        ok, lines = self.Verify([top])
+        self.assertFalse(ok)
+        self.assertEqual(
+            ["b depends on nowhere, which no target provides",
+             "Dependency cycle:",
+             "  a needs b, from",
+             "  b needs c, from",
+             "  c needs a, from",
+             "  a"],
+            lines)
+
+    def testSelfDependency(self):
+        a = FakeTarget("a", ["a"])
+        self.Add(a)
+        ok, lines = self.Verify([a])
+        self.assertFalse(ok)
+        self.assertEqual(["Dependency cycle:", "  a needs a, from", "  a"],
+                         lines)
+
+    def testShortestCycle(self):
+        # a -> b -> c -> a, with a shortcut b -> a; the shorter cycle
+        # is the one reported.
+        a, b, c = (FakeTarget("a", ["b"]), FakeTarget("b", ["c", "a"]),
+                   FakeTarget("c", ["a"]))
+        self.Add(a, b, c)
+        ok, lines = self.Verify([a])
+        self.assertFalse(ok)
+        self.assertEqual(
+            ["Dependency cycle:", "  a needs b, from", "  b needs a, from",
+             "  a"],
+            lines)
+
+
+class SchedulerTest(EngineTestCase):
+
+    def setUp(self):
+        EngineTestCase.setUp(self)
+        self.log = []
+
+    def Target(self, name, deps=(), fail=False):
+        return FakeTarget(name, deps, fail, self.log)
+
+    def Build(self, targets, workers):
+        """Builds targets, and returns the result of Go."""
+        for target in targets:
+            self.engine.BuildTarget(target)
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            return self.engine.Go(workers)
+        finally:
+            sys.stdout = stdout
+
+    def testOrder(self):
+        # A diamond on top of a chain.
+        targets = [self.Target("top", ["left", "right"]),
+                   self.Target("left", ["base"]),
+                   self.Target("right", ["base"]),
+                   self.Target("base", ["lib"]),
+                   self.Target("lib")]
+        self.Add(*targets)
+        self.assertTrue(self.Build(targets[:1], 4))
+        self.assertEqual(sorted(t.name for t in targets), sorted(self.log))
+        for target in targets:
+            for dep in target.deps:
+                self.assertTrue(
+                    self.log.index(dep) < self.log.index(target.name),
+                    "%s ran before %s: %s" % (target.name, dep, self.log))
+
+    def testLongestChainFirst(self):
+        # With one worker, the start of the longer chain goes before the
+        # target that nothing waits for.
+        targets = [self.Target("alone"), self.Target("top", ["bottom"]),
+                   self.Target("bottom")]
+        self.Add(*targets)
+        self.assertTrue(self.Build(targets[:2], 1))
+        self.assertEqual("bottom", self.log[0])
+        self.assertEqual(["alone", "bottom", "top"], sorted(self.log))
+
+    def testFailureSkipsDependents(self):
+        targets = [self.Target("top", ["mid", "other"]),
+                   self.Target("mid", ["broken"]),
+                   self.Target("broken", fail=True),
+                   self.Target("other")]
+        self.Add(*targets)
+        self.assertFalse(self.Build(targets[:1], 2))
+        # Whatever doesn't need the failed target is still built.
+        self.assertEqual(["broken", "other"], sorted(self.log))
+        top, mid, broken, other = targets
+        self.assertEqual([broken], self.engine.failed)
+        self.assertEqual({top: broken, mid: broken}, self.engine.skipped)
+        self.assertFalse(self.engine.cancelled)
+
+    def testFailFastDrainsQueue(self):
+        self.engine.fail_fast = True
+        # broken has a dependent, so with one worker it runs before the
+        # other ready targets, which must then be dropped unrun.
+        targets = [self.Target("top", ["broken"]),
+                   self.Target("broken", fail=True),
+                   self.Target("a"), self.Target("b"), self.Target("c")]
+        self.Add(*targets)
+        self.assertFalse(self.Build([targets[0]] + targets[2:], 1))
+        self.assertEqual(["broken"], self.log)
+        self.assertTrue(self.engine.cancelled)
+        self.assertEqual(0, self.engine.ready_queue.unfinished_tasks)
+        self.assertTrue(self.engine.ready_queue.empty())
+
+
+class SyncSymlinksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = os.path.join(self.dir, ".links")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def Sync(self, links):
+        engine.SyncSymlinks(self.dir, ["src", "res"], links, self.store)
+
+    def Links(self, root):
+        """Returns dict of path -> target of the links under root."""
+        links = {}
+        for dirpath, dirnames, filenames in os.walk(
+            os.path.join(self.dir, root)):
+            for fn in filenames:
+                path = os.path.join(dirpath, fn)
+                links[os.path.relpath(path, self.dir)] = os.readlink(path)
+        return links
+
+    def Dirs(self, root):
+        """Returns the directories under root, relative to the prefix."""
+        return sorted(os.path.relpath(dirpath, self.dir)
+                      for dirpath, _, _ in os.walk(
+                          os.path.join(self.dir, root)))
+
+    def testUpdate(self):
+        self.Sync({"src/a/A.java": "/real/A.java",
+                   "src/a/b/B.java": "/real/B.java",
+                   "src/c/C.java": "/real/C.java"})
+        self.assertEqual(["res"], self.Dirs("res"))
+        kept = os.lstat(os.path.join(self.dir, "src/c/C.java"))
+
+        # B goes, A changes, D is added.
+        links = {"src/a/A.java": "/real/A2.java",
+                 "src/c/C.java": "/real/C.java",
+                 "src/d/D.java": "/real/D.java"}
+        self.Sync(links)
+        self.assertEqual(links, self.Links("src"))
+        # a/b is pruned as it is empty now, but a is not.
+        self.assertEqual(["src", "src/a", "src/c", "src/d"],
+                         self.Dirs("src"))
+        # Unchanged links are left alone.
+        self.assertEqual(
+            kept.st_ino,
+            os.lstat(os.path.join(self.dir, "src/c/C.java")).st_ino)
+
+    def testPruneToRoot(self):
+        self.Sync({"src/a/b/c/A.java": "/real/A.java"})
+        self.Sync({})
+        # The roots themselves stay.
+        self.assertEqual(["src"], self.Dirs("src"))
+        self.assertEqual(["res"], self.Dirs("res"))
+
+    def testUntrackedFileKeepsDirectory(self):
+        self.Sync({"src/a/A.java": "/real/A.java"})
+        with open(os.path.join(self.dir, "src/a/notes"), "w"):
+            pass
+        self.Sync({})
+        self.assertEqual(["src", "src/a"], self.Dirs("src"))
+
+    def CheckRebuilt(self):
+        # Something the store doesn't know about is only cleared when
+        # everything is made from scratch.
+        with open(os.path.join(self.dir, "src/stray"), "w"):
+            pass
+        links = {"src/a/A.java": "/real/A.java"}
+        self.Sync(links)
+        self.assertEqual(links, self.Links("src"))
+
+    def testMissingStore(self):
+        self.Sync({"src/a/A.java": "/real/A.java",
+                   "src/b/B.java": "/real/B.java"})
+        os.unlink(self.store)
+        self.CheckRebuilt()
+
+    def testCorruptStore(self):
+        self.Sync({"src/a/A.java": "/real/A.java",
+                   "src/b/B.java": "/real/B.java"})
+        with open(self.store, "wb") as f:
+            f.write("not marshal data")
+        self.CheckRebuilt()
+
+    def testStoreOfWrongType(self):
+        self.Sync({"src/a/A.java": "/real/A.java"})
+        with open(self.store, "wb") as f:
+            marshal.dump(["src/a/A.java"], f)
+        self.CheckRebuilt()
+
+    def testMissingRoot(self):
+        self.Sync({"src/a/A.java": "/real/A.java",
+                   "res/r.txt": "/real/r.txt"})
+        shutil.rmtree(os.path.join(self.dir, "res"))
+        self.CheckRebuilt()
+        self.assertEqual({}, self.Links("res"))
+        self.assertEqual(["res"], self.Dirs("res"))
+
+
+if __name__ == "__main__":
+    unittest.main()
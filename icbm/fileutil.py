@@ -0,0 +1,32 @@
+#!/usr/bin/python
+
+import errno
+import os
+import tempfile
+
+def WriteAtomic(filename, write):
+    """Creates or replaces a file, so that readers (and builds that
+    were interrupted) only ever see the old contents or all of the new.
+
+    The contents are written to a temporary file next to filename,
+    which is then renamed over it. Missing directories are created.
+
+    Args:
+      filename: The file to write
+      write: Function that writes the contents to the file object it
+             is called with
+    """
+    dirname = os.path.dirname(filename) or "."
+    try:
+        os.makedirs(dirname)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    temp_fd, temp_filename = tempfile.mkstemp(dir=dirname)
+    try:
+        with os.fdopen(temp_fd, "wb") as f:
+            write(f)
+        os.rename(temp_filename, filename)
+    except:
+        os.unlink(temp_filename)
+        raise
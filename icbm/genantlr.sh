@@ -1,5 +1,8 @@
 #!/bin/bash
 
+# A generate rule can run this on a persistent JVM instead with
+# worker = "GenerateWorker <antlr jar> antlr" (see GenerateWorker.java).
+
 GRAMMAR="$1"
 OUTPUTDIR="$(dirname "$GRAMMAR")"
 
@@ -1,30 +1,39 @@
 #!/usr/bin/python
 
-import cPickle
+import bisect
+import fnmatch
+import hashlib
+import multiprocessing
 import os
 import re
+import string
 import sys
 import threading
 import time
 import zipfile
 
+import autodep_cache
 import config
 
+AUTODEP_CACHE_DIR = "build/autodep"
+
 VALID_TLDS = "|".join(re.escape(x) for x in config.VALID_TLDS.split())
 
+# Comments and string literals, which CleanCode drops. The only capture
+# group keeps the contents of string literals that look like class names.
 CLEAN_CODE_RE = re.compile(
-    r"""(
+    r"""
     /\*.*?\*/ # Matches /* */
       |
     //[^\n]* # Matches //
       |
     # Matches a class-looking reference inside of a "-enclosed string literal
-    "(?P<repl>(?:%s)\.[a-zA-Z0-9_\.]*\.[A-Z][A-Za-z0-9_]+)"
+    "((?:%s)\.[a-zA-Z0-9_\.]*\.[A-Z][A-Za-z0-9_]+)"
       |
-    "[^\\"]*(\\.[^\\"]*)*" # Matches a "-enclosed string literal
+    "[^\\"]*(?:\\.[^\\"]*)*" # Matches a "-enclosed string literal
       |
-    '[^\\']*(\\.[^\\']*)*' # Matches a '-enclosed string literal
-    )""" % (VALID_TLDS,), re.M | re.X | re.S)
+    '[^\\']*(?:\\.[^\\']*)*' # Matches a '-enclosed string literal
+    """ % (VALID_TLDS,), re.X | re.S)
 
 # Package specification
 PACKAGE_RE = re.compile(r"package (.*);")
@@ -32,11 +41,8 @@ PACKAGE_RE = re.compile(r"package (.*);")
 # import statement
 IMPORT_RE = re.compile(r"import(?: static)? (.*);")
 
-# Class(?) reference, not preceded with a .
-LOCAL_RE = re.compile(r"(?:^|(?!\.).)\b([A-Z]\w+)\b")
-
-# Fully-qualified class reference
-FULL_RE = re.compile(r"(?:^|(?!\.).)\b((?:%s)\.[a-zA-Z0-9_\.]*\.[A-Z][A-Za-z0-9_]+)\b" % (VALID_TLDS,))
+# Fully-qualified class reference at the start of a name (see ScanReferences)
+FULL_RE = re.compile(r"(?:%s)\.[a-zA-Z0-9_\.]*\.[A-Z][A-Za-z0-9_]+\b" % (VALID_TLDS,))
 
 # Class reference inside of an import
 IMPORT_PARSE_RE = re.compile(r"\b([A-Z]\w+)\b")
@@ -84,40 +90,176 @@ IGNORE_JAR_CLASSES_RE = re.compile(
     com\.sun\.org\.apache\.xml\.internal
     )\.""", re.X)
 
-class File(object):
+# ScanReferences turns every character that can't be part of a (dotted)
+# name into a space, and marks the start of each line with _LINE_MARK.
+_LINE_MARK = "\x01"
+_NAME_TABLE = "".join(
+    c if c in string.ascii_letters + string.digits + "_." + _LINE_MARK
+    else " " for c in map(chr, xrange(256)))
+_FULL_PREFIXES = sorted("%s." % x for x in config.VALID_TLDS.split())
+
+def CleanCode(contents):
+    """Strips the comments and string literals out of Java code, except
+    for string literals that look like class names, which are replaced
+    by their contents."""
+    return "".join(filter(None, CLEAN_CODE_RE.split(contents)))
+
+def ScanReferences(code):
+    """Finds the class references in a piece of code.
+
+    Instead of running a regex per kind of reference over the whole
+    code, this splits the code into names (identifiers, possibly joined
+    by dots) in a single pass of C string operations and then only looks
+    at the distinct names. A name refers to a class if it starts with a
+    capitalized identifier (a local reference: Foo, Foo.bar) or if it is
+    fully qualified (com.foo.Bar). Names right at the start of a line
+    are skipped, as they always have been.
+
+    Args:
+      code: The code, with comments and strings already removed if needed
+
+    Returns: A (local, full) tuple, where local is a set of class names
+    and full is a list of fully-qualified class names. References to
+    different classes with the same name are ordered by the last name
+    in the code that refers to them, so the one referenced last comes
+    last.
+    """
+    tokens = (code.replace("\n", " " + _LINE_MARK)
+              .translate(_NAME_TABLE).split())
+    names = sorted(set(tokens))
+
+    # Names sort by their first character, so the candidates for each
+    # kind of reference are a contiguous slice.
+    lo = bisect.bisect_left(names, "A")
+    hi = bisect.bisect_left(names, "[")
+    local_refs = set(name.split(".", 1)[0] for name in names[lo:hi])
+    local_refs = set(ref for ref in local_refs if len(ref) > 1)
+
+    # full ref -> names that reference it
+    full_refs = {}
+    for prefix in _FULL_PREFIXES:
+        lo = bisect.bisect_left(names, prefix)
+        hi = bisect.bisect_left(names, prefix[:-1] + "/")
+        for name in names[lo:hi]:
+            m = FULL_RE.match(name)
+            if m:
+                full_refs.setdefault(m.group(), []).append(name)
+
+    # Only the order among references to classes of the same name
+    # matters, so only those get located among the names. Searching
+    # the names rather than the text keeps com.x.Foo from matching the
+    # start of com.x.FooBar.
+    by_class = {}
+    for ref in full_refs:
+        by_class.setdefault(IMPORT_PARSE_RE.search(ref).group(1), []).append(ref)
+    ordered = []
+    reversed_tokens = None
+    for refs in by_class.itervalues():
+        if len(refs) > 1:
+            if reversed_tokens is None:
+                reversed_tokens = tokens[::-1]
+            # The fewer names follow the last reference, the later.
+            refs.sort(key=lambda ref: -min(reversed_tokens.index(name)
+                                           for name in full_refs[ref]))
+        ordered.extend(refs)
+
+    return local_refs, ordered
+
+def _ParsedClasses(local_refs, refs):
+    """Builds a parsed_classes map.
+
+    Args:
+      local_refs: Class names that are referenced without a package
+      refs: Fully-qualified references (imports and the like), later
+            ones taking precedence
+
+    Returns: A dict from class name to its fully-qualified name, or
+    None if it isn't known.
     """
+    classes = dict((m, None) for m in local_refs)
+
+    for m in refs:
+        if (m.startswith("java.") or
+            m.startswith("com.sun.management") or
+            m.startswith("com.sun.net.httpserver")):
+            continue
+        match = IMPORT_PARSE_RE.search(m)
+        if match:
+            classes[match.group(1)] = m
+    return classes
+
+class ImportCycleError(Exception):
+    pass
+
+class File(object):
+    """Base class of the files that autodep knows how to parse.
+
+    Files that come out of the autodep cache start out as stubs that
+    only hold the _STUB_ATTRS; the rest of their state is loaded from
+    the cache shard on first access. Likewise, PopulateDependencies is
+    deferred until one of the _LINKED_ATTRS is first accessed, so that
+    only the files that something asks about get linked.
     """
 
+    # Attributes that are kept in the cache index, and so are available
+    # without loading the file's shard.
+    _STUB_ATTRS = ("module", "path", "name")
+
+    # Attributes that are computed by PopulateDependencies.
+    _LINKED_ATTRS = ()
+
     def __repr__(self):
         return "%s(%s)" % (self.__class__.__name__, self.name)
 
+    def __getattr__(self, attr):
+        # Only called for attributes that haven't been set (yet).
+        d = self.__dict__
+        if attr in self._LINKED_ATTRS and "_linker" in d:
+            self.PopulateDependencies(*d.pop("_linker"))
+            return getattr(self, attr)
+        shard = d.get("_shard")
+        if shard is not None and not attr.startswith("__"):
+            # Load removes _shard once the state is in place.
+            shard.Load(self)
+            return getattr(self, attr)
+        raise AttributeError(attr)
+
+    def Stub(self):
+        """Returns the attributes kept in the cache index."""
+        return dict((attr, getattr(self, attr)) for attr in self._STUB_ATTRS)
+
+    @classmethod
+    def FromStub(cls, stub, shard):
+        """Creates a stub File whose remaining state is loaded by shard."""
+        obj = cls.__new__(cls)
+        obj.__dict__.update(stub)
+        obj._shard = shard
+        return obj
+
+    def Link(self, packages, classes, protos):
+        """Arranges for PopulateDependencies to be called on demand."""
+        self._linker = (packages, classes, protos)
+
     def DepName(self):
         raise NotImplementedError
 
 class JavaFile(File):
 
+    _STUB_ATTRS = ("module", "path", "name", "package")
+    _LINKED_ATTRS = ("classes",)
+
     def __init__(self, module, path, name, contents):
         self.module = module
         self.path = path
         self.name = name
 
-        contents = CLEAN_CODE_RE.sub(lambda x: x.group("repl") or "", contents)
+        contents = CleanCode(contents)
 
         package = PACKAGE_RE.search(contents).group(1)
         imports = IMPORT_RE.findall(contents)
-        local_refs = LOCAL_RE.findall(contents)
-        full_refs = FULL_RE.findall(contents)
-
-        classes = dict((m, None) for m in local_refs)
+        local_refs, full_refs = ScanReferences(contents)
 
-        for m in imports + full_refs:
-            if (m.startswith("java.") or
-                m.startswith("com.sun.management") or
-                m.startswith("com.sun.net.httpserver")):
-                continue
-            match = IMPORT_PARSE_RE.search(m)
-            if match:
-                classes[match.group(1)] = m
+        classes = _ParsedClasses(local_refs, imports + full_refs)
 
         #print package
         #print classes
@@ -173,9 +315,9 @@ class JavaFile(File):
             else:
                 # Couldn't match any existing files, check the passed
                 # in classes (aka JARs).
-                match = m.group(0)
-                if match in classes:
-                    name_classes[name] = classes[match]
+                jar = classes.Lookup(package, m.group(4))
+                if jar:
+                    name_classes[name] = jar
 
         for ns in self.namespaces:
             pmap = packages.get(ns)
@@ -208,15 +350,45 @@ class JarFile(File):
         self.module = module
         self.name = name
         self.path = path
+        self.stat = None
 
-        self.classes = set()
-
+        names = {}
         f = zipfile.ZipFile(filename, "r")
         for info in f.infolist():
             if info.filename.endswith(".class"):
-                self.classes.add(info.filename[:-6].replace("/", "."))
+                package, _, name = info.filename[:-6].rpartition("/")
+                names.setdefault(package.replace("/", "."), []).append(name)
         f.close()
 
+        # Package -> the names of the classes in it, one per line and
+        # with a newline on either end, so that a class can be looked up
+        # with a substring search. This is a lot smaller, both in memory
+        # and in the cache, than one string per class.
+        self.packages = dict(
+            (intern(package), "\n%s\n" % "\n".join(sorted(names)))
+            for package, names in names.iteritems())
+
+    def __getstate__(self):
+        return (self.module, self.path, self.name, self.packages, self.stat)
+
+    def __setstate__(self, state):
+        self.module = state[0]
+        self.path = state[1]
+        self.name = state[2]
+        self.packages = dict((intern(package), names)
+                             for package, names in state[3].iteritems())
+        self.stat = state[4]
+
+    def HasClass(self, package, name):
+        """Returns whether the jar has the given class.
+
+        Args:
+          package: The package, e.g. "com.google.protobuf"
+          name: The class name within the package, e.g. "Message"
+        """
+        names = self.packages.get(package)
+        return names is not None and ("\n%s\n" % name) in names
+
     def DepName(self):
         return "%s=%s:%s" % (self.module, self.path, self.name)
 
@@ -227,10 +399,19 @@ PROTO_IMPORT_RE = re.compile(r"import \"(.*)\";")
 
 class ProtoFile(File):
 
+    # Protos are small enough to keep entirely in the cache index.
+    _STUB_ATTRS = ("module", "path", "protoname", "name", "package", "deps")
+    _LINKED_ATTRS = ("classes", "extras")
+
+    # The protos whose dependencies are being computed, each one
+    # imported by the one before it.
+    _linking = []
+
     def __init__(self, module, path, name, filename):
         self.module = module
         self.protoname = name
         self.path = path
+        self.stat = None
 
         proto = open(filename).read()
 
@@ -244,13 +425,36 @@ class ProtoFile(File):
 
         self.deps = PROTO_IMPORT_RE.findall(proto)
 
-        self.classes = [self]
+    def __getstate__(self):
+        return (self.module, self.path, self.protoname, self.name,
+                self.package, self.deps, self.stat)
+
+    def __setstate__(self, state):
+        (self.module, self.path, self.protoname, self.name,
+         self.package, self.deps, self.stat) = state
 
     def DepName(self):
         return "%s=%s:lib%s" % (self.module, self.path, self.name)
 
     def PopulateDependencies(self, packages, classes, protos):
-        self.extras = []
+        """Finds the imported protos, and all the files they need.
+
+        extras ends up holding every proto imported directly or
+        indirectly, once each, in the order they are first reached.
+        The imported protos are linked through the lazy "extras"
+        attribute, so each one computes its closure only once however
+        many protos import it.
+        """
+        ProtoFile._linking.append(self)
+        try:
+            self._PopulateDependencies(packages, classes, protos)
+        finally:
+            ProtoFile._linking.pop()
+
+    def _PopulateDependencies(self, packages, classes, protos):
+        self.classes = [self]
+        extras = []
+        seen = set()
         for dep in self.deps:
             assert dep.endswith(".proto"), (
                 "Dependency %s of %s does not end in .proto" %
@@ -260,16 +464,30 @@ class ProtoFile(File):
             assert proto in protos, (
                 "Could not find dependency %s of %s" % (dep, self.DepName()))
             proto_file = protos[proto]
-            self.classes.append(proto_file)
+            if proto_file in ProtoFile._linking:
+                cycle = ProtoFile._linking[
+                    ProtoFile._linking.index(proto_file):] + [proto_file]
+                raise ImportCycleError(
+                    "Import cycle: %s" %
+                    " -> ".join(f.DepName() for f in cycle))
+            if proto_file not in self.classes:
+                self.classes.append(proto_file)
+
+            if not any(attr in proto_file.__dict__
+                       for attr in ("_linker", "extras")):
+                proto_file.Link(packages, classes, protos)
 
             dep_path = os.path.abspath(os.path.join(proto_file.module, dep))
-            self.extras.append((dep, dep_path))
-
-            proto_file.PopulateDependencies(packages, classes, protos)
-            self.extras.extend(proto_file.extras)
+            for extra in [(dep, dep_path)] + proto_file.extras:
+                if extra not in seen:
+                    seen.add(extra)
+                    extras.append(extra)
+        self.extras = extras
 
 class JSPFile(JavaFile):
 
+    _STUB_ATTRS = ("module", "path", "name")
+
     PAGE_RE = re.compile(r"<%@\s*page[^%]*import=.*?%>", re.M | re.S)
     CODE_RE = re.compile(r"<%=?(.*?)%>", re.M | re.S)
     IMPORT_RE = re.compile(r"import=\"([^\"]*)\"")
@@ -282,8 +500,6 @@ class JSPFile(JavaFile):
         jsp = open(filename).read()
 
         imports = []
-        full_refs = []
-        local_refs = []
 
         # TODO(ilia): Attempt to reuse the JavaFile constructor.
 
@@ -294,11 +510,9 @@ class JSPFile(JavaFile):
             for m in self.IMPORT_RE.finditer(pagetag):
                 imports.extend(x.strip() for x in m.group(1).split(","))
 
-        # Find any full class references in the code
-        for contents in self.CODE_RE.finditer(jsp):
-            c = contents.group(1)
-            full_refs.extend(FULL_RE.findall(c))
-            local_refs.extend(LOCAL_RE.findall(c))
+        # Find any class references in the code
+        local_refs, full_refs = ScanReferences(
+            " ".join(m.group(1) for m in self.CODE_RE.finditer(jsp)))
 
         classes = dict((m, None) for m in local_refs)
 
@@ -336,6 +550,8 @@ class JSPFile(JavaFile):
 
 class XmlClassFile(JavaFile):
 
+    _STUB_ATTRS = ("module", "path", "name")
+
     CLASS_RE = re.compile(r"<[^<]*-class>(.*?)</[^<]*-class>")
 
     def __init__(self, module, path, name, filename):
@@ -379,6 +595,8 @@ class XmlClassFile(JavaFile):
 
 class GroovyFile(JavaFile):
 
+    _STUB_ATTRS = ("module", "path", "name", "package")
+
     CODE_RE_1 = re.compile(r"%{(.*?)}%", re.M | re.S)
     CODE_RE_2 = re.compile(r"[\#\$]{(.*?)}", re.M | re.S)
 
@@ -389,28 +607,14 @@ class GroovyFile(JavaFile):
 
         groovy = open(filename).read()
 
-        full_refs = []
-        for contents in self.CODE_RE_1.finditer(groovy):
-            c = contents.group(1)
-            full_refs.extend(FULL_RE.findall(c))
-        for contents in self.CODE_RE_2.finditer(groovy):
-            c = contents.group(1)
-            full_refs.extend(FULL_RE.findall(c))
+        code = [m.group(1) for m in self.CODE_RE_1.finditer(groovy)]
+        code.extend(m.group(1) for m in self.CODE_RE_2.finditer(groovy))
+        _, full_refs = ScanReferences(" ".join(code))
 
         self.package = path.replace("/", ".")
         self.namespaces = []
-        classes = {}
-
-        for m in full_refs:
-            if (m.startswith("java.") or
-                m.startswith("com.sun.management") or
-                m.startswith("com.sun.net.httpserver")):
-                continue
-            match = IMPORT_PARSE_RE.search(m)
-            if match:
-                classes[match.group(1)] = m
 
-        self.parsed_classes = classes
+        self.parsed_classes = _ParsedClasses([], full_refs)
         self.stat = None
 
     def __getstate__(self):
@@ -442,92 +646,232 @@ class Module(object):
 
         self.jsps = []
 
-def ComputeDependencies(dirs):
-    print >>sys.stderr, "autodep", time.time(), "...",
+        # File name -> File, for every file above
+        self.filenames = {}
+
+        # Directory name -> os.stat(), for every directory walked
+        self.dirs = {}
+
+class _JarIndex(object):
+
+    """Finds the JarFile that provides a class.
+
+    The index only maps each package to the jars that have classes in
+    it; the class names themselves stay in the jars (see
+    JarFile.packages). It is built on first use, so the jars (and the
+    cache shards holding them) are only loaded once something needs to
+    be linked.
+    """
+
+    def __init__(self, modules):
+        self._modules = modules
+        self._packages = None
+
+    def _Packages(self):
+        if self._packages is not None:
+            return self._packages
+        packages = {}
+        for module in self._modules.itervalues():
+            for jar in module.jars:
+                for package in jar.packages:
+                    packages.setdefault(package, []).append(jar)
+        self._packages = packages
+        return packages
+
+    def Lookup(self, package, name):
+        """Returns the JarFile providing package.name, or None.
+
+        When several jars have the class, the first one wins, except
+        that Core/jars is preferred over the more obscure jars.
+        """
+        if IGNORE_JAR_CLASSES_RE.match("%s.%s" % (package, name)):
+            return None
+        found = None
+        for jar in self._Packages().get(package, ()):
+            if jar.HasClass(package, name) and (
+                found is None or jar.module in ("Core/jars",)):
+                found = jar
+        return found
+
+def _IgnorePatterns(module):
+    """Returns the ignore patterns of a module.
+
+    These come from the module's entry in the ignore section of icbm.cfg
+    and from an .icbmignore file at the root of the module, which has
+    one pattern per line. Patterns are fnmatch-style. A pattern that
+    contains a / is matched against the path relative to the module;
+    otherwise it is matched against the base name at any depth.
+    """
+    patterns = list(config.IGNORE.get(module, []))
+    try:
+        with open(os.path.join(module, ".icbmignore")) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    patterns.append(line.rstrip("/"))
+    except IOError:
+        pass
+    return patterns
+
+def _Ignored(path, patterns):
+    """Whether the module-relative path matches any of the patterns."""
+    name = os.path.basename(path)
+    for pattern in patterns:
+        if fnmatch.fnmatchcase(path if "/" in pattern else name, pattern):
+            return True
+    return False
+
+def _SkipDir(module, path, name, ignore):
+    """Whether autodep should stay out of a directory.
+
+    Args:
+      module: The module being walked
+      path: The parent directory, relative to the module
+      name: The name of the directory
+      ignore: The module's ignore patterns
+    """
+    if name.startswith("."):
+        return True
+    if module in ("closure",):
+        return True
+    if not path:
+        # src is a module of its own, and the others hold build output.
+        if name.startswith(("src", "build", "jars-build", "play")):
+            return True
+    elif name in ("build", "jars-build") or name.startswith("tmp"):
+        return True
+    return ignore and _Ignored(os.path.join(path, name), ignore)
+
+def _FileType(module, path, f):
+    """Determines how autodep should parse a file.
+
+    Args:
+      module: The module the file belongs to
+      path: The directory of the file, relative to the module
+      f: The base name of the file
+
+    Returns: A (File subclass, name) tuple, or None if the file is not
+    interesting to autodep.
+    """
+    if f.endswith(".java") and module not in ("thirdparty", "closure"):
+        return JavaFile, f[:-5]
+    elif f.endswith(".jar"):
+        return JarFile, f[:-4]
+    elif f.endswith(".proto"):
+        return ProtoFile, f[:-6]
+    elif f.endswith(".jsp") or f.endswith(".jspf"):
+        return JSPFile, f.rsplit(".", 1)[0]
+    elif f.endswith(".tld"):
+        return XmlClassFile, f.rsplit(".", 1)[0]
+    elif "WEB-INF" in path and f == "web.xml":
+        return XmlClassFile, f.rsplit(".", 1)[0]
+    elif "/app/views" in path:
+        return GroovyFile, f
+    return None
+
+def _ParseFile(args):
+    """Constructs the File object for a single file.
+
+    This is the unit of work handed to the autodep worker processes, so
+    it must be a module level function and its result must be picklable.
+    """
+    cls, module, path, name, fname = args
+    if cls is JavaFile:
+        contents = open(fname).read()
+        return (fname, autodep_cache.FileDigest(fname, contents),
+                cls(module, path, name, contents))
+    return (fname, autodep_cache.FileDigest(fname),
+            cls(module, path, name, fname))
+
+def _ParseFiles(stale):
+    """Parses the given files, in parallel if there are enough of them.
+
+    Args:
+      stale: List of argument tuples for _ParseFile
+
+    Yields: (filename, digest, File) tuples, in no particular order.
+    """
+    jobs = config.AUTODEP_JOBS or multiprocessing.cpu_count()
+    batch = max(1, config.AUTODEP_BATCH)
+    if jobs <= 1 or len(stale) <= batch:
+        for args in stale:
+            yield _ParseFile(args)
+        return
+
+    pool = multiprocessing.Pool(min(jobs, len(stale) // batch + 1))
     try:
-        with open("build/autodep.cache", "rb") as f:
-            cache = cPickle.load(f)
+        for result in pool.imap_unordered(_ParseFile, stale, batch):
+            yield result
+        pool.close()
     except:
-        cache = {}
-    dirty = False
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def ComputeDependencies(dirs):
+    print >>sys.stderr, "autodep", time.time(), "...",
+    cache = autodep_cache.AutodepCache(AUTODEP_CACHE_DIR)
     modules = {}
 
+    # (module, filename, stat) for every file autodep cares about, in
+    # walk order.
+    found = []
+    # Arguments to _ParseFile for every file whose cache entry is stale.
+    stale = []
+
     for d in dirs:
         #print >>sys.stderr, "parsing", d, time.time()
-        module = modules[d] = Module(d)
+        modules[d] = Module(d)
+        ignore = _IgnorePatterns(d)
         for root, dirs, files in os.walk(d):
+            modules[d].dirs[root] = os.stat(root)
             path = root[len(d)+1:]
-            if path.startswith("src"):
-                continue
-            if path.startswith("build") or "/build/" in path:
-                continue
-            if path.startswith("jars-build") or "/jars-build/" in path:
-                continue
-            if path.startswith("play"):
-                continue
-            if path and d in ("closure",):
-                continue
-            if "/tmp" in path:
-                continue
+            # Prune in place, so that the walk never enters these.
+            dirs[:] = [x for x in dirs if not _SkipDir(d, path, x, ignore)]
             for f in files:
                 if f.startswith("."):
                     continue
+                ftype = _FileType(d, path, f)
+                if not ftype:
+                    continue
+                if ignore and _Ignored(os.path.join(path, f), ignore):
+                    continue
                 fname = os.path.join(root, f)
                 stat = os.stat(fname)
-                jf = None
-                if (fname in cache and
-                    cache[fname].stat.st_mtime >= stat.st_mtime):
-                    jf = cache[fname]
-                if f.endswith(".java") and d not in ("thirdparty", "closure"):
-                    if not jf:
-                        jf = JavaFile(d, path, f[:-5], open(fname).read())
-                        cache[fname] = jf
-                        dirty = True
-                    jf.stat = stat
-                    module.files.setdefault(jf.package, []).append(jf)
-                elif f.endswith(".jar"):
-                    if not jf:
-                        jf = JarFile(d, path, f[:-4], fname)
-                        cache[fname] = jf
-                        dirty = True
-                    jf.stat = stat
-                    module.jars.append(jf)
-                elif f.endswith(".proto"):
-                    if not jf:
-                        jf = ProtoFile(d, path, f[:-6], fname)
-                        cache[fname] = jf
-                        dirty = True
-                    jf.stat = stat
-                    module.files.setdefault(jf.package, []).append(jf)
-                    module.protos.append(jf)
-                elif f.endswith(".jsp") or f.endswith(".jspf"):
-                    if not jf:
-                        jf = JSPFile(d, path, f.rsplit(".", 1)[0], fname)
-                        cache[fname] = jf
-                        dirty = True
-                    jf.stat = stat
-                    module.jsps.append(jf)
-                elif f.endswith(".tld"):
-                    if not jf:
-                        jf = XmlClassFile(d, path, f.rsplit(".", 1)[0], fname)
-                        cache[fname] = jf
-                        dirty = True
-                    jf.stat = stat
-                    module.jsps.append(jf)
-                elif "WEB-INF" in path and f == "web.xml":
-                    if not jf:
-                        jf = XmlClassFile(d, path, f.rsplit(".", 1)[0], fname)
-                        cache[fname] = jf
-                        dirty = True
-                    jf.stat = stat
-                    module.jsps.append(jf)
-                elif "/app/views" in path:
-                    if not jf:
-                        jf = GroovyFile(d, path, f, fname)
-                        cache[fname] = jf
-                        dirty = True
-                    jf.stat = stat
-                    module.files.setdefault(jf.package, []).append(jf)
+                jf = cache.Lookup(fname, stat)
+                found.append((d, fname, stat, jf))
+                if not jf:
+                    cls, name = ftype
+                    stale.append((cls, d, path, name, fname))
+
+    parsed = {}
+    if stale:
+        parse_start = time.time()
+        for fname, digest, jf in _ParseFiles(stale):
+            parsed[fname] = digest, jf
+        elapsed = max(time.time() - parse_start, 1e-6)
+        print >>sys.stderr, "parsed %d files (%.0f files/sec) ..." % (
+            len(stale), len(stale) / elapsed),
+    print >>sys.stderr, "cache %d hits, %d misses ..." % (
+        cache.hits, cache.misses),
+
+    for d, fname, stat, jf in found:
+        module = modules[d]
+        if not jf:
+            digest, jf = parsed[fname]
+            cache.Update(fname, stat, digest, jf)
+        jf.stat = stat
+        module.filenames[fname] = jf
+        if isinstance(jf, JarFile):
+            module.jars.append(jf)
+        elif isinstance(jf, ProtoFile):
+            module.files.setdefault(jf.package, []).append(jf)
+            module.protos.append(jf)
+        elif isinstance(jf, (JSPFile, XmlClassFile)):
+            module.jsps.append(jf)
+        else:
+            module.files.setdefault(jf.package, []).append(jf)
 
     #print >>sys.stderr, "linking", time.time()
     packages = {}
@@ -536,18 +880,7 @@ def ComputeDependencies(dirs):
             packages.setdefault(package, {}).update(dict(
                     (f.name, f) for f in module.files[package]))
 
-    classes = {}
-    for module in modules.itervalues():
-        for jar in module.jars:
-            for c in jar.classes:
-                #assert c not in classes, "%s: %r, %r" % (c, classes[c], jar)
-                # Prefer non-obscure jars
-                if IGNORE_JAR_CLASSES_RE.match(c):
-                    continue
-                if c in classes and module.name not in (
-                    "Core/jars",):
-                    continue
-                classes[c] = jar
+    classes = _JarIndex(modules)
 
     protos = {}
     for module in modules.itervalues():
@@ -556,23 +889,107 @@ def ComputeDependencies(dirs):
             assert protofn not in protos, protofn
             protos[protofn] = proto
 
+    # Linking happens on demand, when a file's dependencies are first
+    # asked for.
     for module in modules.itervalues():
         for farr in module.files.itervalues():
             for f in farr:
-                f.PopulateDependencies(packages, classes, protos)
+                f.Link(packages, classes, protos)
         for f in module.jsps:
-            f.PopulateDependencies(packages, classes, protos)
+            f.Link(packages, classes, protos)
 
-    if dirty:
-        def _WriteCache():
-            with open("build/autodep.cache", "wb") as f:
-                cPickle.dump(cache, f, -1)
-        threading.Thread(target=_WriteCache).start()
+    # The states of the changed files are taken here, before anything
+    # else uses them; only the writing is left to the thread.
+    write = cache.Snapshot()
+    if write:
+        threading.Thread(target=write).start()
 
     print >>sys.stderr, " done", time.time()
 
     return modules
 
+def _Node(f):
+    """Returns the name of the target that builds a File.
+
+    JSPs don't have targets of their own, they all end up in the
+    module's jsp_deps library.
+    """
+    if isinstance(f, (JSPFile, XmlClassFile)):
+        return "%s=:jsp_deps" % f.module
+    return f.DepName()
+
+def ReverseDependencies(modules):
+    """Computes which files depend on which, the other way around.
+
+    Finding out requires linking every file, so the result is persisted
+    in the autodep cache directory and reused for as long as none of
+    the files change.
+
+    Args:
+      modules: Modules as returned by ComputeDependencies
+
+    Returns: A (files, dependents) tuple. files maps file names to the
+    DepName of the library built from them (the jsp_deps library for
+    JSPs), and dependents maps a DepName to the set of DepNames of the
+    java files, protos and jsp_deps libraries that depend on it
+    directly.
+    """
+    h = hashlib.sha1()
+    for module in sorted(modules.itervalues(), key=lambda m: m.name):
+        for fname in sorted(module.filenames):
+            stat = module.filenames[fname].stat
+            h.update("%s %d %r\n" % (fname, stat.st_size, stat.st_mtime))
+    generation = h.hexdigest()
+
+    index_file = os.path.join(AUTODEP_CACHE_DIR, "rdeps")
+    loaded = autodep_cache.ReadVersioned(index_file, 2)
+    if loaded and loaded[0] == generation:
+        return loaded[1]
+
+    files = {}
+    dependents = {}
+    for module in modules.itervalues():
+        for fname, f in module.filenames.iteritems():
+            node = files[fname] = _Node(f)
+            if isinstance(f, JarFile):
+                continue
+            for c in f.classes:
+                if c is not f:
+                    dependents.setdefault(c.DepName(), set()).add(node)
+
+    index = (files, dependents)
+    autodep_cache.WriteVersioned(index_file, generation, index)
+    return index
+
+def Affected(index, paths):
+    """Finds the files affected by changes to the given paths.
+
+    Args:
+      index: The result of ReverseDependencies
+      paths: File names, relative to the current directory
+
+    Returns: A (affected, unknown) tuple, where affected is the set of
+    DepNames of the changed files and everything that transitively
+    depends on them, and unknown lists the paths autodep doesn't know.
+    """
+    files, dependents = index
+    affected = set()
+    unknown = []
+    todo = []
+    for path in paths:
+        depname = files.get(os.path.normpath(os.path.relpath(path)))
+        if depname is None:
+            unknown.append(path)
+        else:
+            todo.append(depname)
+    while todo:
+        depname = todo.pop()
+        if depname in affected:
+            continue
+        affected.add(depname)
+        todo.extend(dependents.get(depname, ()))
+    return affected, unknown
+
 if __name__ == '__main__':
     modules = ComputeDependencies(sys.argv[1:])
     for module in modules.itervalues():
@@ -0,0 +1,129 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+import genautodep
+
+class ScanReferencesTest(unittest.TestCase):
+
+    def testLocalReferences(self):
+        local, full = genautodep.ScanReferences(
+            " Foo a = new Bar(); Baz.run(); x.Qux y; ")
+        self.assertEqual(set(["Foo", "Bar", "Baz"]), local)
+        self.assertEqual([], full)
+
+    def testLastReferenceWins(self):
+        _, full = genautodep.ScanReferences(
+            " com.x.Foo a; com.z.Foo b; ")
+        self.assertEqual(["com.x.Foo", "com.z.Foo"], full)
+        _, full = genautodep.ScanReferences(
+            " com.z.Foo b; com.x.Foo a; ")
+        self.assertEqual(["com.z.Foo", "com.x.Foo"], full)
+
+    def testPrefixOfLongerName(self):
+        # com.x.FooBar must not count as a later reference to com.x.Foo.
+        _, full = genautodep.ScanReferences(
+            " com.x.Foo a; com.z.Foo b; com.x.FooBar c; ")
+        classes = genautodep._ParsedClasses(set(), full)
+        self.assertEqual("com.z.Foo", classes["Foo"])
+        self.assertEqual("com.x.FooBar", classes["FooBar"])
+
+
+class ProtoDependenciesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def Proto(self, name, *imports):
+        filename = os.path.join(self.dir, "%s.proto" % name)
+        with open(filename, "w") as f:
+            f.write("option java_package = \"p\";\n")
+            for i in imports:
+                f.write("import \"p/%s.proto\";\n" % i)
+        return genautodep.ProtoFile("m", "p", name, filename)
+
+    def testExtras(self):
+        protos = {"p/a": self.Proto("a", "b"), "p/b": self.Proto("b", "c"),
+                  "p/c": self.Proto("c")}
+        protos["p/a"].PopulateDependencies({}, {}, protos)
+        self.assertEqual(["p/b.proto", "p/c.proto"],
+                         [dep for dep, _ in protos["p/a"].extras])
+
+    def testCycle(self):
+        protos = {"p/a": self.Proto("a", "b"), "p/b": self.Proto("b", "c"),
+                  "p/c": self.Proto("c", "b")}
+        with self.assertRaises(genautodep.ImportCycleError) as e:
+            protos["p/a"].PopulateDependencies({}, {}, protos)
+        self.assertEqual("Import cycle: m=p:libB -> m=p:libC -> m=p:libB",
+                         str(e.exception))
+
+        # The failed link doesn't leave anything behind that makes a
+        # later one look like a cycle.
+        protos = {"p/d": self.Proto("d", "e"), "p/e": self.Proto("e")}
+        protos["p/d"].PopulateDependencies({}, {}, protos)
+        self.assertEqual(["p/e.proto"],
+                         [dep for dep, _ in protos["p/d"].extras])
+
+
+class JarIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.modules = {}
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def Jar(self, module, name, *classes):
+        filename = os.path.join(self.dir, "%s.jar" % name)
+        with zipfile.ZipFile(filename, "w") as z:
+            z.writestr("META-INF/MANIFEST.MF", "")
+            for c in classes:
+                z.writestr("%s.class" % c.replace(".", "/"), "")
+        jar = genautodep.JarFile(module, "", name, filename)
+        self.modules.setdefault(
+            module, genautodep.Module(module)).jars.append(jar)
+        return jar
+
+    def testLookup(self):
+        a = self.Jar("thirdparty", "a", "com.x.Foo", "com.x.Foo$Inner",
+                     "com.x.FooBar", "com.x.y.Baz")
+        index = genautodep._JarIndex(self.modules)
+        self.assertEqual(a, index.Lookup("com.x", "Foo"))
+        self.assertEqual(a, index.Lookup("com.x", "FooBar"))
+        self.assertEqual(a, index.Lookup("com.x.y", "Baz"))
+        # Neither a prefix of a name, nor a class of another package.
+        self.assertEqual(None, index.Lookup("com.x", "Fo"))
+        self.assertEqual(None, index.Lookup("com.x", "Baz"))
+        self.assertEqual(None, index.Lookup("com.z", "Foo"))
+
+    def testPrecedence(self):
+        first = self.Jar("thirdparty", "first", "com.x.Foo", "com.x.Bar")
+        self.Jar("thirdparty", "second", "com.x.Foo")
+        core = self.Jar("Core/jars", "core", "com.x.Bar")
+        index = genautodep._JarIndex(self.modules)
+        self.assertEqual(first, index.Lookup("com.x", "Foo"))
+        self.assertEqual(core, index.Lookup("com.x", "Bar"))
+
+    def testIgnored(self):
+        self.Jar("thirdparty", "xml", "org.w3c.dom.Node")
+        index = genautodep._JarIndex(self.modules)
+        self.assertEqual(None, index.Lookup("org.w3c.dom", "Node"))
+
+    def testPickle(self):
+        jar = self.Jar("thirdparty", "a", "com.x.Foo")
+        copy = genautodep.JarFile.__new__(genautodep.JarFile)
+        copy.__setstate__(jar.__getstate__())
+        self.assertTrue(copy.HasClass("com.x", "Foo"))
+        self.assertFalse(copy.HasClass("com.x", "Bar"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,191 @@
+#!/usr/bin/python
+
+import os
+import struct
+import subprocess
+import threading
+
+_ADAPTER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "GenerateWorker.java")
+
+# Held while GenerateWorker.java is compiled, so that workers that are
+# started at the same time don't write the class files at once.
+_compile_lock = threading.Lock()
+
+class WorkerError(Exception):
+    pass
+
+
+def _String(s):
+    if isinstance(s, unicode):
+        s = s.encode("utf-8")
+    return struct.pack(">i", len(s)) + s
+
+
+def _Read(f, n):
+    data = f.read(n)
+    if len(data) != n:
+        raise WorkerError("Worker exited")
+    return data
+
+
+class Worker(object):
+
+    """A running worker process, which handles one request at a time.
+
+    Requests go to the worker's stdin and responses come back on its
+    stdout. Every string is sent as a 4 byte big-endian length followed
+    by that many bytes of UTF-8:
+
+      request:  int n, then n strings: the absolute path of the
+                directory the tool would have been run in, followed by
+                the arguments it would have been run with
+      response: int exit code, then a string with the tool's output
+
+    A worker exits when its stdin is closed.
+    """
+
+    def __init__(self, process):
+        self.process = process
+
+    def Request(self, directory, args):
+        """Returns (exit code, output) of running the tool on args."""
+        request = [struct.pack(">i", len(args) + 1), _String(directory)]
+        request.extend(_String(arg) for arg in args)
+        try:
+            self.process.stdin.write("".join(request))
+            self.process.stdin.flush()
+            returncode, length = struct.unpack(
+                ">ii", _Read(self.process.stdout, 8))
+            output = _Read(self.process.stdout, length)
+        except IOError as e:
+            raise WorkerError("Worker failed: %s" % e)
+        return returncode, output
+
+    def Stop(self, kill=False):
+        """Stops the worker.
+
+        Args:
+          kill: Whether to terminate it rather than let it exit
+        """
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        if kill and self.process.poll() is None:
+            try:
+                self.process.terminate()
+            except OSError:
+                pass
+        self.process.wait()
+
+
+class WorkerPool(object):
+
+    """The persistent workers of Generate targets.
+
+    A generate rule opts in by naming a worker command. The first time
+    that the rule runs, the command is started, and the process is kept
+    for the rest of the build and handles every later action with the
+    same command. A worker runs one action at a time, so more of them
+    are started as needed when actions run in parallel. Workers run in
+    the top directory of the workspace, so relative paths in the
+    command are relative to it.
+
+    The command "GenerateWorker <classpath> <main class>" runs the main
+    class of a Java generator on GenerateWorker.java, the reference
+    adapter, with the given classpath. In place of the main class, it
+    takes "antlr" or "plovr", which run those generators given the
+    arguments of genantlr.sh and genjs.sh.
+    """
+
+    def __init__(self, state_dir, jvm_memory):
+        """Constructor.
+
+        Args:
+          state_dir: Directory to compile GenerateWorker.java into
+          jvm_memory: Megabytes of heap of GenerateWorker JVMs
+        """
+        self.state_dir = state_dir
+        self.jvm_memory = jvm_memory
+        self.lock = threading.Lock()
+        # command -> idle Workers
+        self.idle = {}
+        self.workers = []
+
+    def Run(self, popen, command, directory, args):
+        """Runs an action on a worker.
+
+        Args:
+          popen: Function to start the worker with, like subprocess.Popen
+          command: The worker command
+          directory: The directory the action would run in
+          args: The arguments of the tool
+
+        Returns: (exit code, output)
+
+        Raises: WorkerError if the worker can't be started, or it
+        fails even after being restarted.
+        """
+        command = tuple(command)
+        for attempt in xrange(2):
+            worker = self._Get(popen, command)
+            try:
+                result = worker.Request(directory, args)
+            except WorkerError:
+                worker.Stop(kill=True)
+                if attempt:
+                    raise
+                continue
+            with self.lock:
+                self.idle[command].append(worker)
+            return result
+
+    def _Get(self, popen, command):
+        with self.lock:
+            idle = self.idle.setdefault(command, [])
+            if idle:
+                return idle.pop()
+        cmd = self._Command(command)
+        print "Starting worker", cmd
+        try:
+            p = popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                      close_fds=True)
+        except OSError as e:
+            raise WorkerError("Could not start %s: %s" % (cmd, e))
+        worker = Worker(p)
+        with self.lock:
+            self.workers.append(worker)
+        return worker
+
+    def _Command(self, command):
+        if command[0] != "GenerateWorker":
+            return list(command)
+        if len(command) < 3:
+            raise WorkerError(
+                "Usage: GenerateWorker <classpath> "
+                "<main class | antlr | plovr> [args]")
+        classfile = os.path.join(self.state_dir, "GenerateWorker.class")
+        with _compile_lock:
+            if (not os.path.exists(classfile) or
+                os.path.getmtime(classfile) < os.path.getmtime(_ADAPTER)):
+                if not os.path.isdir(self.state_dir):
+                    os.makedirs(self.state_dir)
+                cmd = ["javac", "-d", self.state_dir, _ADAPTER]
+                print cmd
+                if subprocess.call(cmd, close_fds=True) != 0:
+                    raise WorkerError("Could not compile %s" % _ADAPTER)
+        cmd = ["java"]
+        if self.jvm_memory > 0:
+            cmd.append("-Xmx%dm" % self.jvm_memory)
+        # The generator gets a class loader of its own, for the
+        # classpath that is passed on.
+        return (cmd + ["-cp", self.state_dir, "GenerateWorker"] +
+                list(command[1:]))
+
+    def Shutdown(self):
+        """Stops all the workers."""
+        with self.lock:
+            workers, self.workers, self.idle = self.workers, [], {}
+        for worker in workers:
+            worker.Stop()
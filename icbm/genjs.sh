@@ -1,5 +1,8 @@
 #!/bin/bash
 
+# A generate rule can run this on a persistent JVM instead with
+# worker = "GenerateWorker <plovr jar> plovr" (see GenerateWorker.java).
+
 # Assume first arg is the classpath extras
 # Assume second arg is config file
 CONFIG=$2
@@ -8,4 +8,6 @@ else
   PROTOC=${PROTOC:-protoc}
 fi
 
-exec ${PROTOC} -I. --java_out=. "$1"
+# Takes any number of .proto files, which ICBM batches (see
+# engine.Generate.RunBatch).
+exec ${PROTOC} -I. --java_out=. "$@"
@@ -0,0 +1,290 @@
+#!/usr/bin/python
+
+import hashlib
+import httplib
+import os
+import Queue
+import socket
+import sys
+import threading
+import time
+import urlparse
+
+# Remote errors in a row after which the remote cache is not used for
+# the rest of the build.
+_MAX_FAILURES = 3
+
+class RemoteError(Exception):
+    pass
+
+
+def FormatManifest(manifest):
+    """Serializes an action manifest (see ActionCache) for the wire.
+
+    Every output is one line of "<digest> <octal mode> <relpath>".
+    """
+    return "".join("%s %o %s\n" % (digest, mode, relpath)
+                   for relpath, digest, mode in manifest)
+
+
+def ParseManifest(text):
+    """Inverse of FormatManifest."""
+    manifest = []
+    for line in text.splitlines():
+        try:
+            digest, mode, relpath = line.split(" ", 2)
+            mode = int(mode, 8)
+        except ValueError:
+            raise RemoteError("Bad manifest line: %r" % line)
+        if (len(digest) != 40 or os.path.isabs(relpath) or
+            ".." in relpath.split("/")):
+            raise RemoteError("Bad manifest line: %r" % line)
+        manifest.append((relpath, digest, mode))
+    return manifest
+
+
+def _Shutdown(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+        pass
+
+
+class RemoteCache(object):
+
+    """Client of a remote action cache, spoken to over HTTP.
+
+    The protocol has two kinds of resources, both of which are read
+    with GET (or HEAD) and written with PUT:
+
+      <url>/ac/<action key>   the manifest of an action (FormatManifest)
+      <url>/cas/<digest>      the contents of an output, by SHA-1
+
+    An action's blobs are always written before its manifest, so a
+    manifest the server has never refers to missing blobs. See
+    cache_server.py for a reference server.
+
+    Connections are kept alive and pooled between the engine workers.
+    Downloads happen on the worker that asks for them, but are given
+    up on after the timeout. Uploads are queued and done by background
+    threads, so they never hold up a build; Flush waits for them.
+    """
+
+    def __init__(self, url, timeout, uploaders=4):
+        """Constructor.
+
+        Args:
+          url: Base URL of the cache, e.g. http://cache:8080/
+          timeout: Seconds a single restore may take before the action
+                   is treated as a miss and run locally
+          uploaders: Number of background upload threads
+        """
+        parsed = urlparse.urlsplit(url)
+        if parsed.scheme != "http":
+            raise ValueError("Unsupported remote cache URL: %s" % url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.base = parsed.path.rstrip("/")
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.disabled = False
+        # Idle connections
+        self.pool = Queue.LifoQueue()
+        self.uploads = Queue.Queue()
+        for _ in xrange(uploaders):
+            t = threading.Thread(target=self._Uploader)
+            t.daemon = True
+            t.start()
+
+    def _Request(self, method, path, body=None, deadline=None, out=None):
+        """Sends a request and returns the status and the response body.
+
+        Args:
+          method: The HTTP method
+          path: The path below the base URL
+          body: A string or file to send
+          deadline: time.time() after which to give up, or None. It
+                    covers the whole request, including a retry and
+                    reading the response body, not just every single
+                    socket operation.
+          out: If given, a function that the response body of a
+               successful GET is streamed to instead of returned
+        """
+        def _Timeout():
+            if deadline is None:
+                return self.timeout
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                raise RemoteError("%s %s: Timed out" % (method, path))
+            return timeout
+
+        headers = {}
+        if hasattr(body, "fileno"):
+            headers["Content-Length"] = str(os.fstat(body.fileno()).st_size)
+        try:
+            conn, pooled = self.pool.get_nowait(), True
+        except Queue.Empty:
+            conn, pooled = None, False
+        while True:
+            try:
+                timeout = _Timeout()
+            except RemoteError:
+                if conn:
+                    conn.close()
+                raise
+            if conn is None:
+                conn = httplib.HTTPConnection(self.host, self.port,
+                                              timeout=timeout)
+            timer = None
+            try:
+                if conn.sock:
+                    conn.sock.settimeout(timeout)
+                conn.request(method, self.base + path, body, headers)
+                # The socket timeout only bounds every single recv, so
+                # a body that trickles in would never trip it. Instead,
+                # the socket is shut down once the deadline passes.
+                if deadline is not None:
+                    timer = threading.Timer(_Timeout(), _Shutdown,
+                                            (conn.sock,))
+                    timer.start()
+                response = conn.getresponse()
+                if out and response.status == httplib.OK:
+                    data, sink = None, out
+                else:
+                    data = []
+                    sink = data.append
+                while True:
+                    block = response.read(1 << 16)
+                    if not block:
+                        break
+                    sink(block)
+                if data is not None:
+                    data = "".join(data)
+            except RemoteError:
+                conn.close()
+                raise
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                conn = None
+                # Don't retry once the deadline has passed.
+                _Timeout()
+                # The server may have closed an idle connection.
+                if pooled:
+                    pooled = False
+                    if hasattr(body, "seek"):
+                        body.seek(0)
+                    continue
+                raise RemoteError("%s %s: %s" % (method, path, e))
+            finally:
+                if timer:
+                    timer.cancel()
+            break
+        if response.will_close:
+            conn.close()
+        else:
+            self.pool.put(conn)
+        return response.status, data
+
+    def _Failed(self, e):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= _MAX_FAILURES and not self.disabled:
+                self.disabled = True
+                print >>sys.stderr, (
+                    "Remote cache is failing (%s), not using it any more" % e)
+
+    def _Succeeded(self):
+        with self.lock:
+            self.failures = 0
+
+    def Download(self, key, blob_path, write_atomic):
+        """Fetches an action from the remote cache.
+
+        Args:
+          key: The action key
+          blob_path: Function from a digest to the local file its
+                     contents belong in; blobs already there are not
+                     downloaded again
+          write_atomic: Function (filename, write) that creates a file
+                        by calling write with a file object
+
+        Returns: The manifest of the action, or None if the remote
+        cache doesn't have it (or didn't answer in time).
+        """
+        if self.disabled:
+            return None
+        deadline = time.time() + self.timeout
+        try:
+            status, text = self._Request("GET", "/ac/" + key,
+                                         deadline=deadline)
+            if status != httplib.OK:
+                self._Succeeded()
+                return None
+            manifest = ParseManifest(text)
+            for _, digest, _ in manifest:
+                path = blob_path(digest)
+                if os.path.exists(path):
+                    continue
+                def _Write(f):
+                    h = hashlib.sha1()
+                    def _Out(block):
+                        h.update(block)
+                        f.write(block)
+                    status, _ = self._Request("GET", "/cas/" + digest,
+                                              deadline=deadline, out=_Out)
+                    if status != httplib.OK:
+                        raise RemoteError("Missing blob %s" % digest)
+                    if h.hexdigest() != digest:
+                        raise RemoteError("Corrupt blob %s" % digest)
+                write_atomic(path, _Write)
+        except (RemoteError, IOError, OSError) as e:
+            self._Failed(e)
+            return None
+        self._Succeeded()
+        return manifest
+
+    def Upload(self, key, manifest, blob_path):
+        """Queues an action to be stored in the remote cache.
+
+        Args:
+          key: The action key
+          manifest: The manifest of the action
+          blob_path: Function from a digest to the local file with its
+                     contents
+        """
+        if not self.disabled:
+            self.uploads.put((key, manifest, blob_path))
+
+    def _Uploader(self):
+        while True:
+            key, manifest, blob_path = self.uploads.get()
+            try:
+                if not self.disabled:
+                    self._Upload(key, manifest, blob_path)
+                    self._Succeeded()
+            except (RemoteError, IOError, OSError) as e:
+                self._Failed(e)
+            finally:
+                self.uploads.task_done()
+
+    def _Upload(self, key, manifest, blob_path):
+        for digest in set(d for _, d, _ in manifest):
+            status, _ = self._Request("HEAD", "/cas/" + digest)
+            if status == httplib.OK:
+                continue
+            with open(blob_path(digest), "rb") as f:
+                status, _ = self._Request("PUT", "/cas/" + digest, f)
+            if status not in (httplib.OK, httplib.CREATED):
+                raise RemoteError("PUT of blob %s: %d" % (digest, status))
+        status, _ = self._Request("PUT", "/ac/" + key,
+                                  FormatManifest(manifest))
+        if status not in (httplib.OK, httplib.CREATED):
+            raise RemoteError("PUT of action %s: %d" % (key, status))
+
+    def Flush(self):
+        """Waits for the queued uploads to finish."""
+        if self.uploads.unfinished_tasks:
+            print "Waiting for %d uploads to the remote cache" % (
+                self.uploads.unfinished_tasks)
+        self.uploads.join()
@@ -0,0 +1,161 @@
+#!/usr/bin/python
+
+import hashlib
+import httplib
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import cache_server
+import fileutil
+import remote_cache
+
+class RemoteCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.server = cache_server.CacheServer(
+            ("127.0.0.1", 0), os.path.join(self.dir, "server"))
+        self.port = self.server.server_address[1]
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.url = "http://127.0.0.1:%d/" % self.port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def Blobs(self, name):
+        """Returns a blob_path function for a local blob directory."""
+        dirname = os.path.join(self.dir, name)
+        return lambda digest: os.path.join(dirname, digest)
+
+    def Blob(self, blob_path, contents):
+        digest = hashlib.sha1(contents).hexdigest()
+        fileutil.WriteAtomic(blob_path(digest), lambda f: f.write(contents))
+        return digest
+
+    def Put(self, path, body):
+        conn = httplib.HTTPConnection("127.0.0.1", self.port)
+        conn.request("PUT", path, body)
+        status = conn.getresponse().status
+        conn.close()
+        return status
+
+    def testRoundTrip(self):
+        local = self.Blobs("local")
+        digest = self.Blob(local, "class file")
+        manifest = [("com/example/Foo.class", digest, 0644)]
+        key = "1" * 40
+        client = remote_cache.RemoteCache(self.url, 5)
+        client.Upload(key, manifest, local)
+        client.Flush()
+        self.assertEqual(0, client.failures)
+
+        other = self.Blobs("other")
+        client = remote_cache.RemoteCache(self.url, 5)
+        self.assertEqual(manifest,
+                         client.Download(key, other, fileutil.WriteAtomic))
+        with open(other(digest)) as f:
+            self.assertEqual("class file", f.read())
+        self.assertEqual(None, client.Download(
+            "2" * 40, other, fileutil.WriteAtomic))
+        self.assertEqual(0, client.failures)
+
+    def testServerRejectsWrongDigest(self):
+        digest = hashlib.sha1("right").hexdigest()
+        self.assertEqual(400, self.Put("/cas/" + digest, "wrong"))
+        self.assertEqual(201, self.Put("/cas/" + digest, "right"))
+        self.assertEqual(400, self.Put("/cas/not-a-digest", "right"))
+
+    def testClientRejectsCorruptBlob(self):
+        digest = hashlib.sha1("right").hexdigest()
+        blob = os.path.join(self.dir, "server", "cas", digest[:2], digest)
+        fileutil.WriteAtomic(blob, lambda f: f.write("wrong"))
+        key = "1" * 40
+        self.assertEqual(201, self.Put(
+            "/ac/" + key, remote_cache.FormatManifest(
+                [("Foo.class", digest, 0644)])))
+
+        local = self.Blobs("local")
+        client = remote_cache.RemoteCache(self.url, 5)
+        self.assertEqual(None,
+                         client.Download(key, local, fileutil.WriteAtomic))
+        self.assertFalse(os.path.exists(local(digest)))
+        self.assertEqual(1, client.failures)
+
+    def testDeadline(self):
+        # A server that answers, but sends the body a byte at a time.
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(5)
+        def _Trickle():
+            conn, _ = listener.accept()
+            conn.recv(4096)
+            try:
+                conn.sendall("HTTP/1.1 200 OK\r\nContent-Length: 1000\r\n\r\n")
+                for _ in xrange(1000):
+                    conn.sendall("x")
+                    time.sleep(0.05)
+            except socket.error:
+                pass
+            conn.close()
+        t = threading.Thread(target=_Trickle)
+        t.daemon = True
+        t.start()
+
+        client = remote_cache.RemoteCache(
+            "http://127.0.0.1:%d/" % listener.getsockname()[1], 0.5)
+        start = time.time()
+        self.assertEqual(None, client.Download(
+            "1" * 40, self.Blobs("local"), fileutil.WriteAtomic))
+        self.assertTrue(time.time() - start < 2, time.time() - start)
+        self.assertEqual(1, client.failures)
+        listener.close()
+
+    def testDisabledAfterFailures(self):
+        # Nothing listens on the port once the socket is closed.
+        s = socket.socket()
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+        s.close()
+
+        client = remote_cache.RemoteCache("http://127.0.0.1:%d/" % port, 5)
+        local = self.Blobs("local")
+        stderr = sys.stderr
+        sys.stderr = open(os.devnull, "w")
+        try:
+            for _ in xrange(remote_cache._MAX_FAILURES):
+                self.assertFalse(client.disabled)
+                self.assertEqual(None, client.Download(
+                    "1" * 40, local, fileutil.WriteAtomic))
+        finally:
+            sys.stderr = stderr
+        self.assertTrue(client.disabled)
+
+        # Nothing is tried any more, not even uploads.
+        client._Request = None
+        self.assertEqual(None, client.Download(
+            "1" * 40, local, fileutil.WriteAtomic))
+        client.Upload("1" * 40, [], local)
+        self.assertEqual(0, client.uploads.unfinished_tasks)
+
+    def testSuccessResetsFailures(self):
+        client = remote_cache.RemoteCache(self.url, 5)
+        client._Failed(remote_cache.RemoteError("flaky"))
+        client._Failed(remote_cache.RemoteError("flaky"))
+        self.assertEqual(None, client.Download(
+            "1" * 40, self.Blobs("local"), fileutil.WriteAtomic))
+        self.assertEqual(0, client.failures)
+        self.assertFalse(client.disabled)
+
+
+if __name__ == "__main__":
+    unittest.main()
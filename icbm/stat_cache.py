@@ -0,0 +1,83 @@
+#!/usr/bin/python
+
+import os
+
+_MISSING = object()
+
+def FromStat(st):
+    """Returns the (size, mtime, inode) tuple of an os.stat() result.
+
+    The mtime is in (integer) nanoseconds, which is cheaper to compare
+    and to write out than a float.
+    """
+    return (st.st_size, int(st.st_mtime * 1e9), st.st_ino)
+
+
+def Stat(path):
+    """Returns the FromStat tuple of a file, or None if it is missing."""
+    try:
+        return FromStat(os.stat(path))
+    except OSError:
+        return None
+
+
+class StatCache(object):
+
+    """Remembers the stats of files for the duration of a build.
+
+    Targets decide whether they are up to date by comparing the stats
+    of their inputs against those of their last run. Many targets share
+    the same source files, so each of those is only stat'ed once per
+    build. Files in the volatile directories (where targets write their
+    outputs) can change during the build, and are always stat'ed again.
+    """
+
+    def __init__(self, volatile=()):
+        """Constructor.
+
+        Args:
+          volatile: Directories whose files are not remembered
+        """
+        prefixes = set()
+        for d in volatile:
+            prefixes.add(os.path.join(d, ""))
+            prefixes.add(os.path.join(os.path.abspath(d), ""))
+        self.volatile = tuple(prefixes)
+        self.stats = {}
+        # The files in the volatile directories that were looked at
+        self.volatile_paths = set()
+
+    def Stat(self, path):
+        """Returns (size, mtime, inode) of a file, or None if it is missing.
+
+        Symlinks are followed. See FromStat.
+        """
+        s = self.stats.get(path, _MISSING)
+        if s is _MISSING:
+            s = Stat(path)
+            if not path.startswith(self.volatile):
+                self.stats[path] = s
+            else:
+                self.volatile_paths.add(path)
+        return s
+
+    def Signature(self, paths):
+        """Returns a list of (path, stat) for the given files."""
+        get = self.stats.get
+        signature = []
+        for path in paths:
+            s = get(path, _MISSING)
+            if s is _MISSING:
+                s = self.Stat(path)
+            signature.append((path, s))
+        return signature
+
+    def Snapshot(self):
+        """Returns (path, stat) for every file looked at so far.
+
+        The files in the volatile directories are stat'ed again, the
+        others are as they were first seen.
+        """
+        snapshot = self.stats.items()
+        snapshot.extend((path, Stat(path)) for path in self.volatile_paths)
+        return snapshot